@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
-from flask import Flask, render_template, request, jsonify, session, redirect
+from flask import Flask, render_template, request, jsonify, session, redirect, Response, stream_with_context, g
 import requests
 import os
 import json
-import google.generativeai as genai
+import time
+import re
+import math
+import gzip
+import base64
+import hashlib
+import difflib
+import sqlite3
+import random
+import fcntl
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from datetime import timedelta
 import yaml
 
@@ -22,33 +40,1013 @@ app.config.update(
 
 SUPERVISOR_TOKEN = os.environ.get('SUPERVISOR_TOKEN', '')
 GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY', '')
-HA_URL = 'http://supervisor/core/api'
+# Sovrascrivibili solo per sviluppo e benchmark (stub locali in benchmarks/)
+HA_URL = os.environ.get('HA_URL', 'http://supervisor/core/api')
+HA_WS_URL = os.environ.get('HA_WS_URL', 'ws://supervisor/core/websocket')
+GEMINI_API_ENDPOINT = os.environ.get('GEMINI_API_ENDPOINT', '')
+
+# ==================== SDK GEMINI ====================
+# google.generativeai (grpc/protobuf) è di gran lunga l'import più lento:
+# viene caricato al primo uso dell'AI (o dal warm-up dopo l'avvio del worker)
+# invece che all'import del modulo, così gunicorn risponde subito.
+
+_genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    """Modulo google.generativeai, importato e configurato al primo uso"""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                started = time.perf_counter()
+                import google.generativeai as genai
+                if GOOGLE_API_KEY:
+                    if GEMINI_API_ENDPOINT:
+                        genai.configure(api_key=GOOGLE_API_KEY, transport='rest', client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+                    else:
+                        genai.configure(api_key=GOOGLE_API_KEY)
+                _genai = genai
+                print(f"SDK Gemini caricato in {time.perf_counter() - started:.2f}s")
+    return _genai
+
+# ==================== MODELLI GEMINI ====================
+# Ogni compito (generate, explain, repair) ha il suo modello e la sua
+# generation_config. I modelli si scelgono nelle opzioni dell'add-on
+# (config.yaml -> run.sh -> GEMINI_<COMPITO>_MODEL, ..._TEMPERATURE,
+# ..._MAX_TOKENS); i client GenerativeModel sono creati una volta per worker.
+# fallback_model è il modello (più veloce) usato per le richieste hedged e
+# quando il modello principale fallisce. I compiti con una parte di prompt
+# fissa (TASK_SYSTEM_INSTRUCTIONS) la ricevono come system_instruction o,
+# se disponibile, come context cache (vedi CONTEXT CACHING GEMINI).
+
+MODEL_TASK_DEFAULTS = {
+    # Generazione: YAML il più possibile deterministico
+    'generate': {'model': 'gemini-3-flash-preview', 'fallback_model': 'gemini-2.0-flash', 'temperature': 0.2, 'max_output_tokens': 4096},
+    # Spiegazione: compito leggero, va al modello più veloce
+    'explain': {'model': 'gemini-2.0-flash-lite', 'fallback_model': 'gemini-2.0-flash-lite', 'temperature': 0.3, 'max_output_tokens': 1024},
+    # Correzione di un YAML non valido
+    'repair': {'model': 'gemini-3-flash-preview', 'fallback_model': 'gemini-2.0-flash', 'temperature': 0.0, 'max_output_tokens': 4096},
+}
+
+def _task_settings(task, defaults):
+    prefix = f"GEMINI_{task.upper()}"
+    return {
+        'model': os.environ.get(f"{prefix}_MODEL") or defaults['model'],
+        'fallback_model': os.environ.get(f"{prefix}_FALLBACK_MODEL") or defaults['fallback_model'],
+        'temperature': float(os.environ.get(f"{prefix}_TEMPERATURE") or defaults['temperature']),
+        'max_output_tokens': int(os.environ.get(f"{prefix}_MAX_TOKENS") or defaults['max_output_tokens'])
+    }
+
+class ModelRegistry:
+    """Modello e generation_config per compito, con client riusati nel worker"""
+    
+    def __init__(self, defaults):
+        self.tasks = {task: _task_settings(task, config) for task, config in defaults.items()}
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = None
+    
+    def model_name(self, task):
+        return self.tasks[task]['model']
+    
+    def signature(self, task):
+        """Identifica modello + generation_config + prompt fisso (per le chiavi di cache)"""
+        settings = self.tasks[task]
+        signature = f"{settings['model']}|{settings['temperature']}|{settings['max_output_tokens']}"
+        instruction = TASK_SYSTEM_INSTRUCTIONS.get(task)
+        if instruction:
+            signature += '|' + hashlib.sha256(instruction.encode('utf-8')).hexdigest()[:12]
+        return signature
+    
+    def get(self, task, model_name=None):
+        """GenerativeModel del compito (o di un altro modello con la stessa config), creato al primo uso in questo worker.
+        
+        Con una system_instruction e una context cache attiva per il modello
+        il client usa il contenuto in cache invece di reinviare il prefisso.
+        """
+        settings = self.tasks[task]
+        model_name = model_name or settings['model']
+        instruction = TASK_SYSTEM_INSTRUCTIONS.get(task)
+        cached_name = context_cache.get(model_name, instruction) if instruction else None
+        key = (task, model_name, cached_name)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._pid = os.getpid()
+            client = self._clients.get(key)
+        if client is None:
+            generation_config = {
+                'temperature': settings['temperature'],
+                'max_output_tokens': settings['max_output_tokens']
+            }
+            genai = get_genai()
+            client = None
+            if cached_name:
+                try:
+                    client = genai.GenerativeModel.from_cached_content(cached_name, generation_config=generation_config)
+                except Exception as e:
+                    print(f"WARN: context cache {cached_name} non utilizzabile: {e}")
+                    context_cache.invalidate(model_name, cached_name)
+            if client is None:
+                client = genai.GenerativeModel(model_name, generation_config=generation_config, system_instruction=instruction)
+            with self._lock:
+                client = self._clients.setdefault(key, client)
+        return client
+
+model_registry = ModelRegistry(MODEL_TASK_DEFAULTS)
+
+# ==================== METRICHE PROMETHEUS ====================
+# Esposte su /metrics. Con gunicorn i worker scrivono i valori in
+# PROMETHEUS_MULTIPROC_DIR (impostata da run.sh) e /metrics li aggrega tutti;
+# in sviluppo (processo singolo) si usa il registro di default.
+# I dati già condivisi su SQLite (cache persistenti, job) sono letti al
+# momento dello scrape da SharedStateCollector.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+GEMINI_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+PAYLOAD_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+
+http_requests_total = Counter(
+    'http_requests_total', 'Richieste HTTP per route', ['route', 'method', 'status']
+)
+http_request_duration_seconds = Histogram(
+    'http_request_duration_seconds', 'Latenza delle richieste HTTP per route', ['route', 'method'],
+    buckets=LATENCY_BUCKETS
+)
+gemini_requests_total = Counter(
+    'gemini_requests_total', 'Chiamate a Gemini per modello ed esito', ['model', 'outcome']
+)
+gemini_request_duration_seconds = Histogram(
+    'gemini_request_duration_seconds', 'Latenza delle chiamate a Gemini per modello', ['model'],
+    buckets=GEMINI_BUCKETS
+)
+gemini_coalesced_total = Counter(
+    'gemini_coalesced_total', 'Chiamate a Gemini evitate perché identiche a una in volo', ['model', 'scope']
+)
+gemini_call_path_total = Counter(
+    'gemini_call_path_total', 'Esito delle chiamate per compito: primary, hedge, fallback, timeout', ['task', 'path']
+)
+gemini_input_tokens_total = Counter(
+    'gemini_input_tokens_total', 'Token di input inviati a Gemini per modello (cached: serviti dalla context cache)',
+    ['model', 'kind']
+)
+gemini_candidates_total = Counter(
+    'gemini_candidates_total', 'Candidati di generazione per esito: selected, valid, invalid, error, cancelled', ['outcome']
+)
+gemini_throttled_total = Counter(
+    'gemini_throttled_total', 'Chiamate a Gemini rifiutate per quota', ['priority']
+)
+ha_requests_total = Counter(
+    'ha_requests_total', 'Chiamate REST al supervisor per endpoint ed esito', ['endpoint', 'outcome']
+)
+ha_request_duration_seconds = Histogram(
+    'ha_request_duration_seconds', 'Latenza delle chiamate REST al supervisor per endpoint', ['endpoint'],
+    buckets=LATENCY_BUCKETS
+)
+ha_registry_payload_bytes = Histogram(
+    'ha_registry_payload_bytes', 'Dimensione delle risposte /states e /services', ['registry'],
+    buckets=PAYLOAD_BUCKETS
+)
+yaml_parse_total = Counter(
+    'yaml_parse_total', 'Parsing YAML per esito della cache: hit, miss, error', ['result']
+)
+registry_cache_lookups_total = Counter(
+    'registry_cache_lookups_total', 'Letture dei registri HA per sorgente (mirror, fresh, stale, miss)',
+    ['registry', 'result']
+)
+llm_inflight = Gauge(
+    'llm_inflight', 'Richieste AI in corso nel pool LLM', ['state'], multiprocess_mode='livesum'
+)
+
+def observe_gemini_usage(model_name, usage_metadata):
+    """Token di input/output di una risposta Gemini: {'input_tokens', 'cached_tokens', 'output_tokens'}"""
+    if usage_metadata is None:
+        return {}
+    usage = {
+        'input_tokens': getattr(usage_metadata, 'prompt_token_count', 0) or 0,
+        'cached_tokens': getattr(usage_metadata, 'cached_content_token_count', 0) or 0,
+        'output_tokens': getattr(usage_metadata, 'candidates_token_count', 0) or 0
+    }
+    # prompt_token_count comprende anche i token serviti dalla cache
+    gemini_input_tokens_total.labels(model_name, 'cached').inc(usage['cached_tokens'])
+    gemini_input_tokens_total.labels(model_name, 'uncached').inc(max(0, usage['input_tokens'] - usage['cached_tokens']))
+    return usage
+
+def observe_gemini(model_name, started, outcome):
+    """Registra una chiamata a Gemini iniziata a 'started' (perf_counter)"""
+    gemini_requests_total.labels(model_name, outcome).inc()
+    gemini_request_duration_seconds.labels(model_name).observe(time.perf_counter() - started)
+
+class SharedStateCollector:
+    """Metriche lette dallo stato condiviso su SQLite (già aggregato fra i worker)"""
+    
+    def describe(self):
+        # Evita che register() chiami collect() all'import, prima che cache e job esistano
+        return []
+    
+    def collect(self):
+        hits = CounterMetricFamily('persistent_cache_hits', 'Hit delle cache persistenti', labels=['cache'])
+        misses = CounterMetricFamily('persistent_cache_misses', 'Miss delle cache persistenti', labels=['cache'])
+        entries = GaugeMetricFamily('persistent_cache_entries', 'Voci nelle cache persistenti', labels=['cache'])
+        size = GaugeMetricFamily('persistent_cache_bytes', 'Dimensione delle cache persistenti', labels=['cache'])
+        ratio = GaugeMetricFamily('persistent_cache_hit_ratio', 'Hit ratio delle cache persistenti', labels=['cache'])
+        for name, cache in PERSISTENT_CACHES.items():
+            stats = cache.stats()
+            if 'error' in stats:
+                continue
+            hits.add_metric([name], stats['hits'])
+            misses.add_metric([name], stats['misses'])
+            entries.add_metric([name], stats['entries'])
+            size.add_metric([name], stats['bytes'])
+            if stats['hit_ratio'] is not None:
+                ratio.add_metric([name], stats['hit_ratio'])
+        yield from (hits, misses, entries, size, ratio)
+        
+        jobs = GaugeMetricFamily('jobs_active', 'Job in coda o in esecuzione', labels=['kind', 'status'])
+        try:
+            for kind, status, count in job_store.count_active():
+                jobs.add_metric([kind, status], count)
+        except sqlite3.Error as e:
+            print(f"WARN: conteggio job non disponibile: {e}")
+        yield jobs
+
+def metrics_registry():
+    """Registro da esporre: aggregato multiprocesso se configurato"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(SharedStateCollector())
+        return registry
+    return REGISTRY
 
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
+if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    REGISTRY.register(SharedStateCollector())
+
+# ==================== CLIENT HTTP HOME ASSISTANT ====================
+# Tutte le chiamate REST verso il supervisor passano da ha_request(): una
+# requests.Session per processo (connessioni keep-alive in pool), timeout per
+# endpoint, retry con backoff su 502/503/504 e errori di connessione (HA in
+# riavvio) e statistiche di latenza per endpoint.
+
+HA_POOL_SIZE = int(os.environ.get('HA_POOL_SIZE', '16'))
+HA_RETRY_ATTEMPTS = int(os.environ.get('HA_RETRY_ATTEMPTS', '4'))
+HA_RETRY_BACKOFF = 0.5
+HA_RETRY_STATUSES = (502, 503, 504)
+
+# (prefisso endpoint, timeout in secondi): vince il primo prefisso che corrisponde
+HA_TIMEOUTS = [
+    ('services/camera/', 60),  # Camera record/snapshot possono richiedere più tempo
+    ('services/media_player/', 20),  # Media player può essere lento
+    ('services/automation/reload', 10),
+    ('services/', 30),
+    ('config/automation/config', 15),
+    ('states', 10),
+    ('services', 10),
+]
+HA_DEFAULT_TIMEOUT = 10
+
+_ha_session = None
+_ha_session_pid = None
+_ha_session_lock = threading.Lock()
+_ha_stats = {}  # {endpoint: {'count', 'errors', 'retries', 'total_ms', 'max_ms'}}
+_ha_stats_lock = threading.Lock()
+
+def ha_timeout(path):
+    for prefix, timeout in HA_TIMEOUTS:
+        if path.startswith(prefix):
+            return timeout
+    return HA_DEFAULT_TIMEOUT
+
+def ha_endpoint_label(path):
+    """Nome dell'endpoint per le statistiche (senza id o nomi di servizio)"""
+    parts = path.strip('/').split('/')
+    if parts[0] == 'services' and len(parts) > 1:
+        return f"services/{parts[1]}"
+    if parts[:3] == ['config', 'automation', 'config']:
+        return 'config/automation/config'
+    if parts[0] == 'states' and len(parts) > 1:
+        return 'states/<entity_id>'
+    return parts[0]
+
+def get_ha_session():
+    """Sessione HTTP del processo (ricreata dopo il fork di gunicorn)"""
+    global _ha_session, _ha_session_pid
+    with _ha_session_lock:
+        if _ha_session is None or _ha_session_pid != os.getpid():
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HA_POOL_SIZE)
+            http_session.mount('http://', adapter)
+            http_session.mount('https://', adapter)
+            http_session.headers.update({
+                "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
+                "Content-Type": "application/json",
+            })
+            _ha_session = http_session
+            _ha_session_pid = os.getpid()
+        return _ha_session
+
+def _record_ha_call(endpoint, elapsed_ms, error=False, retry=False):
+    ha_requests_total.labels(endpoint, 'retry' if retry else 'error' if error else 'ok').inc()
+    ha_request_duration_seconds.labels(endpoint).observe(elapsed_ms / 1000)
+    with _ha_stats_lock:
+        stats = _ha_stats.setdefault(endpoint, {'count': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        if error:
+            stats['errors'] += 1
+        if retry:
+            stats['retries'] += 1
+
+def ha_request(method, path, timeout=None, retry=None, **kwargs):
+    """Chiamata REST a Home Assistant (path relativo a HA_URL, es. 'states').
+    
+    retry=None ritenta solo i GET; per i POST va richiesto esplicitamente
+    (solo per chiamate idempotenti). Gli errori di timeout non vengono ritentati.
+    """
+    if retry is None:
+        retry = method.upper() == 'GET'
+    if timeout is None:
+        timeout = ha_timeout(path)
+    attempts = HA_RETRY_ATTEMPTS if retry else 1
+    endpoint = ha_endpoint_label(path)
+    http_session = get_ha_session()
+    
+    for attempt in range(attempts):
+        last_attempt = attempt + 1 >= attempts
+        started = time.perf_counter()
+        try:
+            response = http_session.request(method, f"{HA_URL}/{path}", timeout=timeout, **kwargs)
+        except requests.exceptions.Timeout:
+            # Prima di ConnectionError: ConnectTimeout è anche un ConnectionError
+            _record_ha_call(endpoint, (time.perf_counter() - started) * 1000, error=True)
+            raise
+        except requests.exceptions.ConnectionError as e:
+            _record_ha_call(endpoint, (time.perf_counter() - started) * 1000, error=True, retry=not last_attempt)
+            if last_attempt:
+                raise
+            print(f"WARN: HA non raggiungibile ({endpoint}), nuovo tentativo: {e}")
+        except requests.exceptions.RequestException:
+            _record_ha_call(endpoint, (time.perf_counter() - started) * 1000, error=True)
+            raise
+        else:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if response.status_code in HA_RETRY_STATUSES and not last_attempt:
+                _record_ha_call(endpoint, elapsed_ms, error=True, retry=True)
+                print(f"WARN: HA ha risposto {response.status_code} ({endpoint}), nuovo tentativo")
+            else:
+                _record_ha_call(endpoint, elapsed_ms, error=response.status_code >= 500)
+                return response
+        
+        # Backoff esponenziale con jitter
+        delay = HA_RETRY_BACKOFF * (2 ** attempt)
+        time.sleep(delay + random.uniform(0, delay / 2))
+
+def ha_client_stats():
+    """Statistiche di latenza delle chiamate HA in questo worker"""
+    with _ha_stats_lock:
+        return {
+            endpoint: {
+                'count': s['count'],
+                'errors': s['errors'],
+                'retries': s['retries'],
+                'avg_ms': round(s['total_ms'] / s['count'], 1) if s['count'] else None,
+                'max_ms': round(s['max_ms'], 1)
+            }
+            for endpoint, s in _ha_stats.items()
+        }
+
+# ==================== CACHE REGISTRI HA ====================
+# Stati e servizi di HA sono condivisi fra tutti i worker gunicorn tramite file
+# in CACHE_DIR: un solo worker alla volta scarica /states o /services (flock),
+# gli altri rileggono il file solo quando cambia (mtime).
+
+REGISTRY_CACHE_TTL = float(os.environ.get('REGISTRY_CACHE_TTL', '30'))
+REGISTRY_CACHE_STALE = float(os.environ.get('REGISTRY_CACHE_STALE', '300'))
+CACHE_DIR = os.environ.get('CACHE_DIR') or (
+    '/data/cache' if os.path.isdir('/data') else os.path.join(tempfile.gettempdir(), 'gemini-ai-cache')
+)
+
+# {nome registro: endpoint API HA}
+REGISTRY_ENDPOINTS = {
+    'states': 'states',
+    'services': 'services',
+}
+
+_registry_memory = {}  # {nome: (mtime_ns, dati decodificati)} - copia locale al worker
+_registry_refreshing = set()  # refresh in background in corso in questo worker
+_registry_lock = threading.Lock()
+
+def _registry_path(name):
+    return os.path.join(CACHE_DIR, f"registry_{name}.json")
+
+def _read_registry(name):
+    """Legge il registro dalla cache condivisa. Ritorna (dati, età in secondi) o (None, None)"""
+    path = _registry_path(name)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None, None
+    
+    with _registry_lock:
+        cached = _registry_memory.get(name)
+    if cached and cached[0] == st.st_mtime_ns:
+        data = cached[1]
+    else:
+        # File aggiornato da un altro worker: rileggi
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            print(f"WARN: cache registro '{name}' illeggibile: {e}")
+            return None, None
+        with _registry_lock:
+            _registry_memory[name] = (st.st_mtime_ns, data)
+    
+    return data, time.time() - st.st_mtime
+
+def _fetch_registry(name):
+    """Scarica il registro da HA e lo scrive (atomicamente) nella cache condivisa"""
+    response = ha_request('GET', REGISTRY_ENDPOINTS[name])
+    response.raise_for_status()
+    data = response.json()
+    
+    path = _registry_path(name)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(response.content)
+    os.replace(tmp_path, path)
+    
+    st = os.stat(path)
+    with _registry_lock:
+        _registry_memory[name] = (st.st_mtime_ns, data)
+    ha_registry_payload_bytes.labels(name).observe(len(response.content))
+    print(f"Registro '{name}' aggiornato da HA ({len(response.content)} bytes)")
+    return data
+
+def _refresh_registry(name, blocking=True):
+    """Aggiorna il registro con un lock fra worker: una sola richiesta a HA per volta.
+    
+    Con blocking=False ritorna None se un altro worker sta già aggiornando.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(_registry_path(name) + '.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return None
+        try:
+            # Un altro worker potrebbe averlo aggiornato mentre aspettavamo il lock
+            data, age = _read_registry(name)
+            if data is not None and age < REGISTRY_CACHE_TTL:
+                return data
+            return _fetch_registry(name)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _refresh_registry_background(name):
+    """Stale-while-revalidate: aggiorna in un thread senza bloccare la richiesta"""
+    with _registry_lock:
+        if name in _registry_refreshing:
+            return
+        _registry_refreshing.add(name)
+    
+    def worker():
+        try:
+            _refresh_registry(name, blocking=False)
+        except Exception as e:
+            print(f"Errore refresh background registro '{name}': {e}")
+        finally:
+            with _registry_lock:
+                _registry_refreshing.discard(name)
+    
+    threading.Thread(target=worker, daemon=True).start()
+
+def get_registry(name):
+    """Ritorna il registro HA (stati o servizi) dalla cache condivisa.
+    
+    - età < TTL: dati in cache
+    - età < TTL + STALE: dati in cache + refresh in background
+    - altrimenti (o cache assente): scarica da HA; se HA non risponde usa i dati vecchi
+    """
+    data, age = _read_registry(name)
+    if data is not None:
+        if age < REGISTRY_CACHE_TTL:
+            registry_cache_lookups_total.labels(name, 'fresh').inc()
+            return data
+        if age < REGISTRY_CACHE_TTL + REGISTRY_CACHE_STALE:
+            registry_cache_lookups_total.labels(name, 'stale').inc()
+            _refresh_registry_background(name)
+            return data
+    
+    registry_cache_lookups_total.labels(name, 'miss').inc()
+    try:
+        return _refresh_registry(name)
+    except Exception as e:
+        if data is not None:
+            print(f"WARN: HA non raggiungibile, uso registro '{name}' in cache ({int(age)}s): {e}")
+            return data
+        raise
+
+def invalidate_registry_cache(*names):
+    """Invalida la cache condivisa (tutti i registri se non specificati)"""
+    for name in names or REGISTRY_ENDPOINTS:
+        try:
+            os.remove(_registry_path(name))
+        except FileNotFoundError:
+            pass
+        with _registry_lock:
+            _registry_memory.pop(name, None)
+    print(f"Cache registri invalidata: {', '.join(names or REGISTRY_ENDPOINTS)}")
+
+# ==================== CACHE PERSISTENTE ====================
+# Cache chiave/valore su SQLite in CACHE_DIR: sopravvive ai riavvii dell'add-on
+# (/data) ed è condivisa fra i worker. TTL, eviction LRU per numero di voci e
+# dimensione totale, contatori hit/miss.
+
+PERSISTENT_CACHES = {}  # {nome: PersistentCache}
+
+class PersistentCache:
+    """Cache JSON su SQLite con TTL ed eviction LRU"""
+    
+    def __init__(self, name, ttl, max_entries, max_bytes):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self._local = threading.local()
+        PERSISTENT_CACHES[name] = self
+    
+    def _connect(self):
+        # Una connessione per thread e per processo (mai condivisa dopo il fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+            'created_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access)')
+        conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        conn.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+    
+    def _count(self, conn, counter, amount=1):
+        conn.execute('UPDATE counters SET value = value + ? WHERE name = ?', (amount, counter))
+    
+    def get(self, key, count=True):
+        """Ritorna il valore in cache o None (miss, scaduto o errore).
+        
+        count=False per i controlli interni: non tocca hit/miss né l'ordine LRU.
+        """
+        try:
+            conn = self._connect()
+            now = time.time()
+            row = conn.execute('SELECT value, created_at FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                if count:
+                    self._count(conn, 'misses')
+                return None
+            if count:
+                conn.execute('UPDATE entries SET last_access = ? WHERE key = ?', (now, key))
+                self._count(conn, 'hits')
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            print(f"WARN: cache '{self.name}' non leggibile: {e}")
+            return None
+    
+    def set(self, key, value):
+        try:
+            conn = self._connect()
+            now = time.time()
+            payload = json.dumps(value, ensure_ascii=False)
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (key, payload, len(payload.encode('utf-8')), now, now)
+            )
+            self._evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"WARN: cache '{self.name}' non scrivibile: {e}")
+    
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM entries WHERE created_at < ?', (now - self.ttl,))
+        count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        evicted = 0
+        # Elimina le voci usate meno di recente finché non si rientra nei limiti
+        while count > self.max_entries or total > self.max_bytes:
+            row = conn.execute('SELECT key, size FROM entries ORDER BY last_access LIMIT 1').fetchone()
+            if row is None:
+                break
+            conn.execute('DELETE FROM entries WHERE key = ?', (row[0],))
+            count -= 1
+            total -= row[1]
+            evicted += 1
+        if evicted:
+            self._count(conn, 'evictions', evicted)
+    
+    def clear(self):
+        try:
+            self._connect().execute('DELETE FROM entries')
+        except sqlite3.Error as e:
+            print(f"WARN: cache '{self.name}' non svuotabile: {e}")
+    
+    def stats(self):
+        try:
+            conn = self._connect()
+            count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        return {
+            'entries': count,
+            'bytes': total,
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'evictions': counters.get('evictions', 0),
+            'hit_ratio': round(counters.get('hits', 0) / lookups, 3) if lookups else None,
+            'ttl': self.ttl,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes
+        }
+
+# ==================== JOB IN BACKGROUND ====================
+# Stato dei job (esecuzioni, generazioni, ...) su SQLite in CACHE_DIR: il job
+# gira in un thread del worker che l'ha creato, ma qualsiasi worker può
+# risponderne lo stato quando la UI fa polling.
+
+JOB_RETENTION = 24 * 3600
+
+class JobStore:
+    """Registro dei job condiviso fra i worker"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+    
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, '
+            'created_at REAL NOT NULL, updated_at REAL NOT NULL, '
+            'progress TEXT NOT NULL, result TEXT, error TEXT, meta TEXT)'
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+    
+    def create(self, kind, meta=None, status='running'):
+        conn = self._connect()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        conn.execute('DELETE FROM jobs WHERE updated_at < ?', (now - JOB_RETENTION,))
+        conn.execute(
+            'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, ?)',
+            (job_id, kind, status, now, now, '[]', json.dumps(meta or {}))
+        )
+        return job_id
+    
+    def set_status(self, job_id, status):
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?',
+            (status, time.time(), job_id)
+        )
+    
+    def add_progress(self, job_id, item):
+        """Aggiunge un risultato parziale (es. esito di una singola azione)"""
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT progress FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return
+            progress = json.loads(row[0])
+            progress.append(item)
+            conn.execute(
+                'UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?',
+                (json.dumps(progress, ensure_ascii=False), time.time(), job_id)
+            )
+    
+    def finish(self, job_id, result=None, error=None):
+        self._connect().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?',
+            (
+                'error' if error else 'done',
+                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                error,
+                time.time(),
+                job_id
+            )
+        )
+    
+    def count_active(self):
+        """[(kind, status, numero)] dei job in coda o in esecuzione"""
+        return self._connect().execute(
+            "SELECT kind, status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY kind, status"
+        ).fetchall()
+    
+    def get(self, job_id):
+        row = self._connect().execute(
+            'SELECT id, kind, status, created_at, updated_at, progress, result, error, meta FROM jobs WHERE id = ?',
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'created_at': row[3],
+            'updated_at': row[4],
+            'progress': json.loads(row[5]),
+            'result': json.loads(row[6]) if row[6] is not None else None,
+            'error': row[7],
+            'meta': json.loads(row[8]) if row[8] else {}
+        }
+
+job_store = JobStore(os.path.join(CACHE_DIR, 'jobs.sqlite3'))
+
+# ==================== MIRROR WEBSOCKET HA ====================
+# Ogni worker tiene una copia in memoria di stati e servizi: li carica una volta
+# via WebSocket API e poi applica gli eventi state_changed / service_registered /
+# service_removed. Finché il mirror non è pronto (avvio, riconnessione) si usa
+# la cache condivisa dei registri.
+
+HA_WEBSOCKET_MIRROR = os.environ.get('HA_WEBSOCKET_MIRROR', '1') != '0'
+MIRROR_PING_INTERVAL = 30
+
+class HAEntityMirror:
+    """Copia in memoria di stati e servizi HA, aggiornata dagli eventi WebSocket"""
+    
+    # ID fissi dei comandi inviati dopo l'autenticazione
+    SUBSCRIBE_STATE_CHANGED = 1
+    SUBSCRIBE_SERVICE_REGISTERED = 2
+    SUBSCRIBE_SERVICE_REMOVED = 3
+    GET_STATES = 4
+    GET_SERVICES = 5
+    
+    def __init__(self, url, token):
+        self.url = url
+        self.token = token
+        self.pid = os.getpid()
+        self.version = 0  # incrementato ad ogni modifica di stati o servizi
+        self.services_version = 0  # incrementato solo quando cambiano i servizi
+        self.entities_version = 0  # incrementato solo quando entità vengono aggiunte o rimosse
+        self.reconnects = 0
+        self._states = {}  # {entity_id: stato}
+        self._services = {}  # {domain: {service: dati}}
+        self._entity_ids = (None, frozenset())  # (entities_version, snapshot degli entity_id)
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._ws = None
+        self._next_id = 100
+        self._pending_ping = None
+        self._loaded = set()
+    
+    @property
+    def ready(self):
+        return self._ready.is_set()
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ha-mirror', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+        if self._thread:
+            self._thread.join(timeout=5)
+    
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+    
+    def entities(self):
+        with self._lock:
+            return list(self._states.values())
+    
+    def entity_ids(self):
+        """Snapshot immutabile degli entity_id (O(1) per appartenenza, iterabile da altri thread).
+        
+        Ricostruito solo quando entità vengono aggiunte o rimosse, non ad ogni cambio di stato.
+        """
+        with self._lock:
+            version, entity_ids = self._entity_ids
+            if version != self.entities_version:
+                entity_ids = frozenset(self._states)
+                self._entity_ids = (self.entities_version, entity_ids)
+            return entity_ids
+    
+    def has_entity(self, entity_id):
+        return entity_id in self._states
+    
+    def get_state(self, entity_id):
+        return self._states.get(entity_id)
+    
+    def services(self):
+        with self._lock:
+            return {domain: dict(services) for domain, services in self._services.items()}
+    
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self._session()
+                backoff = 1
+            except ImportError:
+                print("WARN: websocket-client non installato, mirror WebSocket disabilitato")
+                return
+            except Exception as e:
+                if not self._stop.is_set():
+                    print(f"Mirror WebSocket disconnesso: {e}")
+            finally:
+                self._ready.clear()
+                self._ws = None
+            
+            if self._stop.is_set():
+                return
+            self.reconnects += 1
+            # Backoff esponenziale con jitter (HA potrebbe essere in riavvio)
+            self._stop.wait(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, 60)
+    
+    def _send(self, message):
+        self._ws.send(json.dumps(message))
+    
+    def _session(self):
+        import websocket  # websocket-client
+        
+        ws = websocket.create_connection(self.url, timeout=10)
+        self._ws = ws
+        try:
+            # 1. Autenticazione
+            msg = json.loads(ws.recv())
+            if msg.get('type') != 'auth_required':
+                raise ConnectionError(f"Handshake inatteso: {msg.get('type')}")
+            self._send({'type': 'auth', 'access_token': self.token})
+            msg = json.loads(ws.recv())
+            if msg.get('type') != 'auth_ok':
+                raise ConnectionError(f"Autenticazione WebSocket fallita: {msg.get('message', msg.get('type'))}")
+            
+            # 2. Prima le sottoscrizioni, poi lo snapshot completo: HA risponde
+            # in ordine, quindi nessun evento va perso fra snapshot e stream
+            self._loaded = set()
+            self._pending_ping = None
+            for msg_id, event_type in (
+                (self.SUBSCRIBE_STATE_CHANGED, 'state_changed'),
+                (self.SUBSCRIBE_SERVICE_REGISTERED, 'service_registered'),
+                (self.SUBSCRIBE_SERVICE_REMOVED, 'service_removed'),
+            ):
+                self._send({'id': msg_id, 'type': 'subscribe_events', 'event_type': event_type})
+            self._send({'id': self.GET_STATES, 'type': 'get_states'})
+            self._send({'id': self.GET_SERVICES, 'type': 'get_services'})
+            
+            # 3. Loop eventi con ping periodico per rilevare connessioni morte
+            ws.settimeout(MIRROR_PING_INTERVAL)
+            while not self._stop.is_set():
+                try:
+                    raw = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    if self._pending_ping is not None:
+                        raise ConnectionError("Nessuna risposta al ping")
+                    self._next_id += 1
+                    self._pending_ping = self._next_id
+                    self._send({'id': self._pending_ping, 'type': 'ping'})
+                    continue
+                if not raw:
+                    raise ConnectionError("Connessione chiusa da HA")
+                
+                msg = json.loads(raw)
+                # HA può raggruppare più messaggi in una lista
+                for item in msg if isinstance(msg, list) else [msg]:
+                    self._handle(item)
+        finally:
+            try:
+                ws.close()
+            except Exception:
+                pass
+    
+    def _handle(self, msg):
+        msg_type = msg.get('type')
+        
+        if msg_type == 'event':
+            event = msg.get('event', {})
+            data = event.get('data', {})
+            event_type = event.get('event_type')
+            with self._lock:
+                if event_type == 'state_changed':
+                    entity_id = data.get('entity_id')
+                    new_state = data.get('new_state')
+                    if new_state is None:
+                        if self._states.pop(entity_id, None) is not None:
+                            self.entities_version += 1
+                    else:
+                        if entity_id not in self._states:
+                            self.entities_version += 1
+                        self._states[entity_id] = new_state
+                elif event_type == 'service_registered':
+                    self._services.setdefault(data.get('domain'), {})[data.get('service')] = {}
+                elif event_type == 'service_removed':
+                    domain_services = self._services.get(data.get('domain'), {})
+                    domain_services.pop(data.get('service'), None)
+                    if not domain_services:
+                        self._services.pop(data.get('domain'), None)
+                if event_type != 'state_changed':
+                    self.services_version += 1
+                self.version += 1
+        
+        elif msg_type == 'result':
+            if not msg.get('success', False):
+                error = msg.get('error', {})
+                raise ConnectionError(f"Comando {msg.get('id')} fallito: {error.get('message', error)}")
+            
+            msg_id = msg.get('id')
+            if msg_id == self.GET_STATES:
+                states = {s['entity_id']: s for s in msg.get('result') or [] if isinstance(s, dict) and 'entity_id' in s}
+                with self._lock:
+                    self._states = states
+                    self.entities_version += 1
+                    self.version += 1
+                self._loaded.add(msg_id)
+            elif msg_id == self.GET_SERVICES:
+                with self._lock:
+                    self._services = msg.get('result') or {}
+                    self.services_version += 1
+                    self.version += 1
+                self._loaded.add(msg_id)
+            
+            if not self.ready and self._loaded >= {self.GET_STATES, self.GET_SERVICES}:
+                print(f"Mirror WebSocket pronto: {len(self._states)} entità, {len(self._services)} domini")
+                self._ready.set()
+        
+        elif msg_type == 'pong':
+            if msg.get('id') == self._pending_ping:
+                self._pending_ping = None
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+def get_mirror():
+    """Ritorna il mirror WebSocket se pronto, altrimenti None.
+    
+    Il thread viene avviato al primo uso in ogni worker (dopo il fork di gunicorn).
+    """
+    global _mirror
+    if not HA_WEBSOCKET_MIRROR or not SUPERVISOR_TOKEN:
+        return None
+    with _mirror_lock:
+        if _mirror is None or _mirror.pid != os.getpid():
+            _mirror = HAEntityMirror(HA_WS_URL, SUPERVISOR_TOKEN)
+            _mirror.start()
+    return _mirror if _mirror.ready else None
 
 def get_entities():
     """Carica entità da Home Assistant"""
-    headers = {
-        "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    mirror = get_mirror()
+    if mirror is not None:
+        registry_cache_lookups_total.labels('states', 'mirror').inc()
+        return mirror.entities()
     try:
-        response = requests.get(f"{HA_URL}/states", headers=headers, timeout=10)
-        return response.json()
+        return get_registry('states')
     except Exception as e:
         print(f"Errore caricamento entità: {e}")
         return []
 
 def get_services():
     """Carica lista servizi disponibili da HA e converte in dizionario"""
-    headers = {
-        "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    mirror = get_mirror()
+    if mirror is not None:
+        registry_cache_lookups_total.labels('services', 'mirror').inc()
+        return mirror.services()
     try:
-        response = requests.get(f"{HA_URL}/services", headers=headers, timeout=10)
-        services_data = response.json()
+        services_data = get_registry('services')
         
         # L'API ritorna lista o dizionario a seconda della versione HA
         # Convertiamo sempre in dizionario {domain: {service: data}}
@@ -70,17 +1068,709 @@ def get_services():
         print(f"Errore caricamento servizi: {e}")
         return {}
 
-def generate_automation(description, entities):
-    """Genera automazione con Gemini"""
+# ==================== GOVERNATORE GEMINI ====================
+# Ogni chiamata a Gemini passa da gemini_governor:
+# - token bucket condiviso fra i worker (file + flock in CACHE_DIR) tarato
+#   sulla quota della API key (GEMINI_RPM, GEMINI_BURST);
+# - una parte dei token è riservata alle richieste interattive (generazione):
+#   le analisi in background la lasciano libera;
+# - prompt identici in volo vengono eseguiti una volta sola (single-flight),
+#   sia nello stesso processo sia fra worker diversi;
+# - se l'attesa di un token supera il massimo per la priorità si risponde
+#   subito "occupato" (429) invece di accumulare richieste.
+
+def _governor_option(name, default, minimum, strict):
+    """Opzione numerica del governatore; se non valida avvisa e usa il default (non blocca l'avvio)"""
+    raw = os.environ.get(name, str(default))
     try:
-        model = genai.GenerativeModel('gemini-3-flash-preview')
-        entities_str = json.dumps(entities[:50], indent=2) if entities else "Nessuna entità selezionata"
+        value = float(raw)
+    except ValueError:
+        value = None
+    if value is None or not (value > minimum if strict else value >= minimum):  # anche NaN
+        print(f"WARN: {name}={raw!r} non valido (deve essere {'>' if strict else '>='} {minimum:g}), uso {default:g}")
+        return float(default)
+    return value
+
+# Con rpm 0 il bucket non si ricarica mai (e il calcolo dell'attesa divide per zero)
+GEMINI_RPM = _governor_option('GEMINI_RPM', 15, 0, strict=True)
+GEMINI_BURST = _governor_option('GEMINI_BURST', 5, 1, strict=False)
+GEMINI_INTERACTIVE_RESERVE = float(os.environ.get('GEMINI_INTERACTIVE_RESERVE', '2'))
+GEMINI_MAX_WAIT = {'interactive': 20.0, 'background': 5.0}
+GEMINI_INFLIGHT_TTL = 60  # risultati condivisi fra worker validi per 60s
+GEMINI_FOLLOWER_POLL = 0.05  # attesa fra due tentativi sul lock di una chiamata in volo in un altro worker
+
+class LLMBusyError(Exception):
+    """Servizio AI saturo (quota o coda piena): riprovare più tardi"""
+    
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class GeminiGovernor:
+    """Rate limit condiviso, priorità e coalescing delle chiamate a Gemini"""
+    
+    def __init__(self, rpm, burst, reserve):
+        self.rate = rpm / 60.0
+        self.burst = burst
+        self.reserve = reserve
+        self.bucket_path = os.path.join(CACHE_DIR, 'gemini_bucket')
+        self.inflight_dir = os.path.join(CACHE_DIR, 'gemini_inflight')
+        self._lock = threading.Lock()
+        self._inflight = {}  # {chiave: {'event', 'result', 'error'}}
+        self.stats_counters = {'calls': 0, 'coalesced': 0, 'shared': 0, 'rejected': 0, 'waited': 0.0}
+    
+    def _take_token(self, priority):
+        """Prende un token dal bucket condiviso: 0 se preso, altrimenti i secondi da attendere"""
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd = os.open(self.bucket_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                tokens, updated = json.loads(f.read() or 'null') or (self.burst, now)
+            except ValueError:
+                tokens, updated = self.burst, now
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+            floor = 0 if priority == 'interactive' else self.reserve
+            if tokens - 1 >= floor:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (floor + 1 - tokens) / self.rate
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps([tokens, now]))
+            return wait
+    
+    def acquire(self, priority='interactive'):
+        """Attende un token; LLMBusyError se l'attesa supera il massimo per la priorità"""
+        start = time.time()
+        deadline = start + GEMINI_MAX_WAIT.get(priority, GEMINI_MAX_WAIT['background'])
+        while True:
+            wait = self._take_token(priority)
+            if not wait:
+                with self._lock:
+                    self.stats_counters['waited'] += time.time() - start
+                return
+            if time.time() + wait > deadline:
+                with self._lock:
+                    self.stats_counters['rejected'] += 1
+                gemini_throttled_total.labels(priority).inc()
+                raise LLMBusyError(
+                    f"quota Gemini esaurita ({GEMINI_RPM:g} richieste/min)",
+                    retry_after=max(1, math.ceil(wait))
+                )
+            time.sleep(min(wait, 1.0))
+    
+    def try_acquire(self, priority='interactive'):
+        """Prende un token solo se disponibile subito (richieste opzionali, es. candidati extra)"""
+        return not self._take_token(priority)
+    
+    def _shared_result_path(self, key):
+        return os.path.join(self.inflight_dir, key)
+    
+    def _read_shared_result(self, key, since):
+        """Risultato scritto da un altro worker per la stessa chiamata, dopo 'since'"""
+        path = self._shared_result_path(key) + '.json'
+        try:
+            if os.path.getmtime(path) < since:
+                return None
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _write_shared_result(self, key, result):
+        path = self._shared_result_path(key) + '.json'
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.inflight_dir)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except (OSError, TypeError) as e:
+            print(f"WARN: risultato Gemini non condivisibile: {e}")
+        # Pulizia dei risultati vecchi
+        now = time.time()
+        for name in os.listdir(self.inflight_dir):
+            if name.endswith('.json'):
+                try:
+                    if now - os.path.getmtime(os.path.join(self.inflight_dir, name)) > GEMINI_INFLIGHT_TTL:
+                        os.remove(os.path.join(self.inflight_dir, name))
+                except OSError:
+                    pass
+    
+    def _call_cross_worker(self, key, model_name, fn, priority):
+        """Un solo worker esegue la chiamata; gli altri attendono il suo risultato"""
+        os.makedirs(self.inflight_dir, exist_ok=True)
+        start = time.time()
+        with open(self._shared_result_path(key) + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Un altro worker sta già chiamando Gemini con lo stesso prompt:
+                # si attende al massimo quanto si attenderebbe un token
+                self._wait_leader(lock_file, start, priority)
+                shared = self._read_shared_result(key, start)
+                if shared is not None:
+                    with self._lock:
+                        self.stats_counters['shared'] += 1
+                    gemini_coalesced_total.labels(model_name, 'worker').inc()
+                    return shared
+            self.acquire(priority)
+            with self._lock:
+                self.stats_counters['calls'] += 1
+            result = fn()
+            self._write_shared_result(key, result)
+            return result
+    
+    def _wait_leader(self, lock_file, start, priority):
+        """Prende il lock della chiamata in volo; LLMBusyError oltre l'attesa massima per la priorità"""
+        max_wait = GEMINI_MAX_WAIT.get(priority, GEMINI_MAX_WAIT['background'])
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+            if time.time() - start >= max_wait:
+                with self._lock:
+                    self.stats_counters['rejected'] += 1
+                gemini_throttled_total.labels(priority).inc()
+                raise LLMBusyError(
+                    "richiesta identica ancora in corso su Gemini",
+                    retry_after=max(1, math.ceil(max_wait / 4))
+                )
+            time.sleep(GEMINI_FOLLOWER_POLL)
+    
+    def call(self, model_name, prompt, fn, priority='interactive'):
+        """Esegue fn (chiamata a Gemini, risultato serializzabile in JSON) sotto il governatore.
+        
+        Chiamate in volo con stesso modello e prompt condividono lo stesso
+        risultato o la stessa eccezione.
+        """
+        key = hashlib.sha256(json.dumps([model_name, prompt]).encode('utf-8')).hexdigest()
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'event': threading.Event(), 'result': None, 'error': None}
+                self._inflight[key] = flight
+            else:
+                self.stats_counters['coalesced'] += 1
+        
+        if not leader:
+            gemini_coalesced_total.labels(model_name, 'process').inc()
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
         
-        prompt = f"""You are a Home Assistant expert. Generate a YAML automation based on this description:
+        try:
+            flight['result'] = self._call_cross_worker(key, model_name, fn, priority)
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight['event'].set()
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counters, inflight=len(self._inflight))
+        stats.update({'rpm': GEMINI_RPM, 'burst': self.burst, 'interactive_reserve': self.reserve})
+        return stats
 
-DESCRIPTION: {description}
+gemini_governor = GeminiGovernor(GEMINI_RPM, GEMINI_BURST, GEMINI_INTERACTIVE_RESERVE)
+
+# ==================== CONTEXT CACHING GEMINI ====================
+# La parte fissa di un prompt (regole ed esempi, vedi TASK_SYSTEM_INSTRUCTIONS)
+# viene caricata una volta per modello come CachedContent: le chiamate inviano
+# solo la parte variabile (descrizione ed entità). Il nome del contenuto è
+# condiviso fra i worker (file + flock in CACHE_DIR), la scadenza viene
+# prolungata quando si avvicina e un prefisso cambiato crea un nuovo contenuto
+# (il vecchio viene cancellato). Se il prefisso è sotto il minimo della API o
+# la creazione fallisce (modello non supportato, quota) si usa la normale
+# system_instruction e si riprova dopo GEMINI_CONTEXT_CACHE_RETRY secondi.
+
+GEMINI_CONTEXT_CACHE = os.environ.get('GEMINI_CONTEXT_CACHE', '1') != '0'
+GEMINI_CONTEXT_CACHE_TTL = int(os.environ.get('GEMINI_CONTEXT_CACHE_TTL', '3600'))
+GEMINI_CONTEXT_CACHE_REFRESH = 300  # prolunga se scade entro 5 minuti
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('GEMINI_CONTEXT_CACHE_MIN_TOKENS', '1024'))
+GEMINI_CONTEXT_CACHE_RETRY = 3600
+
+class ContextCacheManager:
+    """Nomi dei CachedContent per modello e prefisso, condivisi fra i worker"""
+    
+    def __init__(self):
+        self.path = os.path.join(CACHE_DIR, 'gemini_context.json')
+        self._lock = threading.Lock()
+        self._local = {}  # {modello: (nome, scadenza, hash prefisso)}
+        self.stats_counters = {'created': 0, 'extended': 0, 'failed': 0, 'invalidated': 0}
+    
+    def _locked_state(self, update):
+        """Legge lo stato condiviso sotto flock, lo passa a update(state) e lo riscrive"""
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            result = update(state)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            return result
+    
+    def get(self, model_name, prefix):
+        """Nome del CachedContent per (modello, prefisso), creato o prolungato se serve; None se non disponibile"""
+        if not GEMINI_CONTEXT_CACHE or estimate_tokens(prefix) < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        prefix_hash = hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:16]
+        now = time.time()
+        with self._lock:
+            local = self._local.get(model_name)
+        if local and local[2] == prefix_hash and local[1] - GEMINI_CONTEXT_CACHE_REFRESH > now:
+            return local[0]
+        
+        def update(state):
+            entry = state.get(model_name) or {}
+            if entry.get('failed_until', 0) > now:
+                return None
+            if entry.get('name') and entry.get('prefix') == prefix_hash:
+                if entry['expires'] - GEMINI_CONTEXT_CACHE_REFRESH > now:
+                    return entry
+                if entry['expires'] > now and self._extend(entry['name']):
+                    entry['expires'] = now + GEMINI_CONTEXT_CACHE_TTL
+                    return entry
+            elif entry.get('name'):
+                self._delete(entry['name'])  # prefisso cambiato (nuova versione)
+            state[model_name] = entry = self._create(model_name, prefix, prefix_hash, now)
+            return entry if entry.get('name') else None
+        
+        entry = self._locked_state(update)
+        if entry is None:
+            return None
+        with self._lock:
+            self._local[model_name] = (entry['name'], entry['expires'], prefix_hash)
+        return entry['name']
+    
+    def _create(self, model_name, prefix, prefix_hash, now):
+        started = time.perf_counter()
+        try:
+            cached = get_genai().caching.CachedContent.create(
+                model=model_name if model_name.startswith('models/') else f"models/{model_name}",
+                display_name=f"ha-automation-{prefix_hash}",
+                system_instruction=prefix,
+                ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL)
+            )
+        except Exception as e:
+            print(f"WARN: context cache non disponibile per {model_name}, uso la system_instruction: {e}")
+            with self._lock:
+                self.stats_counters['failed'] += 1
+            return {'failed_until': now + GEMINI_CONTEXT_CACHE_RETRY}
+        print(f"Context cache {cached.name} creata per {model_name} in {(time.perf_counter() - started) * 1000:.0f}ms")
+        with self._lock:
+            self.stats_counters['created'] += 1
+        return {'name': cached.name, 'prefix': prefix_hash, 'expires': now + GEMINI_CONTEXT_CACHE_TTL}
+    
+    def _extend(self, name):
+        try:
+            cached = get_genai().caching.CachedContent.get(name)
+            cached.update(ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL))
+        except Exception as e:
+            print(f"WARN: impossibile prolungare la context cache {name}: {e}")
+            return False
+        with self._lock:
+            self.stats_counters['extended'] += 1
+        return True
+    
+    def _delete(self, name):
+        try:
+            get_genai().caching.CachedContent.get(name).delete()
+        except Exception as e:
+            print(f"WARN: impossibile cancellare la context cache {name}: {e}")
+    
+    def invalidate(self, model_name, name):
+        """Dimentica un contenuto che la API non riconosce più (scaduto o cancellato)"""
+        def update(state):
+            if (state.get(model_name) or {}).get('name') == name:
+                state.pop(model_name)
+        self._locked_state(update)
+        with self._lock:
+            if self._local.get(model_name, (None,))[0] == name:
+                self._local.pop(model_name)
+            self.stats_counters['invalidated'] += 1
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counters)
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        stats['models'] = {
+            model_name: {'name': entry['name'], 'expires_in': round(entry['expires'] - time.time())}
+            for model_name, entry in state.items() if entry.get('name')
+        }
+        stats['enabled'] = GEMINI_CONTEXT_CACHE
+        return stats
+
+context_cache = ContextCacheManager()
+
+# ==================== CHIAMATE GEMINI CON HEDGING ====================
+# call_model() esegue il compito sul modello principale; se non risponde entro
+# il percentile GEMINI_HEDGE_PERCENTILE delle sue latenze recenti parte una
+# seconda richiesta (hedged) sul fallback_model e vince la prima risposta.
+# Se il principale fallisce si passa subito al fallback. Gli errori transitori
+# (429, 5xx, rete) sono ritentati con backoff esponenziale a jitter pieno.
+# Ogni tentativo extra consuma un token del governatore.
+
+GEMINI_HEDGE = os.environ.get('GEMINI_HEDGE', '1') != '0'
+GEMINI_HEDGE_PERCENTILE = float(os.environ.get('GEMINI_HEDGE_PERCENTILE', '90'))
+GEMINI_HEDGE_MIN_DELAY = 2.0  # mai prima di 2s
+GEMINI_HEDGE_DEFAULT_DELAY = 10.0  # finché non ci sono abbastanza campioni
+GEMINI_HEDGE_MIN_SAMPLES = 20
+GEMINI_CALL_DEADLINE = float(os.environ.get('GEMINI_CALL_DEADLINE', '120'))
+GEMINI_RETRY_ATTEMPTS = 3
+GEMINI_RETRY_BASE_DELAY = 1.0
+GEMINI_RETRY_MAX_DELAY = 8.0
+
+class LatencyTracker:
+    """Latenze recenti (successi) per modello, per calcolare il budget di hedging"""
+    
+    def __init__(self, window=200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}
+    
+    def record(self, model_name, seconds):
+        with self._lock:
+            samples = self._samples.setdefault(model_name, [])
+            samples.append(seconds)
+            if len(samples) > self.window:
+                del samples[0]
+    
+    def percentile(self, model_name, pct):
+        with self._lock:
+            samples = sorted(self._samples.get(model_name, []))
+        if len(samples) < GEMINI_HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+    
+    def hedge_delay(self, model_name):
+        budget = self.percentile(model_name, GEMINI_HEDGE_PERCENTILE)
+        return GEMINI_HEDGE_DEFAULT_DELAY if budget is None else max(GEMINI_HEDGE_MIN_DELAY, budget)
+
+gemini_latency = LatencyTracker()
+
+_hedge_executor = None
+_hedge_executor_pid = None
+_hedge_executor_lock = threading.Lock()
+
+def _get_hedge_executor():
+    global _hedge_executor, _hedge_executor_pid
+    with _hedge_executor_lock:
+        if _hedge_executor is None or _hedge_executor_pid != os.getpid():
+            _hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='gemini')
+            _hedge_executor_pid = os.getpid()
+        return _hedge_executor
+
+def is_transient_gemini_error(error):
+    """429, 5xx e errori di rete: vale la pena ritentare"""
+    from google.api_core import exceptions as api_exceptions  # disponibile con l'SDK
+    return isinstance(error, (
+        api_exceptions.TooManyRequests,
+        api_exceptions.ServerError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        ConnectionError,
+        TimeoutError
+    ))
+
+def _attempt_model(task, model_name, prompt, priority, generation_config=None):
+    """Chiamata a un modello con retry a jitter sugli errori transitori. Ritorna (testo, tentativi, token).
+    
+    generation_config sovrascrive per questa chiamata quella del compito (es. temperatura).
+    """
+    from google.api_core import exceptions as api_exceptions  # disponibile con l'SDK
+    client = model_registry.get(task, model_name)
+    retry_now = False
+    for attempt in range(GEMINI_RETRY_ATTEMPTS):
+        if attempt:
+            if not retry_now:
+                # Full jitter: attesa casuale fra 0 e il backoff esponenziale
+                time.sleep(random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt)))
+            gemini_governor.acquire(priority)
+        retry_now = False
+        started = time.perf_counter()
+        try:
+            response = client.generate_content(prompt, generation_config=generation_config)
+            text = response.text
+        except Exception as e:
+            observe_gemini(model_name, started, 'error')
+            cached_name = getattr(client, 'cached_content', None)
+            if cached_name and isinstance(e, (api_exceptions.NotFound, api_exceptions.PermissionDenied)):
+                # Context cache scaduta o cancellata: si riprova subito senza
+                print(f"WARN: context cache {cached_name} non più valida: {e}")
+                context_cache.invalidate(model_name, cached_name)
+                client = model_registry.get(task, model_name)
+                retry_now = True
+                if attempt < GEMINI_RETRY_ATTEMPTS - 1:
+                    continue
+            if attempt == GEMINI_RETRY_ATTEMPTS - 1 or not is_transient_gemini_error(e):
+                raise
+            print(f"WARN: errore transitorio Gemini ({model_name}), nuovo tentativo: {e}")
+            continue
+        observe_gemini(model_name, started, 'ok')
+        gemini_latency.record(model_name, time.perf_counter() - started)
+        return text, attempt + 1, observe_gemini_usage(model_name, getattr(response, 'usage_metadata', None))
+
+def call_model(task, prompt, priority='interactive'):
+    """Esegue il compito con hedging e fallback. Ritorna {'text', 'meta'}.
+    
+    meta.path: 'primary' (risposta del modello principale), 'hedge' (ha vinto
+    la richiesta hedged) o 'fallback' (principale fallito).
+    Il primo token del governatore è già stato preso dal chiamante.
+    """
+    settings = model_registry.tasks[task]
+    primary, fallback = settings['model'], settings['fallback_model'] or settings['model']
+    executor = _get_hedge_executor()
+    started = time.perf_counter()
+    deadline = started + GEMINI_CALL_DEADLINE
+    hedge_at = started + gemini_latency.hedge_delay(primary) if GEMINI_HEDGE else deadline
+    
+    futures = {executor.submit(_attempt_model, task, primary, prompt, priority): ('primary', primary)}
+    pending = set(futures)
+    second_launched = False
+    errors = []
+    
+    while True:
+        now = time.perf_counter()
+        timeout = deadline - now if second_launched else min(deadline, hedge_at) - now
+        done, pending = wait(pending, timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                text, attempts, usage = future.result()
+                path, model_name = futures[future]
+                gemini_call_path_total.labels(task, path).inc()
+                return {'text': text, 'meta': {
+                    'task': task,
+                    'model': model_name,
+                    'path': path,
+                    'attempts': attempts,
+                    'hedged': second_launched,
+                    'latency_ms': round((time.perf_counter() - started) * 1000),
+                    **usage
+                }}
+            errors.append(future.exception())
+        
+        now = time.perf_counter()
+        if not second_launched and (not pending or now >= hedge_at):
+            second_launched = True
+            if pending:
+                path = 'hedge'
+            elif fallback != primary or is_transient_gemini_error(errors[-1]):
+                path = 'fallback'
+                print(f"WARN: {primary} fallito, uso {fallback}: {errors[-1]}")
+            else:
+                raise errors[-1]
+            try:
+                gemini_governor.acquire(priority)
+            except LLMBusyError:
+                # Niente quota per un secondo tentativo: si aspetta il primo
+                if not pending:
+                    raise errors[-1]
+                continue
+            future = executor.submit(_attempt_model, task, fallback, prompt, priority)
+            futures[future] = (path, fallback)
+            pending.add(future)
+            continue
+        
+        if not pending:
+            raise errors[-1]
+        if now >= deadline:
+            gemini_call_path_total.labels(task, 'timeout').inc()
+            raise TimeoutError(f"Gemini non ha risposto entro {GEMINI_CALL_DEADLINE:g}s")
+
+# ==================== CONTESTO ENTITÀ PER IL PROMPT ====================
+# Le entità selezionate vengono ordinate per rilevanza rispetto alla descrizione
+# (token + trigrammi su entity_id, friendly_name e dominio) e serializzate in
+# forma compatta finché non si esaurisce il budget di token.
+
+PROMPT_ENTITY_TOKEN_BUDGET = int(os.environ.get('PROMPT_ENTITY_TOKEN_BUDGET', '2000'))
+
+# Attributi utili a Gemini per scrivere trigger/azioni corretti
+PROMPT_KEY_ATTRIBUTES = (
+    'device_class', 'unit_of_measurement', 'hvac_modes', 'preset_modes',
+    'options', 'min', 'max', 'supported_color_modes', 'source_list'
+)
+PROMPT_LIST_LIMIT = 8
+RANK_FUZZY_THRESHOLD = 0.6
+
+_entity_terms = {}  # {(entity_id, friendly_name): (token, trigrammi)}
+_ENTITY_TERMS_MAX = 20000
+_TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
 
-AVAILABLE ENTITIES: {entities_str}
+def estimate_tokens(text):
+    """Stima grossolana dei token (~4 caratteri per token)"""
+    return len(text) // 4 + 1
+
+def _tokenize(text):
+    return {t for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1}
+
+def _trigrams(tokens):
+    grams = set()
+    for token in tokens:
+        padded = f" {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def _entity_index_terms(entity_id, friendly_name):
+    key = (entity_id, friendly_name)
+    terms = _entity_terms.get(key)
+    if terms is None:
+        tokens = _tokenize(entity_id) | _tokenize(friendly_name or '')
+        terms = (tokens, _trigrams(tokens))
+        if len(_entity_terms) >= _ENTITY_TERMS_MAX:
+            _entity_terms.clear()
+        _entity_terms[key] = terms
+    return terms
+
+def get_state_lookup():
+    """Funzione entity_id -> stato (o None) sullo snapshot corrente"""
+    mirror = get_mirror()
+    if mirror is not None:
+        return mirror.get_state
+    try:
+        states = get_registry('states')
+    except Exception as e:
+        print(f"Errore caricamento entità: {e}")
+        return lambda entity_id: None
+    by_id = _cached_index(
+        'states_by_id',
+        ('cache', id(states)),
+        lambda: {e['entity_id']: e for e in states if isinstance(e, dict) and 'entity_id' in e},
+        refs=states
+    )
+    return by_id.get
+
+def project_entity(entity_id, state):
+    """Proiezione compatta di un'entità per il prompt"""
+    item = {'id': entity_id, 'domain': entity_id.split('.', 1)[0]}
+    if not state:
+        return item
+    attributes = state.get('attributes') or {}
+    if attributes.get('friendly_name'):
+        item['name'] = attributes['friendly_name']
+    if state.get('state') is not None:
+        item['state'] = state['state']
+    attrs = {}
+    for key in PROMPT_KEY_ATTRIBUTES:
+        value = attributes.get(key)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = value[:PROMPT_LIST_LIMIT]
+        attrs[key] = value
+    if attrs:
+        item['attrs'] = attrs
+    return item
+
+def rank_entities(description, entity_ids, lookup_state):
+    """Ordina gli entity_id per rilevanza rispetto alla descrizione (ordinamento stabile)"""
+    desc_tokens = _tokenize(description)
+    desc_token_trigrams = {token: _trigrams([token]) for token in desc_tokens}
+    
+    terms = []
+    document_frequency = {}
+    for entity_id in entity_ids:
+        state = lookup_state(entity_id) or {}
+        name = (state.get('attributes') or {}).get('friendly_name', '')
+        entity_terms = _entity_index_terms(entity_id, name)
+        terms.append(entity_terms)
+        for token in desc_tokens & entity_terms[0]:
+            document_frequency[token] = document_frequency.get(token, 0) + 1
+    
+    # Un token condiviso da molte entità selezionate (es. "light") pesa poco
+    total = len(entity_ids)
+    idf = {token: math.log(1 + total / df) for token, df in document_frequency.items()}
+    
+    scored = []
+    for position, (entity_id, (tokens, trigrams)) in enumerate(zip(entity_ids, terms)):
+        exact = desc_tokens & tokens
+        score = sum(idf[token] for token in exact)
+        # Corrispondenze parziali via trigrammi (temperature ~ temperatura, luci ~ luce)
+        for token, token_trigrams in desc_token_trigrams.items():
+            if token not in exact:
+                similarity = len(token_trigrams & trigrams) / len(token_trigrams)
+                if similarity >= RANK_FUZZY_THRESHOLD:
+                    score += similarity
+        scored.append((-score, position, entity_id))
+    scored.sort()
+    return [entity_id for _, _, entity_id in scored]
+
+def build_entity_context(description, entities, token_budget=None):
+    """Contesto entità per il prompt: una riga JSON compatta per entità, per rilevanza.
+    
+    Le entità che non entrano nel budget vengono elencate solo per entity_id,
+    le ultime eventualmente solo contate.
+    """
+    if token_budget is None:
+        token_budget = PROMPT_ENTITY_TOKEN_BUDGET
+    
+    entity_ids = []
+    seen = set()
+    for entity in entities or []:
+        entity_id = entity.get('entity_id') if isinstance(entity, dict) else entity
+        if isinstance(entity_id, str) and entity_id and entity_id not in seen:
+            seen.add(entity_id)
+            entity_ids.append(entity_id)
+    if not entity_ids:
+        return "Nessuna entità selezionata"
+    
+    lookup_state = get_state_lookup()
+    ranked = rank_entities(description, entity_ids, lookup_state)
+    
+    lines = []
+    used = 0
+    rest = []
+    for entity_id in ranked:
+        if rest:
+            rest.append(entity_id)
+            continue
+        line = json.dumps(project_entity(entity_id, lookup_state(entity_id)), ensure_ascii=False, separators=(',', ':'))
+        cost = estimate_tokens(line)
+        if lines and used + cost > token_budget:
+            rest.append(entity_id)
+            continue
+        lines.append(line)
+        used += cost
+    
+    if rest:
+        # Oltre il budget: solo gli id, nello spazio rimasto (almeno un quarto del budget)
+        ids_budget = max(token_budget - used, token_budget // 4)
+        listed = []
+        for entity_id in rest:
+            cost = estimate_tokens(entity_id) + 1
+            if ids_budget - cost < 0:
+                break
+            listed.append(entity_id)
+            ids_budget -= cost
+        if listed:
+            lines.append("Other selected entities: " + ', '.join(listed))
+        if len(listed) < len(rest):
+            lines.append(f"(+{len(rest) - len(listed)} more selected entities omitted)")
+    
+    return '\n'.join(lines)
+
+# Parte fissa del prompt di generazione: uguale per ogni richiesta, va nella
+# system_instruction (o nella context cache) invece di essere reinviata.
+GENERATION_SYSTEM_INSTRUCTION = """You are a Home Assistant expert. You generate YAML automations from a description and a list of the user's available entities.
 
 IMPORTANT RULES:
 1. Return ONLY pure YAML code (no markdown or backticks)
@@ -132,166 +1822,713 @@ action:
     data:
       temperature: 20
 
-WARNING: For Telegram ALWAYS use "telegram_bot.send_message", NEVER "notify.telegram"!
+WARNING: For Telegram ALWAYS use "telegram_bot.send_message", NEVER "notify.telegram"!"""
+
+TASK_SYSTEM_INSTRUCTIONS = {'generate': GENERATION_SYSTEM_INSTRUCTION}
+
+def build_generation_prompt(description, entities):
+    """Parte variabile del prompt di generazione (le regole sono nella system_instruction)"""
+    entities_str = build_entity_context(description, entities)
+    
+    return f"""Generate a YAML automation based on this description:
+
+DESCRIPTION: {description}
+
+AVAILABLE ENTITIES (one JSON per line, most relevant first):
+{entities_str}
 
 Generate the automation now (ONLY YAML, no markdown):"""
-        
-        response = model.generate_content(prompt)
-        yaml_text = response.text.strip()
-        
-        # Rimuovi eventuali blocchi markdown
-        yaml_text = yaml_text.replace('```yaml', '').replace('```', '').strip()
-        
-        # Fix automatico se ha usato notify.telegram invece di telegram_bot.send_message
-        if 'notify.telegram' in yaml_text:
-            print("WARN: Gemini ha usato notify.telegram, correggo in telegram_bot.send_message")
-            yaml_text = yaml_text.replace('notify.telegram', 'telegram_bot.send_message')
-        
-        return yaml_text
+
+def clean_generated_yaml(yaml_text):
+    """Ripulisce il YAML restituito da Gemini"""
+    yaml_text = yaml_text.strip()
+    
+    # Rimuovi eventuali blocchi markdown
+    yaml_text = yaml_text.replace('```yaml', '').replace('```', '').strip()
+    
+    # Fix automatico se ha usato notify.telegram invece di telegram_bot.send_message
+    if 'notify.telegram' in yaml_text:
+        print("WARN: Gemini ha usato notify.telegram, correggo in telegram_bot.send_message")
+        yaml_text = yaml_text.replace('notify.telegram', 'telegram_bot.send_message')
+    
+    return yaml_text
+
+class StreamingYamlCleaner:
+    """Stessa pulizia di clean_generated_yaml, applicata incrementalmente ai chunk.
+    
+    Un pattern (```yaml, notify.telegram) può arrivare spezzato fra due chunk:
+    il testo che potrebbe esserne l'inizio resta in coda finché non si può decidere.
+    Anche gli spazi finali restano in coda, come con strip().
+    """
+    
+    # Il più lungo prima: ```yaml va riconosciuto prima di ```
+    REPLACEMENTS = (
+        ('```yaml', ''),
+        ('```', ''),
+        ('notify.telegram', 'telegram_bot.send_message'),
+    )
+    
+    def __init__(self):
+        self.text = ''  # testo già emesso
+        self._buffer = ''
+        self._whitespace = ''
+        self._started = False
+        self._telegram_fixed = False
+    
+    def _process(self, final):
+        buffer = self._buffer
+        out = []
+        i = 0
+        while i < len(buffer):
+            rest = buffer[i:]
+            if not final and any(len(rest) < len(old) and old.startswith(rest) for old, _ in self.REPLACEMENTS):
+                break
+            for old, new in self.REPLACEMENTS:
+                if buffer.startswith(old, i):
+                    if old == 'notify.telegram' and not self._telegram_fixed:
+                        print("WARN: Gemini ha usato notify.telegram, correggo in telegram_bot.send_message")
+                        self._telegram_fixed = True
+                    out.append(new)
+                    i += len(old)
+                    break
+            else:
+                out.append(buffer[i])
+                i += 1
+        self._buffer = buffer[i:]
+        return ''.join(out)
+    
+    def _emit(self, text, final):
+        text = self._whitespace + text
+        self._whitespace = ''
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ''
+            self._started = True
+        stripped = text.rstrip()
+        if not final:
+            self._whitespace = text[len(stripped):]
+        self.text += stripped
+        return stripped
+    
+    def feed(self, chunk):
+        self._buffer += chunk
+        return self._emit(self._process(final=False), final=False)
+    
+    def flush(self):
+        return self._emit(self._process(final=True), final=True)
+
+generation_cache = PersistentCache(
+    'generation',
+    ttl=float(os.environ.get('GENERATION_CACHE_TTL', str(7 * 24 * 3600))),
+    max_entries=int(os.environ.get('GENERATION_CACHE_MAX_ENTRIES', '500')),
+    max_bytes=int(os.environ.get('GENERATION_CACHE_MAX_BYTES', str(10 * 1024 * 1024)))
+)
+
+def generation_cache_key(description, entities, model_signature):
+    """Chiave cache: descrizione normalizzata + hash delle entità selezionate + modello e config"""
+    normalized = ' '.join(description.lower().split()).rstrip('.!?')
+    entity_ids = sorted({e.get('entity_id', '') if isinstance(e, dict) else str(e) for e in entities or []})
+    entities_hash = hashlib.sha256('\n'.join(entity_ids).encode('utf-8')).hexdigest()
+    return hashlib.sha256(json.dumps([model_signature, normalized, entities_hash]).encode('utf-8')).hexdigest()
+
+def get_cached_generation(description, entities):
+    """YAML già generato per la stessa richiesta normalizzata (o None)"""
+    cached = generation_cache.get(generation_cache_key(description, entities, model_registry.signature('generate')))
+    if cached is not None:
+        print("Automazione dalla cache di generazione")
+    return cached
+
+def _generate_automation(description, entities, use_cache=True, meta=None, candidates=None):
+    """Come generate_automation, ma gli errori di Gemini sono sollevati"""
+    cache_key = generation_cache_key(description, entities, model_registry.signature('generate'))
+    if use_cache:
+        cached = get_cached_generation(description, entities)
+        if cached is not None:
+            if meta is not None:
+                meta['path'] = 'cache'
+            return cached
+    
+    prompt = build_generation_prompt(description, entities)
+    
+    candidates = min(max(candidates or GENERATE_CANDIDATES, 1), GENERATE_CANDIDATES_LIMIT)
+    if candidates > 1:
+        # Chiave di coalescing distinta dalla chiamata singola
+        result = gemini_governor.call(
+            f"{model_registry.model_name('generate')}x{candidates}", prompt,
+            lambda: generate_candidates(prompt, candidates),
+            priority='interactive'
+        )
+    else:
+        result = gemini_governor.call(
+            model_registry.model_name('generate'), prompt,
+            lambda: call_model('generate', prompt, priority='interactive'),
+            priority='interactive'
+        )
+    if meta is not None:
+        meta.update(result['meta'])
+    yaml_text = clean_generated_yaml(result['text'])
+    if yaml_text:
+        generation_cache.set(cache_key, yaml_text)
+    return yaml_text
+
+def generate_automation(description, entities, use_cache=True, meta=None, candidates=None):
+    """Genera automazione con Gemini.
+    
+    Se meta è un dict viene riempito con il percorso della chiamata
+    (modello usato, primary/hedge/fallback/candidates, tentativi, latenza).
+    candidates > 1 genera più varianti in parallelo e tiene la migliore.
+    """
+    try:
+        return _generate_automation(description, entities, use_cache=use_cache, meta=meta, candidates=candidates)
+    except LLMBusyError:
+        raise
     except Exception as e:
         print(f"Errore generazione: {e}")
         import traceback
         traceback.print_exc()
         return f"Errore generazione: {str(e)}"
 
-def test_automation(yaml_text):
-    """Testa validità automazione"""
+def generate_automation_stream(description, entities, use_cache=True):
+    """Genera automazione con lo streaming di Gemini: produce chunk di YAML già ripuliti"""
+    cache_key = generation_cache_key(description, entities, model_registry.signature('generate'))
+    if use_cache:
+        cached = get_cached_generation(description, entities)
+        if cached is not None:
+            yield cached
+            return
+    
+    model = model_registry.get('generate')
+    prompt = build_generation_prompt(description, entities)
+    cleaner = StreamingYamlCleaner()
+    
+    # Lo streaming non si può condividere fra richieste: solo rate limit
+    gemini_governor.acquire('interactive')
+    started = time.perf_counter()
+    usage_metadata = None
+    try:
+        for chunk in model.generate_content(prompt, stream=True):
+            usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk senza testo (es. solo metadati di sicurezza)
+                continue
+            out = cleaner.feed(text)
+            if out:
+                yield out
+    except Exception:
+        observe_gemini(model_registry.model_name('generate'), started, 'error')
+        raise
+    observe_gemini(model_registry.model_name('generate'), started, 'ok')
+    observe_gemini_usage(model_registry.model_name('generate'), usage_metadata)
+    
+    out = cleaner.flush()
+    if out:
+        yield out
+    if cleaner.text:
+        generation_cache.set(cache_key, cleaner.text)
+
+# ==================== PARSING YAML CONDIVISO ====================
+# Lo stesso testo YAML passa da test, grafo, analisi, esecuzione e
+# installazione spesso a pochi secondi di distanza: parse_yaml() lo parsa una
+# volta (CSafeLoader di libyaml se disponibile) e tiene il risultato in una LRU
+# per hash del contenuto. I valori in cache sono dict/list in sola lettura:
+# chi deve modificarli lavora su una copia (thaw).
+
+YamlSafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YAML_PARSE_CACHE_SIZE = int(os.environ.get('YAML_PARSE_CACHE_SIZE', '256'))
+YAML_PARSE_CACHE_MAX_TEXT = 2 * 1024 * 1024  # testi più grandi non vanno in cache
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("YAML parsato in cache, in sola lettura: usa thaw() per una copia modificabile")
+
+class FrozenDict(dict):
+    """dict in sola lettura (resta un dict per isinstance e json.dumps)"""
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    
+    def __copy__(self):
+        return dict(self)
+    
+    def __deepcopy__(self, memo):
+        return thaw(self)
+    
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+class FrozenList(list):
+    """list in sola lettura"""
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = remove = pop = clear = sort = reverse = _read_only
+    
+    def __copy__(self):
+        return list(self)
+    
+    def __deepcopy__(self, memo):
+        return thaw(self)
+    
+    def __reduce__(self):
+        return (list, (list(self),))
+
+def _freeze(value, memo):
+    # memo per id: ancore/alias YAML condividono lo stesso oggetto
+    if isinstance(value, (dict, list)) and id(value) in memo:
+        return memo[id(value)]
+    if isinstance(value, dict):
+        frozen = memo[id(value)] = FrozenDict()
+        dict.update(frozen, ((k, _freeze(v, memo)) for k, v in value.items()))
+        return frozen
+    if isinstance(value, list):
+        frozen = memo[id(value)] = FrozenList()
+        list.extend(frozen, (_freeze(v, memo) for v in value))
+        return frozen
+    return value
+
+def thaw(value):
+    """Copia modificabile (dict/list normali) di un valore restituito da parse_yaml"""
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [thaw(v) for v in value]
+    return value
+
+def _copy_error(error):
+    """Copia di un YAMLError senza traceback né contesto (stessi problem/mark e messaggio).
+    
+    Non passa da __init__: le sottoclassi hanno firme diverse (es. ReaderError).
+    """
+    fresh = error.__class__.__new__(error.__class__)
+    fresh.__dict__.update(error.__dict__)
+    fresh.args = error.args
+    return fresh
+
+class YamlParseCache:
+    """LRU testo YAML -> valore parsato (o errore di parsing), condivisa dai thread del worker.
+    
+    Per gli errori si tiene una copia senza traceback e ad ogni chiamata se ne
+    solleva una nuova: rilanciare sempre lo stesso oggetto allungherebbe il suo
+    traceback (e i frame tenuti vivi) e lo condividerebbe fra thread.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {sha256: (valore, errore)}
+        self.stats_counters = {'hits': 0, 'misses': 0, 'errors': 0, 'parse_ms': 0.0}
+    
+    def parse(self, text):
+        if len(text) > YAML_PARSE_CACHE_MAX_TEXT:
+            return yaml.load(text, Loader=YamlSafeLoader)
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats_counters['hits'] += 1
+        if entry is not None:
+            yaml_parse_total.labels('hit').inc()
+        else:
+            started = time.perf_counter()
+            try:
+                entry = (_freeze(yaml.load(text, Loader=YamlSafeLoader), {}), None)
+            except yaml.YAMLError as e:
+                entry = (None, _copy_error(e))
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                self.stats_counters['misses'] += 1
+                self.stats_counters['parse_ms'] += elapsed
+                if entry[1] is not None:
+                    self.stats_counters['errors'] += 1
+            yaml_parse_total.labels('error' if entry[1] is not None else 'miss').inc()
+        if entry[1] is not None:
+            raise _copy_error(entry[1])
+        return entry[0]
+    
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counters, entries=len(self._entries), size=self.size)
+        stats['parse_ms'] = round(stats['parse_ms'], 1)
+        stats['libyaml'] = YamlSafeLoader is not yaml.SafeLoader
+        return stats
+
+yaml_parse_cache = YamlParseCache(YAML_PARSE_CACHE_SIZE)
+
+def parse_yaml(text):
+    """yaml.safe_load condiviso: risultato in sola lettura, parsato una volta per contenuto.
+    
+    Solleva yaml.YAMLError come safe_load. Per modificare il risultato usare thaw().
+    """
+    return yaml_parse_cache.parse(text)
+
+# ==================== MOTORE DI VALIDAZIONE ====================
+# Gli indici di entità e servizi vengono costruiti una volta per snapshot dei
+# registri; l'automazione viene visitata ricorsivamente in un solo passaggio
+# (choose, if/then/else, repeat, parallel, sequence, wait_for_trigger, ...).
+
+class RegistryIndex:
+    """Indici hash di entità e servizi per uno snapshot dei registri HA"""
+    
+    def __init__(self, entity_ids, services, entity_error=None, service_error=None, version=None):
+        # entity_ids: contenitore con lookup O(1), None se non caricato
+        self.entity_ids = entity_ids
+        # services: {domain: frozenset(servizi)}
+        self.services = services
+        self.entity_error = entity_error
+        self.service_error = service_error
+        # Cambia quando cambiano gli insiemi di entità o servizi (non i loro stati)
+        self.version = version
+    
+    @staticmethod
+    def index_entities(states):
+        return frozenset(e['entity_id'] for e in states if isinstance(e, dict) and 'entity_id' in e)
+    
+    @staticmethod
+    def index_services(services):
+        return {domain: frozenset(domain_services or ()) for domain, domain_services in (services or {}).items()}
+
+_index_cache = {}  # {sorgente: (chiave snapshot, valore indicizzato, riferimenti)}
+_index_lock = threading.Lock()
+
+def _cached_index(source, key, builder, refs=None):
+    """Ricostruisce l'indice solo quando lo snapshot (chiave) cambia.
+    
+    refs tiene vivi gli oggetti usati nella chiave (id() non viene riutilizzato).
+    """
+    with _index_lock:
+        cached = _index_cache.get(source)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    value = builder()
+    with _index_lock:
+        _index_cache[source] = (key, value, refs)
+    return value
+
+def get_registry_index():
+    """Indice dei registri HA correnti (mirror WebSocket o cache condivisa)"""
+    mirror = get_mirror()
+    if mirror is not None:
+        services = _cached_index(
+            'services',
+            ('mirror', id(mirror), mirror.services_version),
+            lambda: RegistryIndex.index_services(mirror.services()),
+            refs=mirror
+        )
+        # Versione letta prima dello snapshot: al più lo snapshot è più nuovo della versione
+        version = ('mirror', id(mirror), mirror.entities_version, mirror.services_version)
+        return RegistryIndex(mirror.entity_ids(), services, version=version)
+    
+    entity_ids = None
+    entity_error = None
+    try:
+        states = get_registry('states')
+        entity_ids = _cached_index('entities', ('cache', id(states)), lambda: RegistryIndex.index_entities(states), refs=states)
+        print(f"Caricate {len(entity_ids)} entità da Home Assistant")
+    except Exception as e:
+        print(f"ERRORE caricamento entità: {e}")
+        entity_error = str(e)
+    
+    services = {}
+    service_error = None
+    try:
+        services_data = get_registry('services')
+        services = _cached_index('services', ('cache', id(services_data)), lambda: RegistryIndex.index_services(get_services()), refs=services_data)
+    except Exception as e:
+        print(f"Errore caricamento servizi: {e}")
+        service_error = str(e)
+    
+    # id() basta: gli indici restano vivi in _index_cache finché sono quelli correnti
+    return RegistryIndex(entity_ids, services, entity_error, service_error,
+                         version=('cache', id(entity_ids), id(services)))
+
+def _is_template(value):
+    return isinstance(value, str) and ('{{' in value or '{%' in value)
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def _entity_refs(value):
+    """Normalizza un campo entity_id (stringa, lista, lista separata da virgole)"""
+    refs = []
+    for item in _as_list(value):
+        if not isinstance(item, str) or _is_template(item):
+            continue
+        for eid in item.split(','):
+            eid = eid.strip()
+            if eid and eid not in ('all', 'none'):
+                refs.append(eid)
+    return refs
+
+class AutomationValidator:
+    """Visita ricorsiva di un'automazione contro un RegistryIndex.
+    
+    Produce diagnostiche strutturate: {'kind', 'severity', 'message', 'path', 'ref'}
+    dove path è la tupla di chiavi/indici che porta al blocco nel YAML.
+    """
+    
+    def __init__(self, index):
+        self.index = index
+        self.diagnostics = []
+    
+    def _add(self, kind, severity, message, path, ref=None):
+        self.diagnostics.append({
+            'kind': kind,
+            'severity': severity,
+            'message': message,
+            'path': path,
+            'ref': ref
+        })
+    
+    def _check_entities(self, value, label, path):
+        entity_ids = self.index.entity_ids
+        if entity_ids is None:
+            return
+        for eid in _entity_refs(value):
+            if eid not in entity_ids:
+                self._add('entity', 'error', f"{label}: entità '{eid}' non esiste", path, eid)
+    
+    def _check_service(self, service, path):
+        if not isinstance(service, str) or _is_template(service) or not self.index.services:
+            return
+        if '.' not in service:
+            self._add('service', 'error', f"Servizio '{service}' non valido (manca il dominio)", path, service)
+            return
+        domain, service_name = service.split('.', 1)
+        domain_services = self.index.services.get(domain)
+        if domain_services is None:
+            self._add('service', 'warning', f"Dominio '{domain}' non trovato fra i servizi di Home Assistant", path, service)
+        elif service_name not in domain_services:
+            self._add('service', 'error', f"Servizio '{service}' non disponibile in Home Assistant", path, service)
+    
+    def validate(self, automation):
+        if not isinstance(automation, dict):
+            self._add('structure', 'error', "L'automazione deve essere un dizionario YAML", ())
+            return self.diagnostics
+        
+        trigger_key = 'triggers' if 'triggers' in automation else 'trigger'
+        condition_key = 'conditions' if 'conditions' in automation else 'condition'
+        action_key = 'actions' if 'actions' in automation else 'action'
+        
+        self.visit_triggers(automation.get(trigger_key), (trigger_key,))
+        self.visit_conditions(automation.get(condition_key), (condition_key,))
+        self.visit_sequence(automation.get(action_key), (action_key,))
+        
+        if not automation.get(trigger_key):
+            self._add('structure', 'error', "Manca il campo 'trigger'", ())
+        if not automation.get(action_key):
+            self._add('structure', 'error', "Manca il campo 'action'", ())
+        return self.diagnostics
+    
+    def visit_triggers(self, triggers, path):
+        for i, trigger in enumerate(_as_list(triggers)):
+            self.visit_trigger(trigger, path + (i,) if isinstance(triggers, list) else path)
+    
+    def visit_trigger(self, trigger, path):
+        if not isinstance(trigger, dict) or trigger.get('enabled') is False:
+            return
+        self._check_entities(trigger.get('entity_id'), 'Trigger', path)
+        if trigger.get('platform', trigger.get('trigger')) in ('zone', 'geo_location'):
+            self._check_entities(trigger.get('zone'), 'Trigger', path)
+    
+    def visit_conditions(self, conditions, path):
+        for i, condition in enumerate(_as_list(conditions)):
+            condition_path = path + (i,) if isinstance(conditions, list) else path
+            self.visit_condition(condition, condition_path)
+    
+    def visit_condition(self, condition, path):
+        # Condizioni stringa = template abbreviato
+        if not isinstance(condition, dict) or condition.get('enabled') is False:
+            return
+        self._check_entities(condition.get('entity_id'), 'Condition', path)
+        if condition.get('condition') == 'zone':
+            self._check_entities(condition.get('zone'), 'Condition', path)
+        # and/or/not: forma estesa (conditions:) e abbreviata (and: [...])
+        if 'conditions' in condition:
+            self.visit_conditions(condition['conditions'], path + ('conditions',))
+        for key in ('and', 'or', 'not'):
+            if key in condition:
+                self.visit_conditions(condition[key], path + (key,))
+    
+    def visit_sequence(self, actions, path):
+        for i, action in enumerate(_as_list(actions)):
+            action_path = path + (i,) if isinstance(actions, list) else path
+            self.visit_action(action, action_path)
+    
+    def visit_action(self, action, path):
+        if not isinstance(action, dict) or action.get('enabled') is False:
+            return
+        
+        # Step condizione dentro la sequenza
+        if 'condition' in action:
+            self.visit_condition(action, path)
+            return
+        
+        # Chiamata servizio: 'service:' (classico) o 'action:' (HA 2024.8+)
+        service = action.get('service')
+        if service is None and isinstance(action.get('action'), str):
+            service = action['action']
+        if service is not None:
+            self._check_service(service, path)
+        
+        self._check_entities(action.get('entity_id'), 'Action', path)
+        target = action.get('target')
+        if isinstance(target, dict):
+            self._check_entities(target.get('entity_id'), 'Action target', path + ('target',))
+        data = action.get('data')
+        if isinstance(data, dict) and 'entity_id' in data:
+            self._check_entities(data.get('entity_id'), 'Action data', path + ('data',))
+        if isinstance(action.get('scene'), str):
+            self._check_entities(action['scene'], 'Scene', path)
+        
+        # Blocchi annidati
+        if 'choose' in action:
+            for i, option in enumerate(_as_list(action['choose'])):
+                if not isinstance(option, dict):
+                    continue
+                option_path = path + ('choose', i)
+                self.visit_conditions(option.get('conditions'), option_path + ('conditions',))
+                self.visit_sequence(option.get('sequence'), option_path + ('sequence',))
+            if 'default' in action:
+                self.visit_sequence(action['default'], path + ('default',))
+        
+        if 'if' in action:
+            self.visit_conditions(action['if'], path + ('if',))
+            self.visit_sequence(action.get('then'), path + ('then',))
+            if 'else' in action:
+                self.visit_sequence(action['else'], path + ('else',))
+        
+        repeat = action.get('repeat')
+        if isinstance(repeat, dict):
+            for key in ('while', 'until'):
+                if key in repeat:
+                    self.visit_conditions(repeat[key], path + ('repeat', key))
+            self.visit_sequence(repeat.get('sequence'), path + ('repeat', 'sequence'))
+        
+        if 'parallel' in action:
+            # Ogni ramo può essere uno step o un blocco {sequence: [...]}
+            self.visit_sequence(action['parallel'], path + ('parallel',))
+        
+        if 'sequence' in action:
+            self.visit_sequence(action['sequence'], path + ('sequence',))
+        
+        if 'wait_for_trigger' in action:
+            self.visit_triggers(action['wait_for_trigger'], path + ('wait_for_trigger',))
+
+def validate_automation(automation, index):
+    """Valida un'automazione già parsata contro un RegistryIndex (nessun I/O)"""
+    diagnostics = AutomationValidator(index).validate(automation)
+    
     errors = []
     warnings = []
     entity_errors = {}  # {entity_id: error_message}
     service_errors = {}  # {service: error_message}
     
+    if index.entity_error:
+        errors.append(f"Impossibile verificare entità: {index.entity_error}. Il test potrebbe non essere accurato.")
+    if index.service_error:
+        warnings.append(f"Impossibile verificare servizi: {index.service_error}")
+    
+    for diag in diagnostics:
+        target = errors if diag['severity'] == 'error' else warnings
+        if diag['message'] not in target:
+            target.append(diag['message'])
+        if diag['kind'] == 'entity':
+            entity_errors[diag['ref']] = "Entità non trovata in Home Assistant"
+        elif diag['kind'] == 'service' and diag['severity'] == 'error':
+            service_errors[diag['ref']] = "Servizio non disponibile"
+    
+    return {
+        'valid': len(errors) == 0,
+        'errors': errors,
+        'warnings': warnings,
+        'entity_errors': entity_errors,
+        'service_errors': service_errors
+    }
+
+def validate_automations_batch(automations, index=None):
+    """Valida una lista di automazioni contro un unico snapshot dei registri.
+    
+    Generatore: produce un risultato per automazione, poi un riepilogo finale.
+    Gli elementi possono essere dizionari già parsati o testi YAML.
+    """
+    started = time.time()
+    if index is None:
+        index = get_registry_index()
+    
+    total = 0
+    valid_count = 0
+    for i, item in enumerate(automations):
+        total += 1
+        if isinstance(item, str):
+            try:
+                item = parse_yaml(item)
+            except yaml.YAMLError as e:
+                yield {
+                    'index': i,
+                    'valid': False,
+                    'errors': [f"YAML non valido: {str(e)}"],
+                    'warnings': [],
+                    'entity_errors': {},
+                    'service_errors': {}
+                }
+                continue
+        
+        try:
+            result = validate_automation(item, index)
+        except Exception as e:
+            print(f"Errore validazione batch #{i}: {e}")
+            result = {
+                'valid': False,
+                'errors': [f"Errore durante il test: {str(e)}"],
+                'warnings': [],
+                'entity_errors': {},
+                'service_errors': {}
+            }
+        if result['valid']:
+            valid_count += 1
+        
+        info = item if isinstance(item, dict) else {}
+        yield {'index': i, 'id': info.get('id'), 'alias': info.get('alias'), **result}
+    
+    yield {
+        'summary': {
+            'total': total,
+            'valid': valid_count,
+            'invalid': total - valid_count,
+            'duration_ms': int((time.time() - started) * 1000)
+        }
+    }
+
+def test_automation(yaml_text, index=None, existing=True):
+    """Testa validità automazione (contro index, o lo snapshot corrente dei registri).
+    
+    existing=True confronta anche con le automazioni già presenti (duplicati, conflitti).
+    """
     try:
         # 1. Valida YAML sintattico
         try:
-            automation = yaml.safe_load(yaml_text)
+            automation = parse_yaml(yaml_text)
         except yaml.YAMLError as e:
-            errors.append(f"YAML non valido: {str(e)}")
             return {
                 'valid': False,
-                'errors': errors,
-                'warnings': warnings,
+                'errors': [f"YAML non valido: {str(e)}"],
+                'warnings': [],
                 'entity_errors': {},
                 'service_errors': {}
             }
         
-        # 2. Carica entità disponibili
-        entity_ids = None  # None = non caricato, [] = caricato ma vuoto
-        try:
-            available_entities = get_entities()
-            entity_ids = [e['entity_id'] for e in available_entities if isinstance(e, dict) and 'entity_id' in e]
-            print(f"Caricate {len(entity_ids)} entità da Home Assistant")
-        except Exception as e:
-            print(f"ERRORE caricamento entità: {e}")
-            import traceback
-            traceback.print_exc()
-            # NON impostare entity_ids = [] perché vogliamo sapere se il caricamento è fallito
-            entity_ids = None
-            errors.append(f"Impossibile verificare entità: {str(e)}. Il test potrebbe non essere accurato.")
-        
-        # 3. Carica servizi disponibili
-        try:
-            available_services = get_services()
-        except Exception as e:
-            print(f"Errore caricamento servizi: {e}")
-            warnings.append(f"Impossibile verificare servizi: {str(e)}")
-            available_services = {}
-        
-        # 4. Controlla triggers
-        triggers = automation.get('trigger', [])
-        if not isinstance(triggers, list):
-            triggers = [triggers]
+        # 2. Indici di entità e servizi (una volta per snapshot) + visita completa
+        result = validate_automation(automation, index if index is not None else get_registry_index())
         
-        for trigger in triggers:
-            if not isinstance(trigger, dict):
-                continue
-            entity_id = trigger.get('entity_id')
-            if entity_id:
-                # Se entity_ids è None, non possiamo verificare (errore già aggiunto sopra)
-                # Se entity_ids è lista (anche vuota), verifichiamo
-                if entity_ids is not None and entity_id not in entity_ids:
-                    entity_errors[entity_id] = f"Entità non trovata in Home Assistant"
-                    errors.append(f"Trigger: entità '{entity_id}' non esiste")
-        
-        # 5. Controlla conditions
-        conditions = automation.get('condition', [])
-        if conditions:
-            if not isinstance(conditions, list):
-                conditions = [conditions]
-            
-            for condition in conditions:
-                if not isinstance(condition, dict):
-                    continue
-                entity_id = condition.get('entity_id')
-                if entity_id:
-                    if entity_ids is not None and entity_id not in entity_ids:
-                        entity_errors[entity_id] = f"Entità non trovata in Home Assistant"
-                        errors.append(f"Condition: entità '{entity_id}' non esiste")
-        
-        # 6. Controlla actions
-        actions = automation.get('action', [])
-        if not isinstance(actions, list):
-            actions = [actions]
-        
-        for action in actions:
-            if not isinstance(action, dict):
-                continue
-            
-            # Controlla entity_id nelle actions
-            entity_id = action.get('entity_id')
-            if isinstance(entity_id, str):
-                if entity_ids is not None and entity_id not in entity_ids:
-                    entity_errors[entity_id] = f"Entità non trovata in Home Assistant"
-                    errors.append(f"Action: entità '{entity_id}' non esiste")
-            elif isinstance(entity_id, list):
-                for eid in entity_id:
-                    if entity_ids is not None and eid not in entity_ids:
-                        entity_errors[eid] = f"Entità non trovata"
-                        errors.append(f"Action: entità '{eid}' non esiste")
-            
-            # Controlla target
-            target = action.get('target', {})
-            if isinstance(target, dict):
-                target_entities = target.get('entity_id')
-                if isinstance(target_entities, str):
-                    if entity_ids is not None and target_entities not in entity_ids:
-                        entity_errors[target_entities] = f"Entità non trovata"
-                        errors.append(f"Action target: '{target_entities}' non esiste")
-                elif isinstance(target_entities, list):
-                    for eid in target_entities:
-                        if entity_ids is not None and eid not in entity_ids:
-                            entity_errors[eid] = f"Entità non trovata"
-                            errors.append(f"Action target: '{eid}' non esiste")
-            
-            # Controlla servizi (solo se disponibili)
-            service = action.get('service')
-            if service and available_services:
-                # Estrai dominio e servizio (es: light.turn_on)
-                if '.' in service:
-                    domain, service_name = service.split('.', 1)
-                    # Controlla se il servizio esiste
-                    domain_services = available_services.get(domain, {})
-                    if domain_services and service_name not in domain_services:
-                        service_errors[service] = f"Servizio non disponibile"
-                        errors.append(f"Servizio '{service}' non disponibile in Home Assistant")  # ✅ ERROR critico!
-        
-        # 7. Controlla campi obbligatori
-        if not automation.get('trigger'):
-            errors.append("Manca il campo 'trigger'")
-        
-        if not automation.get('action'):
-            errors.append("Manca il campo 'action'")
-        
-        # 8. Determina validità
-        valid = len(errors) == 0
-        
-        return {
-            'valid': valid,
-            'errors': errors,
-            'warnings': warnings,
-            'entity_errors': entity_errors,
-            'service_errors': service_errors
-        }
+        # 3. Automazioni esistenti che usano gli stessi riferimenti (indice invertito)
+        if existing and isinstance(automation, dict):
+            check_existing_automations(automation, result)
+        return result
         
     except Exception as e:
         print(f"Errore test_automation: {e}")
@@ -305,245 +2542,911 @@ def test_automation(yaml_text):
             'service_errors': {}
         }
 
-def parse_automation_to_graph(yaml_text):
-    """Converte YAML automazione in struttura grafo per visualizzazione"""
+# ==================== VALIDAZIONE INCREMENTALE (EDITOR) ====================
+# L'editor YAML valida mentre si scrive. Per ogni sessione si ricordano le
+# diagnostiche di ogni blocco di primo livello (un trigger, una condizione,
+# un'azione con tutto ciò che contiene) per hash del suo testo: a ogni modifica
+# si rivalidano solo i blocchi nuovi o cambiati. Riga e colonna vengono dai
+# nodi YAML della versione corrente, quindi restano giuste se i blocchi si
+# spostano. Il memo è per worker e si svuota quando cambiano entità o servizi;
+# una richiesta che arriva all'altro worker rivalida semplicemente tutto.
+
+VALIDATION_SESSIONS_MAX = 64
+VALIDATION_SESSION_TTL = 1800
+VALIDATION_SECTIONS = (
+    (('trigger', 'triggers'), 'visit_trigger'),
+    (('condition', 'conditions'), 'visit_condition'),
+    (('action', 'actions'), 'visit_action'),
+)
+
+_validation_sessions = OrderedDict()  # {sessione: {'version', 'blocks', 'updated'}}
+_validation_sessions_lock = threading.Lock()
+
+def compose_yaml(text):
+    """(nodo radice, dati) con un solo parsing: i nodi portano le posizioni nel testo"""
+    loader = YamlSafeLoader(text)
+    try:
+        node = loader.get_single_node()
+        data = loader.construct_document(node) if node is not None else None
+    finally:
+        loader.dispose()
+    return node, data
+
+def yaml_node_at(node, path):
+    """Nodo YAML più profondo raggiungibile seguendo path (chiavi e indici).
+    
+    Con chiavi duplicate prende l'ultima, come il costruttore di PyYAML.
+    """
+    for key in path:
+        if isinstance(node, yaml.MappingNode):
+            child = next((v for k, v in reversed(node.value) if isinstance(k, yaml.ScalarNode) and k.value == key), None)
+        elif isinstance(node, yaml.SequenceNode) and isinstance(key, int) and key < len(node.value):
+            child = node.value[key]
+        else:
+            child = None
+        if child is None:
+            break
+        node = child
+    return node
+
+def _find_scalar(node, value, depth=4):
+    """Primo scalare che contiene value sotto node (punta all'entità/servizio esatto)"""
+    if isinstance(node, yaml.ScalarNode):
+        return node if value in node.value else None
+    if depth == 0:
+        return None
+    if isinstance(node, yaml.MappingNode):
+        children = [v for _, v in node.value]
+    elif isinstance(node, yaml.SequenceNode):
+        children = node.value
+    else:
+        return None
+    for child in children:
+        found = _find_scalar(child, value, depth - 1)
+        if found is not None:
+            return found
+    return None
+
+def _locate(root, diag):
+    """Diagnostica con riga/colonna (base 1) del nodo a cui si riferisce"""
+    node = yaml_node_at(root, diag['path'])
+    if node is None:
+        # Documento vuoto (solo commenti)
+        return {**diag, 'path': list(diag['path']), 'line': 1, 'column': 1}
+    if isinstance(diag.get('ref'), str):
+        node = _find_scalar(node, diag['ref']) or node
+    mark = node.start_mark
+    return {**diag, 'path': list(diag['path']), 'line': mark.line + 1, 'column': mark.column + 1}
+
+def _validation_session(session_id, version):
+    """Memo dei blocchi della sessione (nuovo se i registri sono cambiati)"""
+    now = time.time()
+    with _validation_sessions_lock:
+        for sid in [sid for sid, sess in _validation_sessions.items() if now - sess['updated'] > VALIDATION_SESSION_TTL]:
+            del _validation_sessions[sid]
+        editor_session = _validation_sessions.get(session_id)
+        if editor_session is None or editor_session['version'] != version:
+            editor_session = {'version': version, 'blocks': {}}
+            _validation_sessions[session_id] = editor_session
+        _validation_sessions.move_to_end(session_id)
+        while len(_validation_sessions) > VALIDATION_SESSIONS_MAX:
+            _validation_sessions.popitem(last=False)
+        editor_session['updated'] = now
+        return editor_session
+
+def validate_incremental(session_id, text, index=None):
+    """Valida text rivalidando solo i blocchi cambiati dall'ultima chiamata della sessione"""
+    started = time.perf_counter()
+    try:
+        root, automation = compose_yaml(text)
+    except yaml.YAMLError as e:
+        mark = getattr(e, 'problem_mark', None) or getattr(e, 'context_mark', None)
+        problem = getattr(e, 'problem', None) or str(e)
+        return {
+            'valid': False,
+            'diagnostics': [{
+                'kind': 'syntax',
+                'severity': 'error',
+                'message': f"YAML non valido: {problem}",
+                'path': [],
+                'ref': None,
+                'line': mark.line + 1 if mark else None,
+                'column': mark.column + 1 if mark else None
+            }],
+            'blocks': {'total': 0, 'revalidated': 0},
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+    
+    if index is None:
+        index = get_registry_index()
+    editor_session = _validation_session(session_id, index.version)
+    memo = editor_session['blocks']
+    blocks = {}
+    diagnostics = []
+    revalidated = 0
+    
+    if index.entity_error:
+        diagnostics.append({'kind': 'registry', 'severity': 'error', 'path': (), 'ref': None,
+                            'message': f"Impossibile verificare entità: {index.entity_error}"})
+    if index.service_error:
+        diagnostics.append({'kind': 'registry', 'severity': 'warning', 'path': (), 'ref': None,
+                            'message': f"Impossibile verificare servizi: {index.service_error}"})
+    is_mapping = isinstance(automation, dict)
+    if not is_mapping:
+        diagnostics.append({'kind': 'structure', 'severity': 'error', 'path': (), 'ref': None,
+                            'message': "L'automazione deve essere un dizionario YAML"})
+        automation = {}
+    
+    for keys, visit in VALIDATION_SECTIONS:
+        key = keys[1] if keys[1] in automation else keys[0]
+        section = automation.get(key)
+        items = list(enumerate(section)) if isinstance(section, list) else [(None, section)] if section is not None else []
+        section_node = yaml_node_at(root, (key,))
+        for i, block in items:
+            block_path = (key, i) if i is not None else (key,)
+            if i is None:
+                block_node = section_node
+            elif isinstance(section_node, yaml.SequenceNode) and i < len(section_node.value):
+                block_node = section_node.value[i]
+            else:
+                # Nodo e dati non allineati (merge key, tag): niente memo per questo blocco
+                block_node = None
+            block_key = None
+            if block_node is not None:
+                source = text[block_node.start_mark.index:block_node.end_mark.index]
+                block_key = hashlib.sha1(f"{visit}\0{source}".encode('utf-8')).hexdigest()
+            found = memo.get(block_key) if block_key else None
+            if found is None:
+                validator = AutomationValidator(index)
+                getattr(validator, visit)(block, ())
+                found = validator.diagnostics
+                revalidated += 1
+            if block_key:
+                blocks[block_key] = found
+            diagnostics.extend({**diag, 'path': block_path + diag['path']} for diag in found)
+        if is_mapping and keys[0] != 'condition' and not section:
+            diagnostics.append({'kind': 'structure', 'severity': 'error', 'path': (), 'ref': None,
+                                'message': f"Manca il campo '{keys[0]}'"})
+    
+    # Il memo tiene solo i blocchi della versione corrente
+    editor_session['blocks'] = blocks
+    diagnostics = [_locate(root, diag) for diag in diagnostics]
+    return {
+        'valid': not any(d['severity'] == 'error' for d in diagnostics),
+        'diagnostics': diagnostics,
+        'blocks': {'total': len(blocks), 'revalidated': revalidated},
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)
+    }
+
+# ==================== GENERAZIONE A CANDIDATI MULTIPLI ====================
+# Con GENERATE_CANDIDATES > 1 (o "candidates" nella richiesta) la generazione
+# lancia in parallelo N varianti dello stesso prompt (modello principale e
+# fallback, temperature crescenti). Ogni risposta è valutata in locale
+# (test_automation + struttura) contro un unico snapshot dei registri; il
+# primo candidato valido e completo vince subito e gli altri vengono
+# abbandonati. Altrimenti, a fine corsa, vince quello col punteggio migliore.
+# Il primo candidato usa il token già preso dal chiamante; gli extra partono
+# solo se il governatore ha token liberi in quel momento.
+
+GENERATE_CANDIDATES = int(os.environ.get('GENERATE_CANDIDATES', '1'))
+GENERATE_CANDIDATES_LIMIT = 4
+CANDIDATE_TEMPERATURE_STEP = 0.4
+AUTOMATION_REQUIRED_KEYS = (('alias',), ('trigger', 'triggers'), ('action', 'actions'), ('mode',))
+
+def candidate_variants(count):
+    """[(modello, temperatura)] per N candidati: alterna i modelli, poi alza la temperatura"""
+    settings = model_registry.tasks['generate']
+    models = [settings['model']]
+    if settings['fallback_model'] and settings['fallback_model'] != settings['model']:
+        models.append(settings['fallback_model'])
+    variants = []
+    step = 0
+    while len(variants) < count:
+        temperature = round(min(1.0, settings['temperature'] + step * CANDIDATE_TEMPERATURE_STEP), 2)
+        for model_name in models:
+            if len(variants) < count:
+                variants.append((model_name, temperature))
+        step += 1
+    return variants
+
+def score_candidate(yaml_text, index):
+    """Valutazione locale di un candidato: (punteggio confrontabile, validazione, problemi di struttura)"""
+    validation = test_automation(yaml_text, index, existing=False)
+    issues = []
     try:
-        automation = yaml.safe_load(yaml_text)
+        automation = parse_yaml(yaml_text)
+    except yaml.YAMLError:
+        automation = None
+    if isinstance(automation, dict):
+        for keys in AUTOMATION_REQUIRED_KEYS:
+            if not any(automation.get(key) for key in keys):
+                issues.append(f"Manca '{keys[0]}'")
+    else:
+        issues.append("Non è un'automazione (mappa YAML)")
+    score = (validation['valid'], -len(validation['errors']), -len(issues), -len(validation['warnings']))
+    return score, validation, issues
+
+def generate_candidates(prompt, count, index=None):
+    """Genera count candidati in parallelo e ritorna {'text', 'meta'} del migliore"""
+    if index is None:
+        index = get_registry_index()
+    settings = model_registry.tasks['generate']
+    executor = _get_hedge_executor()
+    started = time.perf_counter()
+    deadline = started + GEMINI_CALL_DEADLINE
+    
+    futures = {}
+    report = []
+    for i, (model_name, temperature) in enumerate(candidate_variants(count)):
+        # Il primo token è del chiamante; gli altri (anche per i retry) con priorità
+        # background, solo se liberi subito e oltre la riserva per gli altri utenti
+        priority = 'background' if i else 'interactive'
+        if i and not gemini_governor.try_acquire(priority):
+            print(f"Candidati limitati a {i}: quota Gemini non disponibile")
+            break
+        config = None if temperature == settings['temperature'] else {'temperature': temperature}
+        future = executor.submit(_attempt_model, 'generate', model_name, prompt, priority, config)
+        futures[future] = i
+        report.append({'model': model_name, 'temperature': temperature, 'status': 'pending'})
+    
+    pending = set(futures)
+    best = None  # (punteggio, indice, testo)
+    errors = []
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, deadline - time.perf_counter()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            entry = report[futures[future]]
+            entry['latency_ms'] = round((time.perf_counter() - started) * 1000)
+            if future.exception() is not None:
+                errors.append(future.exception())
+                entry.update(status='error', error=str(future.exception()))
+                gemini_candidates_total.labels('error').inc()
+                continue
+            text, _, usage = future.result()
+            text = clean_generated_yaml(text)
+            score, validation, issues = score_candidate(text, index)
+            entry.update(
+                usage,
+                status='valid' if validation['valid'] else 'invalid',
+                errors=validation['errors'] + issues,
+                warnings=len(validation['warnings'])
+            )
+            gemini_candidates_total.labels(entry['status']).inc()
+            if best is None or score > best[0]:
+                best = (score, futures[future], text)
+        if best is not None and best[0][0] and best[0][2] == 0:
+            # Valido e completo: gli altri candidati non servono più
+            break
+    
+    for future in pending:
+        future.cancel()  # quelli già in volo finiscono, ma il risultato è ignorato
+        report[futures[future]]['status'] = 'cancelled'
+        gemini_candidates_total.labels('cancelled').inc()
+    
+    if best is None:
+        if errors:
+            raise errors[-1]
+        raise TimeoutError(f"Gemini non ha risposto entro {GEMINI_CALL_DEADLINE:g}s")
+    
+    _, selected, text = best
+    gemini_candidates_total.labels('selected').inc()
+    gemini_call_path_total.labels('generate', 'candidates').inc()
+    return {'text': text, 'meta': {
+        'task': 'generate',
+        'model': report[selected]['model'],
+        'path': 'candidates',
+        'selected': selected,
+        'candidates': report,
+        'latency_ms': round((time.perf_counter() - started) * 1000)
+    }}
+
+# ==================== PIPELINE GENERA → VALIDA → CORREGGI ====================
+# Una sola richiesta: genera, valida contro lo snapshot dei registri e, se
+# non valida, rimanda a Gemini gli errori precisi (con le entità/servizi
+# esistenti più simili) per al massimo PIPELINE_MAX_REPAIRS correzioni.
+# Ritorna il primo YAML valido e la traccia dei tentativi.
+
+PIPELINE_MAX_REPAIRS = int(os.environ.get('PIPELINE_MAX_REPAIRS', '2'))
+PIPELINE_REPAIRS_LIMIT = 5
+REPAIR_SUGGESTIONS = 5
+
+def suggest_entities(entity_id, index, limit=REPAIR_SUGGESTIONS):
+    """Entità esistenti dello stesso dominio con id simile"""
+    if not index.entity_ids or not isinstance(entity_id, str):
+        return []
+    prefix = entity_id.split('.', 1)[0] + '.'
+    candidates = [e for e in index.entity_ids if e.startswith(prefix)]
+    return difflib.get_close_matches(entity_id, candidates, n=limit, cutoff=0.5)
+
+def suggest_services(service, index, limit=REPAIR_SUGGESTIONS):
+    """Servizi esistenti simili (stesso dominio se esiste, altrimenti domini simili)"""
+    domain, _, name = service.partition('.')
+    if domain in index.services:
+        matches = difflib.get_close_matches(name, list(index.services[domain]), n=limit, cutoff=0.5)
+        return [f"{domain}.{m}" for m in matches]
+    domains = difflib.get_close_matches(domain, list(index.services), n=limit, cutoff=0.6)
+    return [f"{d}.{name}" for d in domains if name in index.services[d]]
+
+def build_repair_prompt(description, yaml_text, validation, index):
+    """Prompt di correzione con gli errori di validazione e le alternative esistenti"""
+    lines = [f"- {error}" for error in validation['errors']]
+    
+    for entity_id in validation['entity_errors']:
+        suggestions = suggest_entities(entity_id, index)
+        hint = f" (closest existing: {', '.join(suggestions)})" if suggestions else " (no similar entity exists: remove it or use one from the request)"
+        lines.append(f"- Entity {entity_id} does not exist{hint}")
+    
+    for service in validation['service_errors']:
+        suggestions = suggest_services(service, index)
+        hint = f" (closest existing: {', '.join(suggestions)})" if suggestions else ""
+        lines.append(f"- Service {service} is not available{hint}")
+    
+    errors_str = '\n'.join(lines)
+    return f"""You are a Home Assistant expert. This automation was generated for the request below but failed validation against the user's Home Assistant.
+
+REQUEST: {description}
+
+AUTOMATION:
+{yaml_text}
+
+VALIDATION ERRORS:
+{errors_str}
+
+Fix ONLY these problems and keep everything else unchanged. Use only entity_ids and services that exist.
+Return ONLY the corrected YAML (no markdown, no explanations):"""
+
+def repair_automation(description, yaml_text, validation, index, meta=None):
+    """Chiede a Gemini di correggere il YAML secondo gli errori di validazione"""
+    prompt = build_repair_prompt(description, yaml_text, validation, index)
+    result = gemini_governor.call(
+        model_registry.model_name('repair'), prompt,
+        lambda: call_model('repair', prompt, priority='interactive'),
+        priority='interactive'
+    )
+    if meta is not None:
+        meta.update(result['meta'])
+    return clean_generated_yaml(result['text'])
+
+def run_generation_pipeline(description, entities, automation=None, max_repairs=PIPELINE_MAX_REPAIRS,
+                            use_cache=True, on_progress=None, candidates=None):
+    """Genera (o parte da 'automation'), valida e corregge fino al primo YAML valido.
+    
+    on_progress(tentativo) viene chiamato dopo ogni passaggio.
+    """
+    started = time.perf_counter()
+    index = get_registry_index()
+    cache_key = generation_cache_key(description, entities, model_registry.signature('generate'))
+    # La cache di generazione contiene già questo YAML? Allora la versione corretta lo sostituisce
+    cached_entry = automation is not None and generation_cache.get(cache_key, count=False) == automation
+    from_cache = False
+    
+    attempts = []
+    yaml_text = automation
+    validation = None
+    for step in range(max_repairs + 1):
+        meta = {}
+        step_started = time.perf_counter()
+        try:
+            if step == 0 and yaml_text is None:
+                stage = 'generate'
+                yaml_text = _generate_automation(description, entities, use_cache=use_cache, meta=meta, candidates=candidates)
+                from_cache = meta.get('path') == 'cache'
+                # Letto dalla cache o appena generato (e salvato): è il valore in cache
+                cached_entry = bool(yaml_text)
+            elif step == 0:
+                stage = 'input'
+            else:
+                stage = 'repair'
+                yaml_text = repair_automation(description, yaml_text, validation, index, meta=meta)
+        except Exception as e:
+            if step == 0 and isinstance(e, LLMBusyError):
+                raise
+            print(f"Errore pipeline ({stage}): {e}")
+            attempt = {'stage': stage, 'error': str(e), 'llm_ms': round((time.perf_counter() - step_started) * 1000)}
+            attempts.append(attempt)
+            if on_progress:
+                on_progress(attempt)
+            break
+        llm_ms = round((time.perf_counter() - step_started) * 1000)
         
-        nodes = []
-        edges = []
-        node_id = 0
+        validate_started = time.perf_counter()
+        validation = test_automation(yaml_text, index, existing=False)
+        attempt = {
+            'stage': stage,
+            'valid': validation['valid'],
+            'errors': validation['errors'],
+            'entity_errors': validation['entity_errors'],
+            'service_errors': validation['service_errors'],
+            'generation': meta,
+            'llm_ms': llm_ms,
+            'validate_ms': round((time.perf_counter() - validate_started) * 1000, 2)
+        }
+        attempts.append(attempt)
+        if on_progress:
+            on_progress(attempt)
         
-        # Nodo START
-        nodes.append({
+        if validation['valid']:
+            if stage == 'repair' and cached_entry:
+                # La prossima generazione identica riceve già la versione corretta
+                generation_cache.set(cache_key, yaml_text)
+            break
+        if index.entity_error:
+            # Senza registro entità una correzione non può verificare nulla
+            break
+    
+    if validation is not None:
+        # Duplicati e conflitti con le automazioni esistenti solo sul risultato finale
+        try:
+            final = parse_yaml(yaml_text)
+        except yaml.YAMLError:
+            final = None
+        if isinstance(final, dict):
+            check_existing_automations(final, validation)
+    
+    return {
+        'automation': yaml_text,
+        'valid': bool(validation and validation['valid']),
+        'validation': validation,
+        'repairs': sum(1 for a in attempts if a['stage'] == 'repair'),
+        'from_cache': from_cache,
+        'attempts': attempts,
+        'total_ms': round((time.perf_counter() - started) * 1000)
+    }
+
+# ==================== GRAFO DELL'AUTOMAZIONE ====================
+# parse_automation_to_graph() compila l'automazione in un grafo di flusso:
+# trigger (in OR), condizioni (in AND) e azioni, con choose, if/then/else,
+# repeat, parallel e sequence espansi ricorsivamente. Il layout è calcolato
+# qui (Sugiyama: livelli per cammino più lungo, nodi fittizi sugli archi
+# lunghi, ordinamento per baricentro, coordinate bilanciate) così il browser
+# disegna solo nodi già posizionati. Ogni nodo porta i soli campi propri del
+# blocco YAML (i blocchi annidati sono altri nodi): niente descrizioni
+# duplicate. Formato colonnare (node_fields/edge_fields), in cache per hash.
+
+GRAPH_FORMAT_VERSION = 2
+GRAPH_NODE_FIELDS = ['id', 'type', 'label', 'x', 'y', 'path', 'entities', 'service', 'source']
+GRAPH_EDGE_FIELDS = ['from', 'to', 'label', 'kind']
+GRAPH_LAYER_GAP = 70
+GRAPH_NODE_GAP = 40
+GRAPH_CHAR_WIDTH = 8
+GRAPH_LINE_HEIGHT = 18
+GRAPH_ORDER_SWEEPS = 8
+GRAPH_POSITION_PASSES = 4
+# Chiavi che contengono altri blocchi (diventano nodi propri)
+GRAPH_NESTED_KEYS = ('choose', 'default', 'if', 'then', 'else', 'sequence', 'parallel', 'repeat')
+
+graph_cache = PersistentCache(
+    'graph',
+    ttl=float(os.environ.get('GRAPH_CACHE_TTL', str(7 * 24 * 3600))),
+    max_entries=int(os.environ.get('GRAPH_CACHE_MAX_ENTRIES', '500')),
+    max_bytes=int(os.environ.get('GRAPH_CACHE_MAX_BYTES', str(20 * 1024 * 1024)))
+)
+
+SERVICE_ICONS = (
+    (('light',), '💡'),
+    (('climate', 'heater'), '🔥'),
+    (('notify', 'telegram'), '📱'),
+    (('switch',), '🔌'),
+    (('cover',), '🚪'),
+    (('media_player',), '🎵'),
+    (('scene',), '🎬'),
+    (('script', 'automation'), '📜'),
+)
+
+def _short(value, limit=28):
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+def _entities_label(entities):
+    if not entities:
+        return ''
+    label = f"\n{entities[0]}"
+    if len(entities) > 1:
+        label += f"\n+{len(entities) - 1} more"
+    return label
+
+def _own_fields(block):
+    """Campi del blocco esclusi quelli che contengono altri blocchi"""
+    if not isinstance(block, dict):
+        return block
+    own = {k: v for k, v in block.items() if k not in GRAPH_NESTED_KEYS}
+    repeat = block.get('repeat')
+    if isinstance(repeat, dict):
+        own['repeat'] = {k: v for k, v in repeat.items() if k != 'sequence'}
+    return own
+
+def trigger_label(trigger):
+    platform = trigger.get('platform', trigger.get('trigger', 'unknown'))
+    entity_id = trigger.get('entity_id', '')
+    entity = _short(entity_id) if entity_id else ''
+    if platform == 'time':
+        return f"⏰ Time\n{_short(trigger.get('at', ''))}"
+    if platform == 'state':
+        label = f"🔄 State\n{entity}"
+        return label + f"\n→ {_short(trigger['to'])}" if 'to' in trigger else label
+    if platform == 'numeric_state':
+        label = f"📊 Numeric\n{entity}"
+        if 'above' in trigger:
+            label += f"\n> {trigger['above']}"
+        if 'below' in trigger:
+            label += f"\n< {trigger['below']}"
+        return label
+    if platform == 'event':
+        return f"⚡ Event\n{_short(trigger.get('event_type', ''))}"
+    if platform == 'sun':
+        return f"☀️ Sun\n{trigger.get('event', '')}"
+    return f"🔔 {platform}" + (f"\n{entity}" if entity else '')
+
+def condition_label(condition):
+    if not isinstance(condition, dict):
+        return f"🧩 Template\n{_short(condition)}"
+    cond_type = condition.get('condition', 'unknown')
+    entity_id = condition.get('entity_id', '')
+    entity = _short(entity_id) if entity_id else ''
+    if cond_type == 'time':
+        return f"⏰ Time\n{condition.get('after', '')} - {condition.get('before', '')}"
+    if cond_type == 'state':
+        return f"✅ State\n{entity}\n= {_short(condition.get('state', ''))}"
+    if cond_type == 'numeric_state':
+        label = f"✅ Numeric\n{entity}"
+        if 'above' in condition:
+            label += f"\n > {condition['above']}"
+        if 'below' in condition:
+            label += f"\n < {condition['below']}"
+        return label
+    if cond_type == 'sun':
+        return f"☀️ Sun\n{condition.get('after', condition.get('before', ''))}"
+    if cond_type == 'template':
+        return f"🧩 Template\n{_short(condition.get('value_template', ''))}"
+    for key in ('and', 'or', 'not'):
+        if cond_type == key or key in condition:
+            nested = condition.get('conditions', condition.get(key))
+            return f"🔗 {key.upper()}\n{len(_as_list(nested))} condizioni"
+    return f"✅ {cond_type}" + (f"\n{entity}" if entity else '')
+
+def action_label(action):
+    """(label, servizio) di un'azione foglia"""
+    service = action.get('service') or action.get('action')
+    if isinstance(service, str):
+        icon = next((icon for keys, icon in SERVICE_ICONS if any(k in service for k in keys)), '🎯')
+        return f"{icon} {service.split('.')[-1] if '.' in service else service}", service
+    if 'scene' in action:
+        return f"🎬 Scene\n{_short(action['scene'])}", 'scene.turn_on'
+    if 'delay' in action:
+        return f"⏱️ Delay\n{_short(action['delay'])}", None
+    if 'wait_template' in action:
+        return f"⏳ Wait\n{_short(action['wait_template'])}", None
+    if 'wait_for_trigger' in action:
+        return f"⏳ Wait trigger\n{len(_as_list(action['wait_for_trigger']))} trigger", None
+    if 'event' in action:
+        return f"⚡ Event\n{_short(action['event'])}", None
+    if 'variables' in action:
+        return f"📦 Variables\n{', '.join(map(str, action['variables']))[:28] if isinstance(action['variables'], dict) else ''}", None
+    if 'stop' in action:
+        return f"⛔ Stop\n{_short(action['stop'])}", None
+    return '🎯 ' + _short(next(iter(action), 'action')), None
+
+def _action_entities(action):
+    entities = list(_entity_refs(action.get('entity_id')))
+    target = action.get('target')
+    if isinstance(target, dict):
+        entities += _entity_refs(target.get('entity_id'))
+    data = action.get('data')
+    if isinstance(data, dict):
+        entities += _entity_refs(data.get('entity_id'))
+    return list(dict.fromkeys(entities))
+
+class AutomationGraphBuilder:
+    """Compila un'automazione in nodi e archi di flusso (DAG + archi 'loop' dei repeat)"""
+    
+    def __init__(self):
+        self.nodes = []
+        self.edges = []
+    
+    def node(self, node_type, label, path=(), source=None, entities=None, service=None):
+        node_id = len(self.nodes)
+        self.nodes.append({
             'id': node_id,
-            'label': 'START',
-            'type': 'start',
-            'icon': '▶️',
-            'description': 'Inizio automazione'
+            'type': node_type,
+            'label': label,
+            'path': '.'.join(str(p) for p in path),
+            'entities': entities or [],
+            'service': service,
+            'source': source
         })
-        start_id = node_id
-        node_id += 1
-        
-        # TRIGGERS
-        triggers = automation.get('trigger', [])
-        if not isinstance(triggers, list):
-            triggers = [triggers]
+        return node_id
+    
+    def connect(self, preds, node_id):
+        for pred, label in preds:
+            self.edges.append((pred, node_id, label, 'flow'))
+    
+    def build(self, automation):
+        start = self.node('start', '▶️ START', source={
+            'alias': automation.get('alias'), 'description': automation.get('description'), 'mode': automation.get('mode', 'single')
+        })
+        trigger_key = 'triggers' if 'triggers' in automation else 'trigger'
+        condition_key = 'conditions' if 'conditions' in automation else 'condition'
+        action_key = 'actions' if 'actions' in automation else 'action'
         
+        # Trigger in OR
+        triggers = automation.get(trigger_key)
         trigger_ids = []
-        for i, trigger in enumerate(triggers):
-            platform = trigger.get('platform', 'unknown')
-            entity_id = trigger.get('entity_id', '')
-            label = f"{platform}"
-            
-            # Dettagli specifici per tipo trigger
-            if platform == 'time':
-                at_time = trigger.get('at', '')
-                label = f"⏰ Time\n{at_time}"
-            elif platform == 'state':
-                to_state = trigger.get('to', '')
-                label = f"🔄 State\n{entity_id}\n→ {to_state}"
-            elif platform == 'numeric_state':
-                above = trigger.get('above', '')
-                below = trigger.get('below', '')
-                label = f"📊 Numeric\n{entity_id}"
-                if above:
-                    label += f"\n> {above}"
-                if below:
-                    label += f"\n< {below}"
-            elif platform == 'event':
-                event = trigger.get('event_type', '')
-                label = f"⚡ Event\n{event}"
-            else:
-                label = f"🔔 {platform}"
-            
-            nodes.append({
-                'id': node_id,
-                'label': label,
-                'type': 'trigger',
-                'icon': '⏰',
-                'entity_id': entity_id,
-                'description': json.dumps(trigger, indent=2)
-            })
-            edges.append({
-                'from': start_id,
-                'to': node_id,
-                'label': 'quando'
-            })
-            trigger_ids.append(node_id)
-            node_id += 1
-        
-        # Merge triggers se multipli
+        for i, trigger in enumerate(_as_list(triggers)):
+            if not isinstance(trigger, dict):
+                continue
+            path = (trigger_key, i) if isinstance(triggers, list) else (trigger_key,)
+            trigger_id = self.node('trigger', trigger_label(trigger), path, _own_fields(trigger),
+                                   entities=_entity_refs(trigger.get('entity_id')))
+            self.connect([(start, 'quando')], trigger_id)
+            trigger_ids.append(trigger_id)
         if len(trigger_ids) > 1:
-            nodes.append({
-                'id': node_id,
-                'label': 'OR',
-                'type': 'logic',
-                'icon': '🔀',
-                'description': 'Uno qualsiasi dei trigger'
-            })
-            merge_id = node_id
-            for tid in trigger_ids:
-                edges.append({
-                    'from': tid,
-                    'to': merge_id,
-                    'label': 'o'
-                })
-            node_id += 1
-            last_node = merge_id
+            merge = self.node('logic', '🔀 OR', source={'info': 'Uno qualsiasi dei trigger'})
+            self.connect([(t, 'o') for t in trigger_ids], merge)
+            preds = [(merge, 'se')]
         else:
-            last_node = trigger_ids[0] if trigger_ids else start_id
+            preds = [(trigger_ids[0], 'se')] if trigger_ids else [(start, 'se')]
         
-        # CONDITIONS
-        conditions = automation.get('condition', [])
-        if conditions:
-            if not isinstance(conditions, list):
-                conditions = [conditions]
-            
-            condition_ids = []
-            for i, condition in enumerate(conditions):
-                cond_type = condition.get('condition', 'unknown')
-                entity_id = condition.get('entity_id', '')
-                label = f"✅ {cond_type}"
-                
-                if cond_type == 'time':
-                    after = condition.get('after', '')
-                    before = condition.get('before', '')
-                    label = f"⏰ Time\n{after} - {before}"
-                elif cond_type == 'state':
-                    state = condition.get('state', '')
-                    label = f"✅ State\n{entity_id}\n= {state}"
-                elif cond_type == 'numeric_state':
-                    above = condition.get('above', '')
-                    below = condition.get('below', '')
-                    label = f"✅ Numeric\n{entity_id}"
-                    if above:
-                        label += f"\n > {above}"
-                    if below:
-                        label += f"\n < {below}"
-                elif cond_type == 'sun':
-                    label = f"☀️ Sun\n{condition.get('after', condition.get('before', ''))}"
-                
-                nodes.append({
-                    'id': node_id,
-                    'label': label,
-                    'type': 'condition',
-                    'icon': '✅',
-                    'entity_id': entity_id,
-                    'description': json.dumps(condition, indent=2)
-                })
-                edges.append({
-                    'from': last_node,
-                    'to': node_id,
-                    'label': 'se'
-                })
-                condition_ids.append(node_id)
-                node_id += 1
-            
-            # Merge conditions (AND)
-            if len(condition_ids) > 1:
-                nodes.append({
-                    'id': node_id,
-                    'label': 'AND',
-                    'type': 'logic',
-                    'icon': '🔗',
-                    'description': 'Tutte le condizioni devono essere vere'
-                })
-                merge_id = node_id
-                for cid in condition_ids:
-                    edges.append({
-                        'from': cid,
-                        'to': merge_id,
-                        'label': 'e'
-                    })
-                node_id += 1
-                last_node = merge_id
+        # Condizioni in AND: catena
+        conditions = automation.get(condition_key)
+        for i, condition in enumerate(_as_list(conditions)):
+            path = (condition_key, i) if isinstance(conditions, list) else (condition_key,)
+            preds = [(self.condition(condition, path, preds), 'e')]
+        
+        exits = self.sequence(automation.get(action_key), (action_key,), [(p, 'esegui') for p, _ in preds])
+        end = self.node('end', '✅ END', source={'info': 'Automazione completata'})
+        self.connect([(p, 'fine') for p, _ in exits], end)
+        return self
+    
+    def condition(self, condition, path, preds):
+        entities = _entity_refs(condition.get('entity_id')) if isinstance(condition, dict) else []
+        condition_id = self.node('condition', condition_label(condition), path, condition, entities=entities)
+        self.connect(preds, condition_id)
+        return condition_id
+    
+    def sequence(self, actions, path, preds):
+        """Compila una lista di azioni; ritorna le uscite [(nodo, etichetta arco)]"""
+        for i, action in enumerate(_as_list(actions)):
+            step_path = path + (i,) if isinstance(actions, list) else path
+            preds = self.action(action, step_path, preds)
+        return preds
+    
+    def action(self, action, path, preds):
+        if not isinstance(action, dict):
+            return preds
+        if 'condition' in action and not any(k in action for k in ('service', 'action')):
+            # Condizione dentro la sequenza: se falsa l'esecuzione si ferma
+            return [(self.condition(action, path, preds), 'sì')]
+        
+        if 'choose' in action:
+            branch = self.node('logic', '🔀 Choose', path, _own_fields(action))
+            self.connect(preds, branch)
+            exits = []
+            for i, option in enumerate(_as_list(action['choose'])):
+                if not isinstance(option, dict):
+                    continue
+                option_path = path + ('choose', i)
+                option_preds = [(branch, f"opzione {i + 1}")]
+                option_conditions = option.get('conditions')
+                for j, condition in enumerate(_as_list(option_conditions)):
+                    condition_path = option_path + ('conditions', j) if isinstance(option_conditions, list) else option_path + ('conditions',)
+                    option_preds = [(self.condition(condition, condition_path, option_preds), 'sì')]
+                exits += self.sequence(option.get('sequence'), option_path + ('sequence',), option_preds)
+            if 'default' in action:
+                exits += self.sequence(action['default'], path + ('default',), [(branch, 'altrimenti')])
             else:
-                last_node = condition_ids[0] if condition_ids else last_node
+                exits.append((branch, 'nessuna'))
+            return exits
         
-        # ACTIONS
-        actions = automation.get('action', [])
-        if not isinstance(actions, list):
-            actions = [actions]
+        if 'if' in action:
+            branch = self.node('logic', '❓ If', path, _own_fields(action))
+            self.connect(preds, branch)
+            then_preds = [(branch, 'se')]
+            conditions = action['if']
+            for j, condition in enumerate(_as_list(conditions)):
+                condition_path = path + ('if', j) if isinstance(conditions, list) else path + ('if',)
+                then_preds = [(self.condition(condition, condition_path, then_preds), 'e')]
+            exits = self.sequence(action.get('then'), path + ('then',), [(p, 'allora') for p, _ in then_preds])
+            if 'else' in action:
+                exits += self.sequence(action['else'], path + ('else',), [(branch, 'altrimenti')])
+            else:
+                exits.append((branch, 'altrimenti'))
+            return exits
         
-        for i, action in enumerate(actions):
-            if isinstance(action, dict):
-                service = action.get('service', action.get('scene', 'unknown'))
-                entity = action.get('entity_id', action.get('target', {}).get('entity_id', ''))
-                
-                # Determina icona e label
-                if 'light' in service:
-                    icon = '💡'
-                    action_name = 'turn_on' if 'on' in service else 'turn_off'
-                elif 'climate' in service or 'heater' in service:
-                    icon = '🔥'
-                    action_name = service.split('.')[-1]
-                elif 'notify' in service:
-                    icon = '📱'
-                    action_name = 'notify'
-                elif 'switch' in service:
-                    icon = '🔌'
-                    action_name = service.split('.')[-1]
-                elif 'cover' in service:
-                    icon = '🚪'
-                    action_name = service.split('.')[-1]
-                elif 'media_player' in service:
-                    icon = '🎵'
-                    action_name = service.split('.')[-1]
+        repeat = action.get('repeat')
+        if isinstance(repeat, dict):
+            if 'count' in repeat:
+                detail = f"{_short(repeat['count'])} volte"
+            elif 'for_each' in repeat:
+                detail = f"per {len(_as_list(repeat['for_each']))} elementi"
+            else:
+                kind = 'while' if 'while' in repeat else 'until'
+                detail = f"{kind} ({len(_as_list(repeat.get(kind)))} condizioni)"
+            loop = self.node('logic', f"🔁 Repeat\n{detail}", path, _own_fields(action))
+            self.connect(preds, loop)
+            body_exits = self.sequence(repeat.get('sequence'), path + ('repeat', 'sequence'), [(loop, 'ripeti')])
+            for pred, _ in body_exits:
+                if pred != loop:
+                    self.edges.append((pred, loop, 'di nuovo', 'loop'))
+            return [(loop, 'fine ciclo')]
+        
+        if 'parallel' in action:
+            fork = self.node('logic', '⏸️ Parallel', path, _own_fields(action))
+            self.connect(preds, fork)
+            join = None
+            branch_exits = []
+            for i, branch in enumerate(_as_list(action['parallel'])):
+                branch_path = path + ('parallel', i) if isinstance(action['parallel'], list) else path + ('parallel',)
+                if isinstance(branch, dict) and 'sequence' in branch and len(branch) == 1:
+                    branch_exits += self.sequence(branch['sequence'], branch_path + ('sequence',), [(fork, f"ramo {i + 1}")])
                 else:
-                    icon = '🎯'
-                    action_name = service
-                
-                label = f"{icon} {action_name}"
-                if entity:
-                    if isinstance(entity, list):
-                        label += f"\n{entity[0]}"
-                        if len(entity) > 1:
-                            label += f"\n+{len(entity)-1} more"
-                    else:
-                        label += f"\n{entity}"
-                
-                nodes.append({
-                    'id': node_id,
-                    'label': label,
-                    'type': 'action',
-                    'icon': icon,
-                    'entity_id': entity if isinstance(entity, str) else (entity[0] if entity else ''),
-                    'service': service,
-                    'description': json.dumps(action, indent=2)
-                })
-                edges.append({
-                    'from': last_node,
-                    'to': node_id,
-                    'label': 'esegui' if i == 0 else 'poi'
-                })
-                last_node = node_id
-                node_id += 1
+                    branch_exits += self.action(branch, branch_path, [(fork, f"ramo {i + 1}")])
+            join = self.node('logic', '⏩ Join', source={'info': 'Attende tutti i rami'})
+            self.connect(branch_exits, join)
+            return [(join, 'poi')]
         
-        # Nodo END
-        nodes.append({
-            'id': node_id,
-            'label': 'END',
-            'type': 'end',
-            'icon': '✅',
-            'description': 'Automazione completata'
-        })
-        edges.append({
-            'from': last_node,
-            'to': node_id,
-            'label': 'fine'
-        })
+        if 'sequence' in action and not action.get('service') and not action.get('action'):
+            return self.sequence(action['sequence'], path + ('sequence',), preds)
         
-        return {
-            'nodes': nodes,
-            'edges': edges,
-            'info': {
-                'alias': automation.get('alias', 'Automazione'),
-                'description': automation.get('description', ''),
-                'mode': automation.get('mode', 'single')
-            }
+        label, service = action_label(action)
+        entities = _action_entities(action)
+        if action.get('enabled') is False:
+            label += '\n(disabilitata)'
+        action_id = self.node('action', label + _entities_label(entities), path, _own_fields(action),
+                              entities=entities, service=service)
+        self.connect(preds, action_id)
+        return [(action_id, 'poi')]
+
+def _node_size(label):
+    lines = label.split('\n') if label else ['']
+    return max(len(line) for line in lines) * GRAPH_CHAR_WIDTH + 30, len(lines) * GRAPH_LINE_HEIGHT + 20
+
+def layout_graph(nodes, edges):
+    """Layout a livelli (Sugiyama) in place: aggiunge x, y ai nodi. Ritorna (larghezza, altezza)"""
+    count = len(nodes)
+    if not count:
+        return 0, 0
+    # 1. Livelli: cammino più lungo dallo start (gli archi 'loop' sono esclusi)
+    flow = [(a, b) for a, b, _, kind in edges if kind != 'loop' and a != b]
+    succ = [[] for _ in range(count)]
+    indegree = [0] * count
+    for a, b in flow:
+        succ[a].append(b)
+        indegree[b] += 1
+    layer = [0] * count
+    queue = [n for n in range(count) if indegree[n] == 0]
+    for n in queue:  # la lista cresce durante il ciclo (ordine topologico)
+        for m in succ[n]:
+            layer[m] = max(layer[m], layer[n] + 1)
+            indegree[m] -= 1
+            if indegree[m] == 0:
+                queue.append(m)
+    
+    # 2. Nodi fittizi sugli archi che saltano livelli
+    widths = [_node_size(node['label'])[0] for node in nodes]
+    heights = [_node_size(node['label'])[1] for node in nodes]
+    up = [[] for _ in range(count)]
+    down = [[] for _ in range(count)]
+    for a, b in flow:
+        previous = a
+        for level in range(layer[a] + 1, layer[b]):
+            dummy = len(layer)
+            layer.append(level)
+            widths.append(0)
+            heights.append(0)
+            up.append([])
+            down.append([])
+            down[previous].append(dummy)
+            up[dummy].append(previous)
+            previous = dummy
+        down[previous].append(b)
+        up[b].append(previous)
+    
+    layers = [[] for _ in range(max(layer) + 1)]
+    for n in queue + list(range(count, len(layer))):  # ordine iniziale: topologico
+        layers[layer[n]].append(n)
+    
+    # 3. Ordinamento per baricentro (sweep alternati), tenendo il migliore per incroci
+    def crossings(order):
+        total = 0
+        for level in range(len(order) - 1):
+            position = {n: i for i, n in enumerate(order[level + 1])}
+            pairs = [(i, position[m]) for i, n in enumerate(order[level]) for m in down[n]]
+            total += sum(1 for x in range(len(pairs)) for y in range(x + 1, len(pairs))
+                         if (pairs[x][0] - pairs[y][0]) * (pairs[x][1] - pairs[y][1]) < 0)
+        return total
+    
+    best = [list(level) for level in layers]
+    best_crossings = crossings(best)
+    for sweep in range(GRAPH_ORDER_SWEEPS):
+        downward = sweep % 2 == 0
+        levels = range(1, len(layers)) if downward else range(len(layers) - 2, -1, -1)
+        for level in levels:
+            reference = {n: i for i, n in enumerate(layers[level - 1 if downward else level + 1])}
+            current = {n: i for i, n in enumerate(layers[level])}
+            def barycenter(n):
+                neighbours = [reference[m] for m in (up[n] if downward else down[n])]
+                return sum(neighbours) / len(neighbours) if neighbours else current[n]
+            layers[level].sort(key=barycenter)
+        found = crossings(layers)
+        if found < best_crossings:
+            best, best_crossings = [list(level) for level in layers], found
+    layers = best
+    
+    # 4. Coordinate x: media dei vicini, poi compattazione rispettando ordine e distanze
+    x = [0.0] * len(layer)
+    for level in layers:
+        position = 0.0
+        for n in level:
+            x[n] = position + widths[n] / 2
+            position += widths[n] + GRAPH_NODE_GAP
+    
+    def place(level, desired):
+        gaps = [(widths[a] + widths[b]) / 2 + GRAPH_NODE_GAP for a, b in zip(level, level[1:])]
+        left = [desired[0]]
+        for i in range(1, len(level)):
+            left.append(max(desired[i], left[-1] + gaps[i - 1]))
+        right = [desired[-1]]
+        for i in range(len(level) - 2, -1, -1):
+            right.insert(0, min(desired[i], right[0] - gaps[i]))
+        # La media di due disposizioni valide è valida e non sbilanciata
+        for i, n in enumerate(level):
+            x[n] = (left[i] + right[i]) / 2
+    
+    for sweep in range(GRAPH_POSITION_PASSES):
+        downward = sweep % 2 == 0
+        for level in (layers[1:] if downward else layers[-2::-1]):
+            desired = []
+            for n in level:
+                neighbours = up[n] if downward else down[n]
+                desired.append(sum(x[m] for m in neighbours) / len(neighbours) if neighbours else x[n])
+            place(level, desired)
+    
+    # 5. Coordinate finali (centro dei nodi), y cumulativa per altezza dei livelli
+    left_edge = min(x[n] - widths[n] / 2 for level in layers for n in level)
+    y = 0
+    for level in layers:
+        level_height = max(heights[n] for n in level) if level else 0
+        for n in level:
+            if n < count:
+                nodes[n]['x'] = round(x[n] - left_edge)
+                nodes[n]['y'] = round(y + level_height / 2)
+        y += level_height + GRAPH_LAYER_GAP
+    width = max(x[n] + widths[n] / 2 for level in layers for n in level) - left_edge
+    return round(width), max(0, y - GRAPH_LAYER_GAP)
+
+def compile_automation_graph(automation):
+    """Grafo posizionato nel formato colonnare di GRAPH_NODE_FIELDS / GRAPH_EDGE_FIELDS"""
+    builder = AutomationGraphBuilder().build(automation)
+    width, height = layout_graph(builder.nodes, builder.edges)
+    return {
+        'version': GRAPH_FORMAT_VERSION,
+        'node_fields': GRAPH_NODE_FIELDS,
+        'nodes': [[node[field] for field in GRAPH_NODE_FIELDS] for node in builder.nodes],
+        'edge_fields': GRAPH_EDGE_FIELDS,
+        'edges': [list(edge) for edge in builder.edges],
+        'size': [width, height],
+        'info': {
+            'alias': automation.get('alias', 'Automazione'),
+            'description': automation.get('description', ''),
+            'mode': automation.get('mode', 'single')
         }
-        
+    }
+
+def parse_automation_to_graph(yaml_text):
+    """Converte YAML automazione in grafo posizionato per la visualizzazione (in cache per hash)"""
+    try:
+        key = f"v{GRAPH_FORMAT_VERSION}:{automation_hash(yaml_text)}"
+        cached = graph_cache.get(key)
+        if cached is not None:
+            return cached
+        automation = parse_yaml(yaml_text)
+        if not isinstance(automation, dict):
+            raise ValueError("L'automazione deve essere un dizionario YAML")
+        graph = compile_automation_graph(automation)
+        graph_cache.set(key, graph)
+        return graph
     except Exception as e:
         return {
             'error': str(e),
@@ -551,15 +3454,46 @@ def parse_automation_to_graph(yaml_text):
             'edges': []
         }
 
+analysis_cache = PersistentCache(
+    'analysis',
+    ttl=float(os.environ.get('ANALYSIS_CACHE_TTL', str(30 * 24 * 3600))),
+    max_entries=int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', '1000')),
+    max_bytes=int(os.environ.get('ANALYSIS_CACHE_MAX_BYTES', str(10 * 1024 * 1024)))
+)
+
+def automation_hash(yaml_text):
+    """Hash canonico dell'automazione: stesso contenuto = stesso hash,
+    indipendentemente da formattazione, commenti e ordine delle chiavi"""
+    try:
+        canonical = json.dumps(parse_yaml(yaml_text), sort_keys=True, separators=(',', ':'), default=str)
+    except yaml.YAMLError:
+        canonical = yaml_text
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def get_automation_analysis(yaml_text, cached_only=False):
+    """Analisi AI dalla cache (per hash canonico) o da Gemini.
+    
+    Con cached_only=True non chiama Gemini: ritorna None se non in cache.
+    """
+    key = automation_hash(yaml_text)
+    cached = analysis_cache.get(key)
+    if cached is not None or cached_only:
+        return cached
+    
+    analysis = explain_automation_with_ai(yaml_text)
+    # Le risposte di ripiego (errore Gemini/JSON) non vanno in cache
+    if not analysis.get('fallback'):
+        analysis_cache.set(key, analysis)
+    return analysis
+
 def explain_automation_with_ai(yaml_text):
     """Usa Gemini per spiegare l'automazione"""
     try:
         # Prova a parsare prima per dare info all'AI
-        automation = yaml.safe_load(yaml_text)
+        automation = parse_yaml(yaml_text)
         alias = automation.get('alias', 'Automazione')
         description = automation.get('description', '')
         
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
         prompt = f"""Analyze this Home Assistant automation in a simple and clear way.
 
 AUTOMATION:
@@ -576,8 +3510,11 @@ Respond ONLY with a valid JSON object (no markdown):
 
 IMPORTANT: Respond ONLY with the JSON, no additional text or markdown."""
         
-        response = model.generate_content(prompt)
-        text = response.text.strip()
+        text = gemini_governor.call(
+            model_registry.model_name('explain'), prompt,
+            lambda: call_model('explain', prompt, priority='background'),
+            priority='background'
+        )['text'].strip()
         
         # Rimuovi markdown code blocks se presenti
         if '```json' in text:
@@ -613,8 +3550,11 @@ IMPORTANT: Respond ONLY with the JSON, no additional text or markdown."""
             'triggers': ['Verifica i trigger nel YAML'],
             'conditions': [],
             'actions': ['Verifica le azioni nel YAML'],
-            'suggestions': ['Usa il test per verificare la validità']
+            'suggestions': ['Usa il test per verificare la validità'],
+            'fallback': True
         }
+    except LLMBusyError:
+        raise
     except Exception as e:
         print(f"Errore AI analysis: {e}")
         import traceback
@@ -624,9 +3564,497 @@ IMPORTANT: Respond ONLY with the JSON, no additional text or markdown."""
             'triggers': [],
             'conditions': [],
             'actions': [],
-            'suggestions': ['Riprova più tardi']
+            'suggestions': ['Riprova più tardi'],
+            'fallback': True
+        }
+
+# ==================== ESECUZIONE AZIONI ====================
+# Le azioni vengono trasformate in un piano ('seq' / 'par' / 'call') ed eseguite
+# come job: i blocchi parallel: girano in parallelo, le sequenze restano in
+# ordine. In modalità concorrente anche le chiamate consecutive al primo livello
+# su entità diverse vengono eseguite insieme (delay/wait fanno da barriera).
+
+EXECUTE_MAX_PARALLEL = int(os.environ.get('EXECUTE_MAX_PARALLEL', '8'))
+EXECUTE_MAX_JOBS = int(os.environ.get('EXECUTE_MAX_JOBS', '4'))
+EXECUTE_SYNC_DEADLINE = float(os.environ.get('EXECUTE_SYNC_DEADLINE', '45'))
+
+_execute_slots = threading.BoundedSemaphore(EXECUTE_MAX_JOBS)
+
+def prepare_service_call(action, label):
+    """Estrae (servizio, service_data) da un'azione; None se non va eseguita"""
+    # Estrai servizio (supporta vari formati)
+    service = action.get('service') or action.get('action')
+    if service is not None and not isinstance(service, str):
+        service = None
+    
+    if not service:
+        # Prova a inferire dal tipo di azione
+        if 'scene' in action:
+            service = 'scene.turn_on'
+        elif 'event' in action:
+            service = 'event.fire'
+        else:
+            # Salta silenziosamente azioni senza servizio valido
+            # (probabilmente azioni di delay, wait, ecc)
+            if 'delay' in action or 'wait_template' in action or 'wait_for_trigger' in action:
+                print(f"INFO: Azione {label} è wait/delay, skip esecuzione")
+                return None
+            
+            print(f"WARN: Azione {label} senza servizio riconosciuto: {action}")
+            return None
+    
+    # Prepara dati per chiamata servizio
+    service_data = {}
+    
+    # Entity ID (vari formati)
+    if 'entity_id' in action:
+        service_data['entity_id'] = action['entity_id']
+    
+    # Target (nuovo formato HA): va dentro service_data
+    target = action.get('target')
+    if isinstance(target, dict):
+        for key in ('entity_id', 'device_id', 'area_id'):
+            if key in target:
+                service_data[key] = target[key]
+    
+    # Data aggiuntivi (per notifiche, ecc.)
+    action_data = action.get('data')
+    if isinstance(action_data, dict):
+        service_data.update(action_data)
+    
+    # Scene specifico
+    if 'scene' in action:
+        service_data['entity_id'] = action['scene']
+    
+    # Event specifico
+    if 'event' in action:
+        service_data['event_type'] = action['event']
+    
+    return service, service_data
+
+def call_service(service, service_data):
+    """Chiama un servizio HA e ritorna il risultato nel formato di /api/execute"""
+    timeout = None
+    try:
+        if '.' not in service:
+            return {
+                'action': service,
+                'success': False,
+                'error': 'Formato servizio non valido (manca dominio)'
+            }
+        domain, service_name = service.split('.', 1)
+        
+        print(f"Chiamata servizio: {domain}/{service_name}")
+        print(f"Dati: {service_data}")
+        
+        # Timeout dinamico basato sul servizio (vedi HA_TIMEOUTS)
+        service_path = f"services/{domain}/{service_name}"
+        timeout = ha_timeout(service_path)
+        
+        response = ha_request('POST', service_path, json=service_data, timeout=timeout)
+        
+        print(f"Response status: {response.status_code}")
+        print(f"Response text: {response.text[:200] if response.text else 'empty'}")
+        
+        if response.status_code == 200:
+            # Determina descrizione azione
+            action_desc = service
+            if 'entity_id' in service_data:
+                entity = service_data['entity_id']
+                if isinstance(entity, list):
+                    entity = f"{entity[0]} (+{len(entity)-1})" if len(entity) > 1 else entity[0]
+                action_desc = f"{service} → {entity}"
+            elif isinstance(service_data.get('message'), str):
+                msg = service_data['message'][:30] + "..." if len(service_data['message']) > 30 else service_data['message']
+                action_desc = f"{service} → \"{msg}\""
+            
+            return {
+                'action': action_desc,
+                'success': True,
+                'response': 'Eseguito con successo'
+            }
+        
+        error_msg = response.text if response.text else f'HTTP {response.status_code}'
+        return {
+            'action': service,
+            'success': False,
+            'error': error_msg
+        }
+    
+    except requests.exceptions.Timeout:
+        return {
+            'action': service,
+            'success': False,
+            'error': f'Timeout (>{timeout}s) - Il servizio ha impiegato troppo tempo. Potrebbe essere riuscito comunque, controlla i dispositivi.'
+        }
+    except requests.exceptions.RequestException as e:
+        return {
+            'action': service,
+            'success': False,
+            'error': f'Errore connessione: {str(e)}'
+        }
+    except Exception as e:
+        print(f"Errore esecuzione azione: {e}")
+        import traceback
+        traceback.print_exc()
+        return {
+            'action': service,
+            'success': False,
+            'error': str(e)
         }
 
+def _call_entities(service_data):
+    entities = set(_entity_refs(service_data.get('entity_id')))
+    for key in ('device_id', 'area_id'):
+        entities.update(f"{key}:{value}" for value in _as_list(service_data.get(key)) if isinstance(value, str))
+    return entities
+
+def build_execution_plan(actions, concurrent=False, counter=None, top_level=True):
+    """Piano di esecuzione: ('seq', [nodi]) / ('par', [nodi]) / ('call', indice, servizio, dati).
+    
+    Gli indici seguono l'ordine del YAML, così i risultati restano ordinati.
+    """
+    if counter is None:
+        counter = [0]
+    steps = []
+    group = []  # chiamate indipendenti consecutive (solo modalità concorrente)
+    group_entities = set()
+    
+    def close_group():
+        if len(group) > 1:
+            steps.append(('par', list(group)))
+        else:
+            steps.extend(group)
+        group.clear()
+        group_entities.clear()
+    
+    for i, action in enumerate(_as_list(actions)):
+        if not isinstance(action, dict):
+            # Salta azioni non dict (probabilmente errori di parsing)
+            print(f"WARN: Azione {i+1} non è un dizionario, skip")
+            continue
+        if action.get('enabled') is False:
+            continue
+        
+        if 'parallel' in action:
+            close_group()
+            branches = []
+            for branch in _as_list(action['parallel']):
+                if isinstance(branch, dict) and 'sequence' in branch and len(branch) == 1:
+                    branch = branch['sequence']
+                node = build_execution_plan(branch, concurrent, counter, top_level=False)
+                if node[1]:
+                    branches.append(node)
+            if branches:
+                steps.append(('par', branches) if concurrent else ('seq', branches))
+            continue
+        
+        if 'sequence' in action and not action.get('service') and not action.get('action'):
+            close_group()
+            node = build_execution_plan(action['sequence'], concurrent, counter, top_level=False)
+            if node[1]:
+                steps.append(node)
+            continue
+        
+        prepared = prepare_service_call(action, i + 1)
+        if prepared is None:
+            # delay/wait e azioni non eseguibili: l'ordine prima/dopo va rispettato
+            close_group()
+            continue
+        
+        service, service_data = prepared
+        node = ('call', counter[0], service, service_data)
+        counter[0] += 1
+        
+        if not concurrent or not top_level:
+            steps.append(node)
+            continue
+        entities = _call_entities(service_data)
+        if not entities or entities & group_entities:
+            # Senza target (es. notifiche) o stesse entità: serve l'ordine
+            close_group()
+            if entities:
+                group.append(node)
+                group_entities.update(entities)
+            else:
+                steps.append(node)
+        else:
+            group.append(node)
+            group_entities.update(entities)
+    close_group()
+    
+    return ('seq', steps)
+
+def count_plan_calls(node):
+    if node[0] == 'call':
+        return 1
+    return sum(count_plan_calls(child) for child in node[1])
+
+def run_execution_plan(node, on_result):
+    """Esegue il piano; on_result(indice, risultato) viene chiamato per ogni azione"""
+    kind = node[0]
+    if kind == 'call':
+        _, index, service, service_data = node
+        on_result(index, call_service(service, service_data))
+    elif kind == 'seq':
+        for child in node[1]:
+            run_execution_plan(child, on_result)
+    elif kind == 'par':
+        with ThreadPoolExecutor(max_workers=min(len(node[1]), EXECUTE_MAX_PARALLEL)) as pool:
+            for future in [pool.submit(run_execution_plan, child, on_result) for child in node[1]]:
+                future.result()
+
+def start_execution_job(plan):
+    """Avvia l'esecuzione in background. Ritorna (job_id, evento di fine) o None se saturo"""
+    if not _execute_slots.acquire(blocking=False):
+        return None
+    try:
+        total = count_plan_calls(plan)
+        job_id = job_store.create('execute', meta={'total_actions': total})
+    except BaseException:
+        # Il worker non partirà: lo slot va restituito subito
+        _execute_slots.release()
+        raise
+    finished = threading.Event()
+    
+    def on_result(index, result):
+        job_store.add_progress(job_id, {'index': index, **result})
+    
+    def worker():
+        try:
+            run_execution_plan(plan, on_result)
+            job = job_store.get(job_id)
+            results = sorted(job['progress'], key=lambda r: r['index'])
+            job_store.finish(job_id, {
+                'success': all(r['success'] for r in results),
+                'results': results,
+                'total_actions': len(results)
+            })
+        except Exception as e:
+            print(f"Errore job esecuzione {job_id}: {e}")
+            import traceback
+            traceback.print_exc()
+            job_store.finish(job_id, error=str(e))
+        finally:
+            _execute_slots.release()
+            finished.set()
+    
+    try:
+        threading.Thread(target=worker, name=f"execute-{job_id[:8]}", daemon=True).start()
+    except BaseException:
+        _execute_slots.release()
+        job_store.finish(job_id, error='Impossibile avviare il job')
+        raise
+    return job_id, finished
+
+# ==================== RUNTIME JOB LLM ====================
+# Le chiamate a Gemini girano in un pool di thread limitato (per worker), con
+# una coda limitata: oltre LLM_MAX_PENDING richieste in volo si risponde 429
+# invece di bloccare il worker. Gli endpoint economici (entità, test, ...)
+# restano serviti dagli altri thread del worker gunicorn (gthread).
+
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '4'))
+LLM_MAX_PENDING = int(os.environ.get('LLM_MAX_PENDING', '32'))
+LLM_RETRY_AFTER = 5
+
+class LLMJobRuntime:
+    """Pool limitato per il lavoro LLM, con controllo di ammissione"""
+    
+    def __init__(self, max_concurrency, max_pending):
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = 0  # in coda + in esecuzione (inclusi gli stream)
+        self._running = 0
+        self._executor = None
+        self._pid = None
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm')
+                self._pid = os.getpid()
+            return self._executor
+    
+    def acquire(self):
+        """Ammissione di una richiesta; LLMBusyError se la coda è piena"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise LLMBusyError(f"{self._pending} richieste AI già in corso", retry_after=LLM_RETRY_AFTER)
+            self._pending += 1
+    
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+    
+    def submit(self, fn, *args, **kwargs):
+        """Accoda fn nel pool. Ritorna un Future"""
+        self.acquire()
+        
+        def task():
+            with self._lock:
+                self._running += 1
+            llm_inflight.labels('queued').dec()
+            llm_inflight.labels('running').inc()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                llm_inflight.labels('running').dec()
+                self.release()
+        
+        llm_inflight.labels('queued').inc()
+        try:
+            return self._get_executor().submit(task)
+        except Exception:
+            llm_inflight.labels('queued').dec()
+            self.release()
+            raise
+    
+    def run(self, fn, *args, **kwargs):
+        """Esegue fn nel pool e ne attende il risultato"""
+        return self.submit(fn, *args, **kwargs).result()
+    
+    def submit_job(self, kind, fn, *args, meta=None, progress=False, **kwargs):
+        """Come submit, ma con stato su job_store. Ritorna il job_id.
+        
+        Con progress=True fn riceve on_progress(item), salvato nel progresso del job.
+        """
+        self.acquire()
+        try:
+            job_id = job_store.create(kind, meta=meta, status='queued')
+        finally:
+            self.release()
+        if progress:
+            kwargs['on_progress'] = lambda item: job_store.add_progress(job_id, item)
+        
+        def job():
+            job_store.set_status(job_id, 'running')
+            try:
+                job_store.finish(job_id, fn(*args, **kwargs))
+            except Exception as e:
+                print(f"Errore job {kind} {job_id}: {e}")
+                import traceback
+                traceback.print_exc()
+                job_store.finish(job_id, error=str(e))
+        
+        try:
+            self.submit(job)
+        except LLMBusyError as e:
+            job_store.finish(job_id, error=str(e))
+            raise
+        return job_id
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._running,
+                'queued': self._pending - self._running,
+                'max_concurrency': self.max_concurrency,
+                'max_pending': self.max_pending
+            }
+
+llm_runtime = LLMJobRuntime(LLM_MAX_CONCURRENCY, LLM_MAX_PENDING)
+
+def llm_busy_response(error):
+    response = jsonify({'error': f"Servizio AI occupato: {error}. Riprova fra qualche secondo."})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+@app.before_request
+def metrics_start_timer():
+    g.metrics_started = time.perf_counter()
+
+@app.after_request
+def metrics_record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        # Route (template) e non path: etichette a cardinalità limitata
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_requests_total.labels(route, request.method, str(response.status_code)).inc()
+        http_request_duration_seconds.labels(route, request.method).observe(time.perf_counter() - started)
+    return response
+
+# ==================== AVVIO E READINESS ====================
+# Con gunicorn --preload i worker nascono dal master con moduli già importati;
+# warm-up (da post_worker_init in gunicorn.conf.py) scalda in background
+# registri HA, mirror, indice delle automazioni e SDK Gemini. /api/ready dice
+# quando i registri sono pronti.
+
+STARTED_AT = time.time()
+_ready_at = None
+_warm_up_lock = threading.Lock()
+_warm_up_pid = None  # pid del worker con warm-up in corso
+
+def registry_age(name):
+    """Età in secondi del registro nella cache condivisa (None se assente)"""
+    try:
+        return time.time() - os.path.getmtime(_registry_path(name))
+    except OSError:
+        return None
+
+def warm_up():
+    """Scalda il worker in un thread: registri in cache, mirror WebSocket, indice automazioni, SDK Gemini"""
+    global _warm_up_pid
+    with _warm_up_lock:
+        if _warm_up_pid == os.getpid():
+            return
+        _warm_up_pid = os.getpid()
+    
+    def worker():
+        global _warm_up_pid
+        try:
+            warm()
+        finally:
+            with _warm_up_lock:
+                _warm_up_pid = None
+    
+    def warm():
+        get_mirror()
+        for name in REGISTRY_ENDPOINTS:
+            age = registry_age(name)
+            if age is not None and age < REGISTRY_CACHE_TTL:
+                continue
+            try:
+                # Non bloccante: se un altro worker lo sta già scaricando basta attendere
+                _refresh_registry(name, blocking=False)
+            except Exception as e:
+                print(f"WARN: warm-up registro '{name}' fallito: {e}")
+        automation_index.current()
+        try:
+            get_genai()
+        except Exception as e:
+            print(f"WARN: warm-up SDK Gemini fallito: {e}")
+    
+    threading.Thread(target=worker, name='warm-up', daemon=True).start()
+
+@app.route('/api/ready', methods=['GET'])
+def api_ready():
+    """Readiness: 200 quando i registri HA sono in cache (o il mirror è connesso), altrimenti 503"""
+    global _ready_at
+    ages = {name: registry_age(name) for name in REGISTRY_ENDPOINTS}
+    primed = all(age is not None and age < REGISTRY_CACHE_TTL + REGISTRY_CACHE_STALE for age in ages.values())
+    mirror = get_mirror() is not None
+    ready = primed or mirror
+    if ready and _ready_at is None:
+        _ready_at = time.time()
+        print(f"Worker {os.getpid()} pronto in {_ready_at - STARTED_AT:.2f}s")
+    if not ready:
+        warm_up()
+    
+    response = jsonify({
+        'ready': ready,
+        'registries': {name: round(age, 1) if age is not None else None for name, age in ages.items()},
+        'mirror': mirror,
+        'sdk_loaded': _genai is not None,
+        'uptime': round(time.time() - STARTED_AT, 2),
+        'ready_after': round(_ready_at - STARTED_AT, 2) if _ready_at else None
+    })
+    response.status_code = 200 if ready else 503
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -635,19 +4063,303 @@ def index():
 def visualize():
     return render_template('visualize.html')
 
+ENTITIES_PAGE_SIZE = 100
+ENTITIES_MAX_PAGE_SIZE = 1000
+GZIP_MIN_SIZE = 1024
+
+_entities_responses = {}  # {(snapshot, query): (etag, body, body gzip)} - per worker
+_ENTITIES_RESPONSES_MAX = 32
+
+def entities_snapshot_key():
+    """Identifica lo snapshot corrente degli stati (per la memo delle risposte)"""
+    mirror = get_mirror()
+    if mirror is not None:
+        return ('mirror', id(mirror), mirror.version)
+    try:
+        return ('cache', os.stat(_registry_path('states')).st_mtime_ns)
+    except OSError:
+        return None
+
+def _project_entity_fields(entity, fields):
+    """Proiezione di uno stato: campi di primo livello, friendly_name o attributes.<nome>"""
+    item = {'entity_id': entity.get('entity_id')}
+    attributes = entity.get('attributes') or {}
+    for field in fields:
+        if field == 'friendly_name':
+            field = 'attributes.friendly_name'
+        if field.startswith('attributes.'):
+            name = field.split('.', 1)[1]
+            if name in attributes:
+                item.setdefault('attributes', {})[name] = attributes[name]
+        elif field in entity:
+            item[field] = entity[field]
+    return item
+
+def _encode_cursor(entity_id):
+    return base64.urlsafe_b64encode(entity_id.encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+
+def query_entities(entities, args):
+    """Filtra, ordina, proietta e pagina gli stati secondo i parametri della richiesta.
+    
+    Parametri: q (testo in entity_id/friendly_name), domain (lista separata da virgole),
+    fields (proiezione), limit, cursor (opaco, dalla risposta precedente).
+    """
+    search = (args.get('q') or '').strip().lower()
+    domains = {d.strip() for d in (args.get('domain') or '').split(',') if d.strip()}
+    fields = [f.strip() for f in (args.get('fields') or '').split(',') if f.strip() and f.strip() != 'entity_id']
+    limit = min(max(int(args.get('limit') or ENTITIES_PAGE_SIZE), 1), ENTITIES_MAX_PAGE_SIZE)
+    after = _decode_cursor(args['cursor']) if args.get('cursor') else None
+    
+    matched = []
+    for entity in entities:
+        if not isinstance(entity, dict) or 'entity_id' not in entity:
+            continue
+        entity_id = entity['entity_id']
+        if domains and entity_id.split('.', 1)[0] not in domains:
+            continue
+        if search:
+            friendly_name = ((entity.get('attributes') or {}).get('friendly_name') or '').lower()
+            if search not in entity_id.lower() and search not in friendly_name:
+                continue
+        matched.append(entity)
+    matched.sort(key=lambda e: e['entity_id'])
+    
+    start = 0
+    if after is not None:
+        # Primo entity_id successivo al cursore (ricerca binaria sulla lista ordinata)
+        lo, hi = 0, len(matched)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if matched[mid]['entity_id'] <= after:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+    page = matched[start:start + limit]
+    
+    return {
+        'entities': [_project_entity_fields(e, fields) for e in page] if fields else page,
+        'total': len(matched),
+        'next_cursor': _encode_cursor(page[-1]['entity_id']) if start + limit < len(matched) else None
+    }
+
 @app.route('/api/entities', methods=['GET'])
 def api_entities():
-    return jsonify(get_entities())
+    """Stati HA. Senza parametri: lista completa (compatibilità).
+    Con q/domain/fields/limit/cursor: {'entities', 'total', 'next_cursor'}.
+    Supporta ETag/If-None-Match e gzip.
+    """
+    query_keys = ('q', 'domain', 'fields', 'limit', 'cursor')
+    query = tuple((k, request.args.get(k)) for k in query_keys if request.args.get(k) is not None)
+    
+    # Prima i dati: get_entities() fa scattare TTL e refresh in background del
+    # registro anche quando la risposta è in memo (economico se fresco). Se lo
+    # snapshot cambia mentre si leggono i dati, la risposta non va in memo.
+    snapshot = entities_snapshot_key()
+    entities = get_entities()
+    if entities_snapshot_key() != snapshot:
+        snapshot = None
+    cached = _entities_responses.get((snapshot, query)) if snapshot is not None else None
+    if cached is None:
+        try:
+            payload = query_entities(entities, request.args) if query else entities
+        except (ValueError, UnicodeDecodeError) as e:
+            return jsonify({'error': f'Parametri non validi: {str(e)}'}), 400
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        body_gzip = gzip.compress(body, compresslevel=5) if len(body) >= GZIP_MIN_SIZE else None
+        cached = (etag, body, body_gzip)
+        if snapshot is not None:
+            if len(_entities_responses) >= _ENTITIES_RESPONSES_MAX:
+                _entities_responses.clear()
+            _entities_responses[(snapshot, query)] = cached
+    etag, body, body_gzip = cached
+    
+    use_gzip = body_gzip is not None and 'gzip' in request.headers.get('Accept-Encoding', '')
+    # ETag diverso per la versione compressa (rappresentazione diversa)
+    response_etag = etag + '-gz' if use_gzip else etag
+    if request.if_none_match.contains(response_etag) or request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body_gzip if use_gzip else body, mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(response_etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/cache/invalidate', methods=['POST'])
+def api_cache_invalidate():
+    """Invalida la cache condivisa di stati/servizi HA e/o le cache persistenti"""
+    data = request.get_json(silent=True) or {}
+    names = data.get('registries') or []
+    caches = data.get('caches') or []
+    if not names and not caches:
+        names = list(REGISTRY_ENDPOINTS)
+    unknown = [n for n in names if n not in REGISTRY_ENDPOINTS] + [c for c in caches if c not in PERSISTENT_CACHES]
+    if unknown:
+        return jsonify({'error': f"Cache sconosciute: {', '.join(unknown)}"}), 400
+    if names:
+        invalidate_registry_cache(*names)
+    for name in caches:
+        PERSISTENT_CACHES[name].clear()
+    return jsonify({'success': True, 'invalidated': names + caches})
+
+@app.route('/api/ha/stats', methods=['GET'])
+def api_ha_stats():
+    """Latenza delle chiamate al supervisor per endpoint (worker corrente)"""
+    return jsonify({'pid': os.getpid(), 'endpoints': ha_client_stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metriche Prometheus aggregate su tutti i worker"""
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    """Statistiche delle cache (età registri, hit/miss cache persistenti)"""
+    registries = {}
+    for name in REGISTRY_ENDPOINTS:
+        try:
+            age = time.time() - os.path.getmtime(_registry_path(name))
+        except OSError:
+            age = None
+        registries[name] = {'age': round(age, 1) if age is not None else None}
+    return jsonify({
+        'registries': registries,
+        'caches': {name: cache.stats() for name, cache in PERSISTENT_CACHES.items()},
+        'yaml_parse': yaml_parse_cache.stats(),
+        'automation_index': automation_index.stats()
+    })
+
+def parse_candidates(data):
+    """Numero di candidati richiesto (ValueError se non numerico), limitato a GENERATE_CANDIDATES_LIMIT"""
+    return min(max(int(data.get('candidates', GENERATE_CANDIDATES)), 1), GENERATE_CANDIDATES_LIMIT)
 
 @app.route('/api/generate', methods=['POST'])
 def api_generate():
     data = request.json
     description = data.get('description', '')
     selected_entities = data.get('entities', [])
+    use_cache = not data.get('no_cache', False)
+    if not description:
+        return jsonify({'error': 'Descrizione mancante'}), 400
+    try:
+        candidates = parse_candidates(data)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'candidates non valido'}), 400
+    
+    meta = {}
+    automation = get_cached_generation(description, selected_entities) if use_cache else None
+    if automation is not None:
+        meta['path'] = 'cache'
+    else:
+        try:
+            # Nel pool LLM limitato; la cache è già stata controllata
+            automation = llm_runtime.run(generate_automation, description, selected_entities, use_cache=False, meta=meta, candidates=candidates)
+        except LLMBusyError as e:
+            return llm_busy_response(e)
+    return jsonify({'automation': automation, 'generation': meta})
+
+@app.route('/api/generate/pipeline', methods=['POST'])
+def api_generate_pipeline():
+    """Genera → valida → corregge in una richiesta.
+    
+    Con "automation" salta la generazione e parte da quel YAML (es. appena
+    generato in streaming). "max_repairs" limita le correzioni, "async": true
+    ritorna un job_id con i tentativi nel progresso del job, "candidates"
+    genera più varianti in parallelo e tiene la migliore.
+    """
+    data = request.json
+    description = data.get('description', '')
+    selected_entities = data.get('entities', [])
+    automation = data.get('automation') or None
+    use_cache = not data.get('no_cache', False)
+    if not description:
+        return jsonify({'error': 'Descrizione mancante'}), 400
+    try:
+        max_repairs = min(max(int(data.get('max_repairs', PIPELINE_MAX_REPAIRS)), 0), PIPELINE_REPAIRS_LIMIT)
+        candidates = parse_candidates(data)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_repairs o candidates non valido'}), 400
+    
+    args = (run_generation_pipeline, description, selected_entities)
+    kwargs = {'automation': automation, 'max_repairs': max_repairs, 'use_cache': use_cache, 'candidates': candidates}
+    try:
+        if data.get('async', False):
+            job_id = llm_runtime.submit_job('pipeline', *args, progress=True, **kwargs)
+            return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+        return jsonify(llm_runtime.run(*args, **kwargs))
+    except LLMBusyError as e:
+        return llm_busy_response(e)
+
+def sse_event(event, data):
+    """Formatta un evento Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/generate/stream', methods=['POST'])
+def api_generate_stream():
+    """Come /api/generate, ma invia il YAML man mano che Gemini lo produce (SSE)"""
+    data = request.json
+    description = data.get('description', '')
+    selected_entities = data.get('entities', [])
+    use_cache = not data.get('no_cache', False)
     if not description:
         return jsonify({'error': 'Descrizione mancante'}), 400
-    automation = generate_automation(description, selected_entities)
-    return jsonify({'automation': automation})
+    
+    cached = get_cached_generation(description, selected_entities) if use_cache else None
+    if cached is None:
+        # Lo stream gira nel thread della richiesta ma conta fra le richieste AI in volo
+        try:
+            llm_runtime.acquire()
+        except LLMBusyError as e:
+            return llm_busy_response(e)
+        llm_inflight.labels('streaming').inc()
+    released = []
+    release_lock = threading.Lock()
+    
+    def release():
+        # Una sola volta: dal generatore o dalla chiusura della risposta se il
+        # client se ne va prima che il generatore parta
+        with release_lock:
+            if cached is not None or released:
+                return
+            released.append(True)
+        llm_inflight.labels('streaming').dec()
+        llm_runtime.release()
+    
+    def generate():
+        if cached is not None:
+            yield sse_event('chunk', {'text': cached})
+            yield sse_event('done', {'automation': cached})
+            return
+        parts = []
+        try:
+            for text in generate_automation_stream(description, selected_entities, use_cache=False):
+                parts.append(text)
+                yield sse_event('chunk', {'text': text})
+            yield sse_event('done', {'automation': ''.join(parts)})
+        except LLMBusyError as e:
+            yield sse_event('error', {'error': f"Servizio AI occupato: {e}. Riprova fra qualche secondo.", 'retry_after': e.retry_after})
+        except Exception as e:
+            print(f"Errore generazione streaming: {e}")
+            import traceback
+            traceback.print_exc()
+            yield sse_event('error', {'error': f"Errore generazione: {str(e)}"})
+        finally:
+            release()
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Ingress (nginx) non deve bufferizzare lo stream
+    })
+    response.call_on_close(release)
+    return response
 
 @app.route('/api/test', methods=['POST'])
 def api_test():
@@ -663,189 +4375,86 @@ def api_test():
     
     return jsonify(test_result)
 
+@app.route('/api/validate/incremental', methods=['POST'])
+def api_validate_incremental():
+    """Validazione per l'editor (chiamata a ogni modifica, con debounce).
+    
+    "session" identifica l'editor: fra due chiamate della stessa sessione
+    vengono rivalidati solo i blocchi cambiati. Le diagnostiche hanno riga e
+    colonna (base 1) nel testo inviato.
+    """
+    data = request.json or {}
+    yaml_text = data.get('automation', '')
+    session_id = str(data.get('session') or uuid.uuid4().hex)
+    if not yaml_text.strip():
+        return jsonify({'error': 'YAML mancante'}), 400
+    result = validate_incremental(session_id, yaml_text)
+    return jsonify({**result, 'session': session_id})
+
 @app.route('/api/execute', methods=['POST'])
 def api_execute():
-    """Endpoint per eseguire automazione in modalità test"""
+    """Endpoint per eseguire automazione in modalità test.
+    
+    Opzioni: "concurrent": true esegue insieme le azioni indipendenti,
+    "async": true ritorna subito un job_id (stato su /api/jobs/<id>).
+    """
     data = request.json
     yaml_text = data.get('automation', '')
     
     if not yaml_text:
         return jsonify({'error': 'YAML mancante'}), 400
     
-    headers = {
-        "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    
     try:
         # Parse automazione
-        automation = yaml.safe_load(yaml_text)
+        automation = parse_yaml(yaml_text)
         
         # Estrai le azioni
-        actions = automation.get('action', [])
+        actions = automation.get('actions', automation.get('action', []))
         if not isinstance(actions, list):
             actions = [actions]
         
-        if not actions:
+        plan = build_execution_plan(actions, concurrent=bool(data.get('concurrent', False)))
+        if not actions or not plan[1]:
             return jsonify({
                 'success': False,
                 'error': 'Nessuna azione da eseguire'
             })
         
-        # Esegui le azioni una per una
-        results = []
-        all_success = True
+        started = start_execution_job(plan)
+        if started is None:
+            return jsonify({
+                'success': False,
+                'error': 'Troppe esecuzioni in corso, riprova fra poco'
+            }), 429
+        job_id, finished = started
         
-        for i, action in enumerate(actions):
-            if not isinstance(action, dict):
-                # Salta azioni non dict (probabilmente errori di parsing)
-                print(f"WARN: Azione {i+1} non è un dizionario, skip")
-                continue
-            
-            # Estrai servizio (supporta vari formati)
-            service = action.get('service') or action.get('action')
-            
-            if not service:
-                # Prova a inferire dal tipo di azione
-                if 'scene' in action:
-                    service = 'scene.turn_on'
-                elif 'event' in action:
-                    service = 'event.fire'
-                else:
-                    # Salta silenziosamente azioni senza servizio valido
-                    # (probabilmente azioni di delay, wait, ecc)
-                    if 'delay' in action or 'wait_template' in action or 'wait_for_trigger' in action:
-                        print(f"INFO: Azione {i+1} è wait/delay, skip esecuzione")
-                        continue
-                    
-                    print(f"WARN: Azione {i+1} senza servizio riconosciuto: {action}")
-                    # Non aggiungiamo più errore, skippiamo solo
-                    continue
-            
-            # Prepara dati per chiamata servizio
-            service_data = {}
-            
-            # Entity ID (vari formati)
-            if 'entity_id' in action:
-                service_data['entity_id'] = action['entity_id']
-            
-            # Target (nuovo formato HA)
-            if 'target' in action:
-                # Il target va dentro service_data
-                target = action['target']
-                if isinstance(target, dict):
-                    if 'entity_id' in target:
-                        service_data['entity_id'] = target['entity_id']
-                    if 'device_id' in target:
-                        service_data['device_id'] = target['device_id']
-                    if 'area_id' in target:
-                        service_data['area_id'] = target['area_id']
-            
-            # Data aggiuntivi (per notifiche, ecc.)
-            if 'data' in action:
-                # Merge dei data
-                action_data = action['data']
-                if isinstance(action_data, dict):
-                    for key, value in action_data.items():
-                        service_data[key] = value
-            
-            # Scene specifico
-            if 'scene' in action:
-                service_data['entity_id'] = action['scene']
-            
-            # Event specifico
-            if 'event' in action:
-                service_data['event_type'] = action['event']
-            
-            # Chiama il servizio
-            try:
-                if '.' in service:
-                    domain, service_name = service.split('.', 1)
-                else:
-                    results.append({
-                        'action': service,
-                        'success': False,
-                        'error': 'Formato servizio non valido (manca dominio)'
-                    })
-                    all_success = False
-                    continue
-                
-                print(f"Chiamata servizio: {domain}/{service_name}")
-                print(f"Dati: {service_data}")
-                
-                # Timeout dinamico basato sul servizio
-                timeout = 30  # Default 30 secondi
-                if domain == 'camera':
-                    timeout = 60  # Camera record/snapshot possono richiedere più tempo
-                elif domain == 'media_player':
-                    timeout = 20  # Media player può essere lento
-                
-                response = requests.post(
-                    f"{HA_URL}/services/{domain}/{service_name}",
-                    headers=headers,
-                    json=service_data,
-                    timeout=timeout
-                )
-                
-                print(f"Response status: {response.status_code}")
-                print(f"Response text: {response.text[:200] if response.text else 'empty'}")
-                
-                if response.status_code == 200:
-                    # Determina descrizione azione
-                    action_desc = service
-                    if 'entity_id' in service_data:
-                        entity = service_data['entity_id']
-                        if isinstance(entity, list):
-                            entity = f"{entity[0]} (+{len(entity)-1})" if len(entity) > 1 else entity[0]
-                        action_desc = f"{service} → {entity}"
-                    elif 'message' in service_data:
-                        msg = service_data['message'][:30] + "..." if len(service_data['message']) > 30 else service_data['message']
-                        action_desc = f"{service} → \"{msg}\""
-                    
-                    results.append({
-                        'action': action_desc,
-                        'success': True,
-                        'response': 'Eseguito con successo'
-                    })
-                else:
-                    error_msg = response.text if response.text else f'HTTP {response.status_code}'
-                    results.append({
-                        'action': service,
-                        'success': False,
-                        'error': error_msg
-                    })
-                    all_success = False
-                    
-            except requests.exceptions.Timeout:
-                results.append({
-                    'action': service,
-                    'success': False,
-                    'error': f'Timeout (>{timeout}s) - Il servizio ha impiegato troppo tempo. Potrebbe essere riuscito comunque, controlla i dispositivi.'
-                })
-                all_success = False
-            except requests.exceptions.RequestException as e:
-                results.append({
-                    'action': service,
-                    'success': False,
-                    'error': f'Errore connessione: {str(e)}'
-                })
-                all_success = False
-            except Exception as e:
-                print(f"Errore esecuzione azione: {e}")
-                import traceback
-                traceback.print_exc()
-                results.append({
-                    'action': service,
+        if data.get('async', False):
+            return jsonify({
+                'job_id': job_id,
+                'status': 'running',
+                'total_actions': count_plan_calls(plan)
+            }), 202
+        
+        # Sincrono, ma con un limite: oltre la scadenza ritorna i parziali e il job_id
+        if finished.wait(EXECUTE_SYNC_DEADLINE):
+            job = job_store.get(job_id)
+            if job['status'] == 'error':
+                return jsonify({
                     'success': False,
-                    'error': str(e)
-                })
-                all_success = False
+                    'error': f"Errore esecuzione: {job['error']}"
+                }), 500
+            return jsonify({**job['result'], 'job_id': job_id})
         
+        job = job_store.get(job_id)
+        results = sorted(job['progress'], key=lambda r: r['index'])
         return jsonify({
-            'success': all_success,
+            'success': False,
+            'pending': True,
+            'job_id': job_id,
             'results': results,
-            'total_actions': len(results)
-        })
+            'total_actions': count_plan_calls(plan),
+            'error': 'Alcune azioni sono ancora in esecuzione, controlla lo stato del job'
+        }), 202
         
     except yaml.YAMLError as e:
         return jsonify({
@@ -861,6 +4470,538 @@ def api_execute():
             'error': f'Errore esecuzione: {str(e)}'
         }), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_status(job_id):
+    """Stato di un job in background (qualsiasi worker può rispondere)"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job non trovato'}), 404
+    job['progress'] = sorted(job['progress'], key=lambda r: r.get('index', 0))
+    return jsonify(job)
+
+AUTOMATIONS_PATHS = [
+    '/homeassistant/automations.yaml',
+    '/config/automations.yaml',
+    '/data/automations.yaml',
+    '/usr/share/hassio/homeassistant/automations.yaml'
+]
+
+def find_automations_file():
+    """Ritorna il percorso di automations.yaml (o None se non trovato)"""
+    for path in AUTOMATIONS_PATHS:
+        if os.path.isfile(path):
+            return path
+    return None
+
+# ==================== INDICE AUTOMAZIONI ESISTENTI ====================
+# Indice invertito delle automazioni già presenti in HA: entity_id, servizio e
+# piattaforma di trigger -> id delle automazioni. La parte da automations.yaml
+# si aggiorna quando cambiano mtime/dimensione del file, riparsando solo le
+# automazioni il cui testo è cambiato (i record sono anche in cache persistente
+# per firma del file: l'altro worker non riparsa); le automation.* che il file
+# non contiene arrivano da /config/automation/config. Gli aggiornamenti girano
+# in background (warm-up all'avvio) e ogni snapshot è immutabile, sostituito in
+# blocco: test_automation() segnala duplicati e conflitti con una lookup per
+# riferimento anche con migliaia di automazioni.
+
+AUTOMATION_INDEX_API_TTL = int(os.environ.get('AUTOMATION_INDEX_API_TTL', '600'))
+AUTOMATION_INDEX_API_MAX_AGE = 3600  # record scaricati dall'API più vecchi vengono riscaricati
+AUTOMATION_INDEX_API_PARALLEL = 8
+AUTOMATION_INDEX_FIRST_WAIT = 3.0  # attesa massima della prima costruzione dell'indice in test_automation
+AUTOMATION_INDEX_RELATED_MAX = 5  # automazioni correlate riportate da test_automation
+# Campi che non cambiano il comportamento (esclusi dall'impronta dei duplicati)
+AUTOMATION_META_KEYS = ('id', 'alias', 'description')
+TRIGGER_META_KEYS = ('id', 'alias', 'enabled', 'variables', 'platform', 'trigger', 'entity_id')
+SECTION_ALIASES = {'triggers': 'trigger', 'conditions': 'condition', 'actions': 'action'}
+
+automation_index_cache = PersistentCache(
+    'automation_index',
+    ttl=float(os.environ.get('AUTOMATION_INDEX_CACHE_TTL', str(7 * 24 * 3600))),
+    max_entries=4,
+    max_bytes=int(os.environ.get('AUTOMATION_INDEX_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+)
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str, separators=(',', ':'))
+
+def automation_record(automation_id, automation, source):
+    """Riferimenti di un'automazione già parsata, nel formato (JSON) dell'indice"""
+    normalized = {SECTION_ALIASES.get(k, k): v for k, v in automation.items()}
+    entities, services, actions = set(), set(), set()
+    
+    def walk(value, in_action):
+        if isinstance(value, dict):
+            service = value.get('service') or value.get('action')
+            if isinstance(service, str) and '.' in service and not _is_template(service):
+                services.add(service)
+                if in_action:
+                    actions.update((entity_id, service) for entity_id in _action_entities(value))
+            for key, item in value.items():
+                if key == 'entity_id':
+                    entities.update(_entity_refs(item))
+                elif key == 'scene' and isinstance(item, str) and not _is_template(item):
+                    entities.add(item)
+                else:
+                    walk(item, in_action)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item, in_action)
+    
+    walk(normalized.get('trigger'), False)
+    walk(normalized.get('condition'), False)
+    walk(normalized.get('action'), True)
+    
+    platforms, triggers = set(), set()
+    for trigger in _as_list(normalized.get('trigger')):
+        if not isinstance(trigger, dict):
+            continue
+        platform = trigger.get('platform', trigger.get('trigger'))
+        platforms.add(str(platform))
+        rest = {k: v for k, v in trigger.items() if k not in TRIGGER_META_KEYS}
+        # Un trigger su più entità vale come un trigger per entità
+        for entity_id in _entity_refs(trigger.get('entity_id')) or [None]:
+            triggers.add(_canonical([platform, entity_id, rest]))
+    
+    behaviour = {k: v for k, v in normalized.items() if k not in AUTOMATION_META_KEYS}
+    behaviour.setdefault('mode', 'single')
+    alias = automation.get('alias')
+    return {
+        'id': automation_id,
+        'alias': alias if isinstance(alias, str) else None,
+        'source': source,
+        'entities': sorted(entities),
+        'services': sorted(services),
+        'platforms': sorted(platforms),
+        'triggers': sorted(triggers),
+        'actions': sorted([entity_id, service] for entity_id, service in actions),
+        'fingerprint': hashlib.sha1(_canonical(behaviour).encode('utf-8')).hexdigest()
+    }
+
+def _add_posting(postings, key, automation_id):
+    ids = postings.get(key)
+    if ids is None:
+        postings[key] = ids = set()
+    ids.add(automation_id)
+
+class AutomationIndexSnapshot:
+    """Liste di posting (riferimento -> set di id) di un insieme di record; in sola lettura"""
+    
+    def __init__(self, records):
+        self.records = records  # {id: record}
+        self.by_entity = {}
+        self.by_service = {}
+        self.by_platform = {}
+        self.by_trigger = {}
+        self.by_fingerprint = {}
+        self.by_alias = {}
+        self.actions = {}  # {id: {entity_id: set(servizi)}}
+        for automation_id, record in records.items():
+            for entity_id in record['entities']:
+                _add_posting(self.by_entity, entity_id, automation_id)
+            for service in record['services']:
+                _add_posting(self.by_service, service, automation_id)
+            for platform in record['platforms']:
+                _add_posting(self.by_platform, platform, automation_id)
+            for trigger in record['triggers']:
+                _add_posting(self.by_trigger, trigger, automation_id)
+            _add_posting(self.by_fingerprint, record['fingerprint'], automation_id)
+            if record['alias']:
+                _add_posting(self.by_alias, record['alias'].strip().lower(), automation_id)
+            action_map = self.actions[automation_id] = {}
+            for entity_id, service in record['actions']:
+                action_map.setdefault(entity_id, set()).add(service)
+    
+    def query(self, entity_ids=(), services=(), platforms=()):
+        """Id delle automazioni che soddisfano tutti i filtri (ogni filtro: uno qualsiasi dei valori)"""
+        matches = None
+        for postings, values in ((self.by_entity, entity_ids), (self.by_service, services), (self.by_platform, platforms)):
+            if not values:
+                continue
+            ids = set().union(*(postings.get(value, ()) for value in values))
+            matches = ids if matches is None else matches & ids
+        return sorted(matches) if matches is not None else []
+    
+    def related(self, automation):
+        """Automazioni esistenti duplicate o in conflitto con automation: {id: [(motivo, dettaglio)]}"""
+        # Id come stringa, come nell'indice (id: 1700000000000 senza virgolette è un int)
+        record = automation_record(str(automation['id']) if automation.get('id') else None, automation, 'test')
+        own_id = record['id']
+        found = {}
+        
+        def add(automation_id, reason, detail=None):
+            if automation_id != own_id:
+                found.setdefault(automation_id, []).append((reason, detail))
+        
+        for automation_id in self.by_fingerprint.get(record['fingerprint'], ()):
+            add(automation_id, 'duplicate')
+        if record['alias']:
+            for automation_id in self.by_alias.get(record['alias'].strip().lower(), ()):
+                add(automation_id, 'alias')
+        
+        # Stesso trigger e azione sulla stessa entità: servizio uguale o diverso
+        same_trigger = set()
+        for trigger in record['triggers']:
+            same_trigger.update(self.by_trigger.get(trigger, ()))
+        same_trigger.discard(own_id)
+        for automation_id in same_trigger:
+            if any(reason == 'duplicate' for reason, _ in found.get(automation_id, ())):
+                continue
+            action_map = self.actions.get(automation_id, {})
+            for entity_id, service in record['actions']:
+                existing = action_map.get(entity_id)
+                if not existing:
+                    continue
+                if service in existing:
+                    add(automation_id, 'same_action', (entity_id, service, sorted(existing)))
+                else:
+                    add(automation_id, 'conflict', (entity_id, service, sorted(existing)))
+        return found
+
+def split_automation_items(text):
+    """Elementi di primo livello di automations.yaml come testi separati.
+    
+    HA scrive il file come lista a blocchi con ogni automazione che inizia con
+    "- " in colonna 0: basta tagliare lì. None se il file ha un'altra forma.
+    """
+    starts = [m.start() for m in re.finditer(r'^-(?: |$)', text, re.M)]
+    if not starts:
+        return None
+    header = text[:starts[0]].splitlines()
+    if any(line.strip() and not line.lstrip().startswith('#') and line.strip() != '---' for line in header):
+        return None
+    return [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)])]
+
+class AutomationIndex:
+    """Indice delle automazioni di questo worker, aggiornato in background (mtime del file, TTL API)"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._file_signature = None
+        self._file_records = {}
+        self._item_records = {}  # {sha1 del testo di un elemento: record}, per il parsing incrementale
+        self._api_records = {}  # {id: record} automazioni non presenti nel file
+        self._api_checked = 0
+        self._snapshot = AutomationIndexSnapshot({})
+        self._built = threading.Event()  # prima costruzione completata
+        self._attempted = threading.Event()  # primo tentativo finito (anche fallito)
+        self.builds = 0
+        self.last_build_ms = None
+        self.last_parsed = None  # elementi riparsati all'ultimo cambio del file
+    
+    @property
+    def ready(self):
+        return self._built.is_set()
+    
+    def current(self, wait=0):
+        """Snapshot corrente: se il file è cambiato o l'API è scaduta aggiorna in background.
+        
+        Con wait > 0 attende il primo tentativo di costruzione al massimo wait secondi.
+        """
+        if self._file_stat() != self._file_signature or time.time() - self._api_checked > AUTOMATION_INDEX_API_TTL:
+            self._refresh_background()
+        if wait and not self._attempted.is_set():
+            self._attempted.wait(wait)
+        return self._snapshot
+    
+    def invalidate(self, automation_id=None):
+        """Dopo un'installazione: riscarica dall'API (il file si aggiorna da solo per mtime)"""
+        with self._lock:
+            self._api_records.pop(automation_id, None)
+            self._api_checked = 0
+    
+    def _file_stat(self):
+        path = find_automations_file()
+        if not path:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [path, st.st_mtime_ns, st.st_size]
+    
+    def _refresh_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        
+        def worker():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"WARN: aggiornamento indice automazioni fallito: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        
+        threading.Thread(target=worker, name='automation-index', daemon=True).start()
+    
+    def refresh(self):
+        """Aggiorna (bloccante) la parte del file se cambiata e quella dell'API se scaduta"""
+        try:
+            self._update()
+            self._built.set()
+        finally:
+            # Anche se fallisce: le attese successive non ripartono da capo
+            self._attempted.set()
+    
+    def _update(self):
+        changed = False
+        signature = self._file_stat()
+        if signature != self._file_signature:
+            self._file_records = self._load_file(signature) if signature else {}
+            self._file_signature = signature
+            changed = True
+        if time.time() - self._api_checked > AUTOMATION_INDEX_API_TTL:
+            self._api_checked = time.time()
+            try:
+                changed = self._refresh_api() or changed
+            except Exception as e:
+                print(f"WARN: indice automazioni, automazioni da API non aggiornate: {e}")
+        if changed:
+            started = time.perf_counter()
+            records = dict(self._api_records)
+            records.update(self._file_records)
+            self._snapshot = AutomationIndexSnapshot(records)
+            self.builds += 1
+            self.last_build_ms = round((time.perf_counter() - started) * 1000, 1)
+    
+    def _load_file(self, signature):
+        key = _canonical(signature)
+        records = automation_index_cache.get(key)
+        if records is not None:
+            return records
+        try:
+            with open(signature[0], 'r', encoding='utf-8') as f:
+                records = self._parse_records(f.read())
+        except (OSError, yaml.YAMLError) as e:
+            print(f"WARN: indice automazioni, impossibile leggere {signature[0]}: {e}")
+            return self._file_records
+        automation_index_cache.set(key, records)
+        return records
+    
+    @staticmethod
+    def _item_record(automation):
+        if not isinstance(automation, dict):
+            return None
+        return automation_record(str(automation['id']) if automation.get('id') else None, automation, 'file')
+    
+    def _parse_records(self, text):
+        """Record di tutte le automazioni del file, riparsando solo gli elementi cambiati.
+        
+        Usa il loader direttamente (non parse_yaml): i testi dei singoli elementi
+        riempirebbero la cache condivisa e i risultati non servono ad altri.
+        """
+        entries = None
+        items = split_automation_items(text)
+        if items is not None:
+            memo, entries, parsed = {}, [], 0
+            for item in items:
+                digest = hashlib.sha1(item.encode('utf-8')).hexdigest()
+                if digest in memo or digest in self._item_records:
+                    record = memo.get(digest) or self._item_records[digest]
+                else:
+                    try:
+                        automations = yaml.load(item, Loader=YamlSafeLoader)
+                    except yaml.YAMLError:
+                        automations = None
+                    if not (isinstance(automations, list) and len(automations) == 1):
+                        # Ancore fra elementi o forma inattesa: parsing completo
+                        entries = None
+                        break
+                    record = self._item_record(automations[0])
+                    parsed += 1
+                memo[digest] = record
+                entries.append(record)
+        if entries is None:
+            automations = yaml.load(text, Loader=YamlSafeLoader) or []
+            entries = [self._item_record(automation) for automation in _as_list(automations)]
+            memo, parsed = {}, len(entries)
+        self._item_records = memo
+        self.last_parsed = parsed
+        
+        records = {}
+        for position, record in enumerate(entries):
+            if record is None:
+                continue
+            automation_id = record['id'] or f"#{position}"
+            records[automation_id] = record if record['id'] else dict(record, id=automation_id)
+        return records
+    
+    def _refresh_api(self):
+        """Scarica da /config/automation/config le automation.* che il file non contiene"""
+        ids = {
+            str(s['attributes']['id'])
+            for s in get_registry('states')
+            if s.get('entity_id', '').startswith('automation.') and (s.get('attributes') or {}).get('id')
+        }
+        now = time.time()
+        file_records = self._file_records
+        kept = {
+            automation_id: record for automation_id, record in self._api_records.items()
+            if automation_id in ids and now - record.get('fetched', 0) < AUTOMATION_INDEX_API_MAX_AGE
+        }
+        missing = [automation_id for automation_id in ids if automation_id not in file_records and automation_id not in kept]
+        
+        def fetch(automation_id):
+            try:
+                response = ha_request('GET', f"config/automation/config/{automation_id}")
+                config = response.json() if response.status_code == 200 else None
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"WARN: automazione {automation_id} non scaricata: {e}")
+                return automation_id, None
+            return automation_id, config if isinstance(config, dict) else None
+        
+        if missing:
+            with ThreadPoolExecutor(max_workers=AUTOMATION_INDEX_API_PARALLEL, thread_name_prefix='automation-index') as pool:
+                for automation_id, config in pool.map(fetch, missing):
+                    if config is not None:
+                        kept[automation_id] = dict(automation_record(automation_id, config, 'api'), fetched=now)
+        
+        changed = kept.keys() != self._api_records.keys() or bool(missing)
+        self._api_records = kept
+        return changed
+    
+    def stats(self):
+        snapshot = self._snapshot
+        sources = {}
+        for record in snapshot.records.values():
+            sources[record['source']] = sources.get(record['source'], 0) + 1
+        return {
+            'ready': self.ready,
+            'automations': len(snapshot.records),
+            'sources': sources,
+            'entities': len(snapshot.by_entity),
+            'services': len(snapshot.by_service),
+            'file': self._file_signature[0] if self._file_signature else None,
+            'builds': self.builds,
+            'last_build_ms': self.last_build_ms,
+            'last_parsed': self.last_parsed,
+            'api_checked_age': round(time.time() - self._api_checked, 1) if self._api_checked else None,
+            'refreshing': self._refreshing
+        }
+
+automation_index = AutomationIndex()
+
+def check_existing_automations(automation, result):
+    """Aggiunge a result (di test_automation) gli avvisi su automazioni esistenti duplicate o in conflitto"""
+    try:
+        snapshot = automation_index.current(wait=AUTOMATION_INDEX_FIRST_WAIT)
+        if not automation_index.ready:
+            # Indice vuoto perché non ancora costruito: non è un "nessun duplicato"
+            result['index_pending'] = True
+            result['warnings'].append("Confronto con le automazioni esistenti non ancora disponibile (indice in costruzione): riprova fra poco")
+            return result
+        found = snapshot.related(automation)
+    except Exception as e:
+        print(f"WARN: confronto con le automazioni esistenti non riuscito: {e}")
+        return result
+    result['index_pending'] = False
+    
+    related = []
+    for automation_id, reasons in sorted(found.items())[:AUTOMATION_INDEX_RELATED_MAX]:
+        record = snapshot.records.get(automation_id, {})
+        name = f"'{record.get('alias') or automation_id}' ({automation_id})"
+        for reason, detail in reasons:
+            if reason == 'duplicate':
+                message = f"Esiste già un'automazione identica: {name}"
+            elif reason == 'alias':
+                message = f"Alias già usato dall'automazione {name}"
+            elif reason == 'conflict':
+                entity_id, service, existing = detail
+                message = (f"Possibile conflitto con {name}: stesso trigger, ma su {entity_id} "
+                           f"usa {', '.join(existing)} invece di {service}")
+            else:
+                entity_id, service, _ = detail
+                message = f"L'automazione {name} ha già lo stesso trigger e chiama {service} su {entity_id}"
+            if message not in result['warnings']:
+                result['warnings'].append(message)
+        related.append({
+            'id': automation_id,
+            'alias': record.get('alias'),
+            'reasons': sorted({reason for reason, _ in reasons})
+        })
+    if len(found) > AUTOMATION_INDEX_RELATED_MAX:
+        result['warnings'].append(f"...e altre {len(found) - AUTOMATION_INDEX_RELATED_MAX} automazioni esistenti correlate")
+    result['related_automations'] = related
+    return result
+
+def _query_values(name):
+    """Valori di un parametro ripetibile e/o separato da virgole"""
+    return [v.strip() for item in request.args.getlist(name) for v in item.split(',') if v.strip()]
+
+@app.route('/api/automations/index', methods=['GET'])
+def api_automations_index():
+    """Automazioni esistenti che usano entità, servizi o piattaforme di trigger.
+    
+    GET ?entity_id=light.cucina&service=light.turn_on&platform=state
+    Ogni parametro si può ripetere (o separare con virgole): vale uno qualsiasi
+    dei valori, i parametri diversi sono in AND. Senza filtri: solo statistiche.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({'error': 'limit deve essere un numero'}), 400
+    entity_ids = _query_values('entity_id')
+    services = _query_values('service')
+    platforms = _query_values('platform')
+    
+    snapshot = automation_index.current()
+    ids = snapshot.query(entity_ids, services, platforms)
+    automations = []
+    for automation_id in ids[:limit]:
+        record = snapshot.records[automation_id]
+        automations.append({
+            'id': automation_id,
+            'alias': record['alias'],
+            'source': record['source'],
+            'platforms': record['platforms'],
+            'services': record['services']
+        })
+    return jsonify({
+        'count': len(ids),
+        'automations': automations,
+        'truncated': len(ids) > limit,
+        'index': automation_index.stats()
+    })
+
+@app.route('/api/test_batch', methods=['GET', 'POST'])
+def api_test_batch():
+    """Valida molte automazioni in una richiesta, risultati in streaming NDJSON.
+    
+    POST {"automations": [...]}  lista di dizionari o testi YAML
+    POST {"yaml": "..."}         contenuto completo di un automations.yaml
+    GET / POST {}                legge automations.yaml di Home Assistant
+    """
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        if 'automations' in data:
+            automations = data['automations']
+        else:
+            yaml_text = data.get('yaml')
+            if yaml_text is None:
+                path = find_automations_file()
+                if not path:
+                    return jsonify({'error': 'automations.yaml non trovato'}), 404
+                with open(path, 'r', encoding='utf-8') as f:
+                    yaml_text = f.read()
+            automations = parse_yaml(yaml_text) or []
+    except yaml.YAMLError as e:
+        return jsonify({'error': f'YAML non valido: {str(e)}'}), 400
+    except OSError as e:
+        return jsonify({'error': f'Impossibile leggere automations.yaml: {str(e)}'}), 500
+    
+    if not isinstance(automations, list):
+        return jsonify({'error': 'Serve una lista di automazioni'}), 400
+    
+    def generate():
+        for result in validate_automations_batch(automations):
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/api/debug_automations', methods=['GET'])
 def api_debug_automations():
     """Debug endpoint per verificare dove sono le automazioni"""
@@ -873,14 +5014,7 @@ def api_debug_automations():
         }
         
         # 1. Controlla vari percorsi possibili
-        possible_paths = [
-            '/homeassistant/automations.yaml',
-            '/config/automations.yaml',
-            '/data/automations.yaml',
-            '/usr/share/hassio/homeassistant/automations.yaml'
-        ]
-        
-        for path in possible_paths:
+        for path in AUTOMATIONS_PATHS:
             debug_info['paths_checked'].append({
                 'path': path,
                 'exists': os.path.exists(path),
@@ -901,7 +5035,7 @@ def api_debug_automations():
                         'size': len(content),
                         'lines': len(content.split('\n')),
                         'preview': content[:500] if len(content) > 500 else content,
-                        'automations_count': len(yaml.safe_load(content)) if content.strip() else 0
+                        'automations_count': len(parse_yaml(content) or []) if content.strip() else 0
                     }
                     break
             except Exception as e:
@@ -910,6 +5044,9 @@ def api_debug_automations():
                     'error': str(e)
                 }
         
+        automation_index.current()
+        debug_info['index'] = automation_index.stats()
+        
         # 3. Controlla configuration.yaml
         config_paths = [
             '/homeassistant/configuration.yaml',
@@ -933,26 +5070,14 @@ def api_debug_automations():
                         'error': str(e)
                     }
         
-        # 4. Controlla automazioni via API HA
-        headers = {
-            "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
+        # 4. Controlla automazioni via API HA (stati dalla cache condivisa)
         try:
-            states_response = requests.get(
-                f"{HA_URL}/states",
-                headers=headers,
-                timeout=10
-            )
-            
-            if states_response.status_code == 200:
-                states = states_response.json()
-                automations = [s for s in states if s.get('entity_id', '').startswith('automation.')]
-                debug_info['ha_automations'] = {
-                    'count': len(automations),
-                    'list': [a.get('attributes', {}).get('friendly_name', a.get('entity_id')) for a in automations[:10]]
-                }
+            states = get_registry('states')
+            automations = [s for s in states if s.get('entity_id', '').startswith('automation.')]
+            debug_info['ha_automations'] = {
+                'count': len(automations),
+                'list': [a.get('attributes', {}).get('friendly_name', a.get('entity_id')) for a in automations[:10]]
+            }
         except Exception as e:
             debug_info['ha_automations'] = {
                 'error': str(e)
@@ -977,8 +5102,8 @@ def api_install():
         return jsonify({'error': 'YAML mancante'}), 400
     
     try:
-        # 1. Parse YAML per validazione
-        automation = yaml.safe_load(yaml_text)
+        # 1. Parse YAML per validazione (copia: qui l'automazione viene modificata)
+        automation = thaw(parse_yaml(yaml_text))
         
         # 2. Controlla che abbia alias (obbligatorio per identificazione)
         if 'alias' not in automation:
@@ -999,11 +5124,6 @@ def api_install():
         print(f"Installazione automazione: {alias} (ID: {automation_id})")
         
         # 4. USA L'API DI HOME ASSISTANT per creare l'automazione
-        headers = {
-            "Authorization": f"Bearer {SUPERVISOR_TOKEN}",
-            "Content-Type": "application/json",
-        }
-        
         # Converti automation in formato API
         # Rimuovi 'id' e 'alias' perché l'API li gestisce diversamente
         automation_config = dict(automation)
@@ -1031,29 +5151,27 @@ def api_install():
         # Crea l'automazione via API
         try:
             # Endpoint per creare automazione
-            create_response = requests.post(
-                f"{HA_URL}/services/automation/reload",
-                headers=headers,
-                json={},
-                timeout=10
-            )
+            create_response = ha_request('POST', 'services/automation/reload', json={}, retry=True)
             
             print(f"Reload response: {create_response.status_code}")
             
             # METODO ALTERNATIVO: Scrivi via servizio config
             # Proviamo a usare il servizio di configurazione
-            config_response = requests.post(
-                f"{HA_URL}/config/automation/config/{automation_id}",
-                headers=headers,
+            # Upsert per id: idempotente, si può ritentare
+            config_response = ha_request(
+                'POST',
+                f"config/automation/config/{automation_id}",
                 json=api_automation,
-                timeout=15
+                retry=True
             )
             
             print(f"Config API response: {config_response.status_code}")
             print(f"Config API response text: {config_response.text[:200]}")
             
             if config_response.status_code in [200, 201]:
-                # Successo!
+                # Successo! La nuova automation.* cambia gli stati
+                invalidate_registry_cache('states')
+                automation_index.invalidate(str(automation_id))
                 return jsonify({
                     'success': True,
                     'message': f'Automazione "{alias}" creata con successo!',
@@ -1065,16 +5183,13 @@ def api_install():
             else:
                 # Prova metodo POST diretto
                 print("Tentativo metodo POST automation config...")
-                post_response = requests.post(
-                    f"{HA_URL}/config/automation/config",
-                    headers=headers,
-                    json=api_automation,
-                    timeout=15
-                )
+                post_response = ha_request('POST', 'config/automation/config', json=api_automation)
                 
                 print(f"POST response: {post_response.status_code}")
                 
                 if post_response.status_code in [200, 201]:
+                    invalidate_registry_cache('states')
+                    automation_index.invalidate(str(automation_id))
                     return jsonify({
                         'success': True,
                         'message': f'Automazione "{alias}" creata!',
@@ -1127,16 +5242,103 @@ def api_visualize():
     if not yaml_text:
         return jsonify({'error': 'YAML mancante'}), 400
     
-    # Genera grafo
+    # Genera grafo (locale, veloce)
     graph = parse_automation_to_graph(yaml_text)
     
-    # Analisi AI
-    ai_analysis = explain_automation_with_ai(yaml_text)
+    # Analisi AI solo se già in cache: altrimenti la UI la chiede a /api/visualize/analysis
+    ai_analysis = get_automation_analysis(yaml_text, cached_only=True)
     
     return jsonify({
         'graph': graph,
-        'analysis': ai_analysis
+        'analysis': ai_analysis,
+        'analysis_pending': ai_analysis is None,
+        'analysis_id': automation_hash(yaml_text)
+    })
+
+@app.route('/api/visualize/analysis', methods=['POST'])
+def api_visualize_analysis():
+    """Analisi AI dell'automazione (cache per hash canonico del YAML)"""
+    data = request.json
+    yaml_text = data.get('automation', '')
+    
+    if not yaml_text:
+        return jsonify({'error': 'YAML mancante'}), 400
+    
+    analysis = get_automation_analysis(yaml_text, cached_only=True)
+    if analysis is None:
+        try:
+            analysis = llm_runtime.run(get_automation_analysis, yaml_text)
+        except LLMBusyError as e:
+            return llm_busy_response(e)
+    
+    return jsonify({
+        'analysis': analysis,
+        'analysis_id': automation_hash(yaml_text)
+    })
+
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs_stats():
+    """Stato del pool LLM e del governatore Gemini di questo worker"""
+    return jsonify({
+        'pid': os.getpid(),
+        'llm': llm_runtime.stats(),
+        'gemini': gemini_governor.stats(),
+        'models': model_registry.tasks,
+        'context_cache': context_cache.stats()
     })
 
+@app.route('/api/jobs/generate', methods=['POST'])
+def api_jobs_generate():
+    """Generazione in background: ritorna subito un job_id (stato su /api/jobs/<id>)"""
+    data = request.json
+    description = data.get('description', '')
+    selected_entities = data.get('entities', [])
+    use_cache = not data.get('no_cache', False)
+    if not description:
+        return jsonify({'error': 'Descrizione mancante'}), 400
+    try:
+        candidates = parse_candidates(data)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'candidates non valido'}), 400
+    
+    cached = get_cached_generation(description, selected_entities) if use_cache else None
+    if cached is not None:
+        job_id = job_store.create('generate')
+        job_store.finish(job_id, {'automation': cached, 'generation': {'path': 'cache'}})
+        return jsonify({'job_id': job_id, 'status': 'done'}), 202
+    
+    def job():
+        meta = {}
+        # Variante che solleva: un errore di Gemini chiude il job con stato 'error'
+        automation = _generate_automation(description, selected_entities, use_cache=False, meta=meta, candidates=candidates)
+        return {'automation': automation, 'generation': meta}
+    
+    try:
+        job_id = llm_runtime.submit_job('generate', job)
+    except LLMBusyError as e:
+        return llm_busy_response(e)
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+
+@app.route('/api/jobs/analysis', methods=['POST'])
+def api_jobs_analysis():
+    """Analisi AI in background: ritorna subito un job_id (stato su /api/jobs/<id>)"""
+    data = request.json
+    yaml_text = data.get('automation', '')
+    if not yaml_text:
+        return jsonify({'error': 'YAML mancante'}), 400
+    
+    analysis = get_automation_analysis(yaml_text, cached_only=True)
+    if analysis is not None:
+        job_id = job_store.create('analysis')
+        job_store.finish(job_id, {'analysis': analysis})
+        return jsonify({'job_id': job_id, 'status': 'done'}), 202
+    
+    try:
+        job_id = llm_runtime.submit_job('analysis', lambda: {'analysis': get_automation_analysis(yaml_text)})
+    except LLMBusyError as e:
+        return llm_busy_response(e)
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+
 if __name__ == '__main__':
+    warm_up()
     app.run(host='0.0.0.0', port=8099)
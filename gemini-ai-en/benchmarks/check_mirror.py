@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Controllo del mirror WebSocket (HAEntityMirror) contro stub in-process.
+
+Avvia WebSocketStub e SupervisorStub nello stesso processo, punta l'add-on
+su di loro e verifica:
+- caricamento iniziale ed eventi state_changed dal vivo
+- chiusura della connessione (drop_connections): mentre il mirror è giù le
+  entità arrivano dall'API REST; dopo la riconnessione stati aggiunti e
+  rimossi durante l'interruzione sono allineati
+- ping senza risposta (ignore_pings): il mirror chiude e si riconnette
+
+Esce con codice 1 al primo controllo fallito.
+
+Uso: python benchmarks/check_mirror.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from stub_supervisor import SupervisorStub  # noqa: E402
+from stub_websocket import WebSocketStub  # noqa: E402
+
+ENTITIES = 200
+TIMEOUT = 15
+
+ws_stub = WebSocketStub(entities=ENTITIES, port=0).start()
+supervisor = SupervisorStub(entities=ENTITIES, service_latency=0, port=0).start()
+
+os.environ.update({
+    'CACHE_DIR': tempfile.mkdtemp(prefix='check-mirror-'),
+    'SUPERVISOR_TOKEN': 'check',
+    'HA_URL': supervisor.url,
+    'HA_WS_URL': ws_stub.url,
+    'HA_WEBSOCKET_MIRROR': '1'
+})
+sys.path.insert(0, APP_DIR)
+
+import app  # noqa: E402
+
+app.MIRROR_PING_INTERVAL = 0.5  # ping dopo 0.5s di silenzio, timeout dopo altri 0.5s
+
+failures = []
+
+def check(name, condition, detail=''):
+    print(f"{'OK  ' if condition else 'FAIL'} {name}{f' ({detail})' if detail and not condition else ''}")
+    if not condition:
+        failures.append(name)
+    return condition
+
+def wait_for(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+def state_of(mirror, entity_id):
+    return (mirror.get_state(entity_id) or {}).get('state')
+
+def main():
+    app.get_mirror()
+    mirror = app._mirror
+    if not check("mirror pronto", mirror is not None and mirror.wait_ready(TIMEOUT)):
+        return
+    check("entità caricate", len(mirror.entity_ids()) == ENTITIES, len(mirror.entity_ids()))
+    check("get_entities() dal mirror", len(app.get_entities()) == ENTITIES)
+
+    # Eventi dal vivo
+    ws_stub.set_state('light.check_live', 'on')
+    check("state_changed applicato", wait_for(lambda: state_of(mirror, 'light.check_live') == 'on'))
+
+    # Chiusura della connessione: fallback REST e risincronizzazione
+    connections = ws_stub.connections
+    removed = next(e for e in mirror.entity_ids() if e.startswith('switch.'))
+    ws_stub.drop_connections()
+    if not check("mirror non pronto dopo la chiusura", wait_for(lambda: not mirror.ready)):
+        return
+    ws_stub.set_state('light.check_drop', 'off')
+    ws_stub.set_state('light.check_live', 'off')
+    ws_stub.remove_entity(removed)
+    check("get_mirror() None durante l'interruzione", app.get_mirror() is None)
+    rest_hits = supervisor.hits.get('GET states', 0)
+    app.invalidate_registry_cache('states')
+    check("get_entities() dall'API REST durante l'interruzione",
+          len(app.get_entities()) == ENTITIES and supervisor.hits.get('GET states', 0) > rest_hits)
+    check("riconnessione dopo la chiusura",
+          wait_for(lambda: ws_stub.connections > connections and mirror.ready), ws_stub.connections)
+    check("entità aggiunta durante l'interruzione", mirror.has_entity('light.check_drop'))
+    check("stato cambiato durante l'interruzione", state_of(mirror, 'light.check_live') == 'off',
+          state_of(mirror, 'light.check_live'))
+    check("entità rimossa durante l'interruzione", not mirror.has_entity(removed))
+    check("entity_ids() aggiornato", 'light.check_drop' in mirror.entity_ids() and removed not in mirror.entity_ids())
+
+    # Ping senza risposta: il mirror deve accorgersene e riconnettersi
+    connections = ws_stub.connections
+    reconnects = mirror.reconnects
+    ws_stub.ignore_pings = True
+    if not check("connessione chiusa per ping senza risposta", wait_for(lambda: not mirror.ready)):
+        return
+    ws_stub.ignore_pings = False
+    ws_stub.set_state('light.check_ping', 'on')
+    check("riconnessione dopo il timeout del ping",
+          wait_for(lambda: ws_stub.connections > connections and mirror.ready), ws_stub.connections)
+    check("reconnects incrementato", mirror.reconnects > reconnects, mirror.reconnects)
+    check("stato impostato durante l'interruzione", state_of(mirror, 'light.check_ping') == 'on')
+
+try:
+    main()
+finally:
+    if app._mirror is not None:
+        app._mirror.stop()
+    ws_stub.stop()
+    supervisor.stop()
+
+sys.exit(1 if failures else 0)
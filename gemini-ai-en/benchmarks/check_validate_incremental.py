@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Controllo di validate_incremental su documenti con chiavi duplicate e merge key.
+
+Mentre si scrive nell'editor capita spesso di avere due volte la stessa
+chiave (PyYAML tiene l'ultima) o blocchi presi da un'ancora con `<<:`: la
+validazione deve rispondere con diagnostiche, non con un'eccezione, e le
+chiamate successive della stessa sessione devono riusare il memo.
+
+Gira offline (registri finti, nessuna chiamata a HA). Esce con codice 1 al
+primo controllo fallito.
+
+Uso: python benchmarks/check_validate_incremental.py
+"""
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='check-validate-'))
+os.environ.setdefault('HA_WEBSOCKET_MIRROR', '0')
+sys.path.insert(0, APP_DIR)
+
+import app  # noqa: E402
+
+INDEX = app.RegistryIndex(
+    frozenset({'light.soggiorno', 'light.cucina', 'binary_sensor.movimento'}),
+    {'light': frozenset({'turn_on', 'turn_off'})},
+    version='check'
+)
+
+DUPLICATE_KEY = """alias: Chiave duplicata
+trigger:
+  - platform: state
+    entity_id: binary_sensor.movimento
+trigger:
+  - platform: state
+    entity_id: binary_sensor.movimento
+  - platform: state
+    entity_id: light.inesistente
+action:
+  - service: light.turn_on
+    target:
+      entity_id: light.soggiorno
+"""
+
+MERGE_KEY = """base: &base
+  trigger:
+    - platform: state
+      entity_id: binary_sensor.movimento
+    - platform: state
+      entity_id: light.inesistente
+alias: Merge key
+<<: *base
+action:
+  - service: light.turn_on
+    target:
+      entity_id: light.cucina
+"""
+
+MERGE_KEY_OVERRIDE = """base: &base
+  action:
+    - service: light.turn_off
+      target:
+        entity_id: light.cucina
+alias: Merge key con override
+trigger:
+  - platform: state
+    entity_id: binary_sensor.movimento
+<<: *base
+action:
+  - service: light.turn_on
+    target:
+      entity_id: light.soggiorno
+  - service: light.accendi
+    target:
+      entity_id: light.soggiorno
+"""
+
+failures = []
+
+def check(name, condition, detail=''):
+    print(f"{'OK  ' if condition else 'FAIL'} {name}{f' ({detail})' if detail and not condition else ''}")
+    if not condition:
+        failures.append(name)
+
+def refs(result):
+    return {d.get('ref') for d in result['diagnostics']}
+
+def run(name, text, expected_ref, expected_path):
+    session = f"check-{name}"
+    try:
+        first = app.validate_incremental(session, text, INDEX)
+        second = app.validate_incremental(session, text, INDEX)
+    except Exception as e:
+        check(f"{name}: nessuna eccezione", False, f"{type(e).__name__}: {e}")
+        return
+    check(f"{name}: nessuna eccezione", True)
+    check(f"{name}: diagnostica su {expected_ref}", expected_ref in refs(first), refs(first))
+    diag = next((d for d in first['diagnostics'] if d.get('ref') == expected_ref), None)
+    check(f"{name}: percorso {expected_path}", diag is not None and diag['path'] == expected_path,
+          diag and diag['path'])
+    check(f"{name}: riga e colonna", diag is not None and diag['line'] and diag['column'], diag)
+    check(f"{name}: stesso risultato alla seconda chiamata", first['diagnostics'] == second['diagnostics'])
+    check(f"{name}: seconda chiamata tutta dal memo", second['blocks']['revalidated'] == 0, second['blocks'])
+
+run('chiave duplicata', DUPLICATE_KEY, 'light.inesistente', ['trigger', 1])
+run('merge key', MERGE_KEY, 'light.inesistente', ['trigger', 1])
+run('merge key con override', MERGE_KEY_OVERRIDE, 'light.accendi', ['action', 1])
+
+sys.exit(1 if failures else 0)
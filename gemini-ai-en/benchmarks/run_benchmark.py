@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""Benchmark dell'add-on con supervisor e Gemini finti (gira offline).
+
+Per ogni dimensione del registro entità avvia lo stub del supervisor, lo
+stub di Gemini e l'add-on sotto gunicorn (stessa configurazione di run.sh),
+poi esegue gli scenari a concorrenza controllata e riporta throughput,
+latenza p50/p99 ed RSS massimo (master + worker).
+
+Esempi:
+    python benchmarks/run_benchmark.py
+    python benchmarks/run_benchmark.py --entities 100,50000 --concurrency 16 --requests 500
+    python benchmarks/run_benchmark.py --json risultati.json
+    python benchmarks/run_benchmark.py --baseline risultati.json --tolerance 0.3   # CI: exit 1 se regressione
+
+Richiede solo le dipendenze dell'add-on (requirements.txt) e Linux (/proc per l'RSS).
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+
+BENCH_AUTOMATION = """alias: Benchmark - luce al movimento
+description: Accende la luce quando rileva movimento
+trigger:
+  - platform: state
+    entity_id: binary_sensor.bench_3
+    to: "on"
+condition:
+  - condition: state
+    entity_id: person.bench_7
+    state: home
+action:
+  - service: light.turn_on
+    target:
+      entity_id: light.bench_0
+  - delay: "00:00:01"
+  - choose:
+      - conditions:
+          - condition: numeric_state
+            entity_id: sensor.bench_2
+            below: 18
+        sequence:
+          - service: climate.set_temperature
+            target:
+              entity_id: climate.bench_4
+            data:
+              temperature: 21
+    default:
+      - service: switch.turn_off
+        target:
+          entity_id: switch.bench_1
+mode: single
+"""
+
+EXECUTE_AUTOMATION = """alias: Benchmark - esecuzione
+action:
+  - service: light.turn_on
+    target:
+      entity_id: light.bench_0
+  - service: switch.turn_off
+    target:
+      entity_id: switch.bench_1
+  - service: cover.open_cover
+    target:
+      entity_id: cover.bench_5
+"""
+
+def scenario_entities(i):
+    if i % 2:
+        return 'GET', f"/api/entities?q=bench {i % 50}&limit=50", None
+    return 'GET', '/api/entities?fields=friendly_name&limit=100', None
+
+def scenario_test(i):
+    return 'POST', '/api/test', {'automation': BENCH_AUTOMATION}
+
+def scenario_visualize(i):
+    return 'POST', '/api/visualize', {'automation': BENCH_AUTOMATION}
+
+def scenario_execute(i):
+    return 'POST', '/api/execute', {'automation': EXECUTE_AUTOMATION, 'concurrent': True}
+
+def scenario_generate(i):
+    # Descrizioni sempre diverse e no_cache: ogni richiesta arriva allo stub Gemini
+    return 'POST', '/api/generate', {
+        'description': f"Accendi la luce light.bench_0 quando rileva movimento (richiesta {i})",
+        'entities': ['light.bench_0', 'binary_sensor.bench_3', 'sensor.bench_2'],
+        'no_cache': True
+    }
+
+SCENARIOS = {
+    'entities': scenario_entities,
+    'test': scenario_test,
+    'visualize': scenario_visualize,
+    'execute': scenario_execute,
+    'generate': scenario_generate,
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_http(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=2).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} non pronto dopo {timeout}s")
+
+def process_tree_rss(pid):
+    """RSS totale (byte) di un processo e dei suoi figli diretti, da /proc"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+    return total
+
+class RssSampler:
+    """Campiona l'RSS dell'albero gunicorn ogni 50ms e ne tiene il massimo"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = process_tree_rss(self.pid)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def run_scenario(base_url, name, total, concurrency, timeout):
+    """Esegue 'total' richieste dello scenario con 'concurrency' client"""
+    make_request = SCENARIOS[name]
+    local = threading.local()
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def one(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        method, path, payload = make_request(i)
+        started = time.perf_counter()
+        try:
+            response = session.request(method, base_url + path, json=payload, timeout=timeout)
+            response.content
+            status = response.status_code
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ok = statuses.get(200, 0)
+    return {
+        'requests': total,
+        'ok': ok,
+        'errors': {str(k): v for k, v in statuses.items() if k != 200},
+        'throughput_rps': round(ok / wall, 2) if wall else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'wall_s': round(wall, 3),
+    }
+
+def start_app(port, ha_url, gemini_url, workdir, args):
+    env = dict(
+        os.environ,
+        HA_URL=ha_url,
+        HA_WEBSOCKET_MIRROR='0',
+        GEMINI_API_ENDPOINT=gemini_url,
+        GOOGLE_API_KEY='benchmark',
+        SUPERVISOR_TOKEN='benchmark',
+        CACHE_DIR=os.path.join(workdir, 'cache'),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'prometheus'),
+        # Il benchmark misura l'add-on, non la quota dell'API key
+        GEMINI_RPM='1000000',
+        GEMINI_BURST='1000000',
+        LLM_MAX_PENDING='100000',
+        EXECUTE_MAX_JOBS='1000',
+    )
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    cmd = [
+        sys.executable, '-m', 'gunicorn',
+        '--config', os.path.join(APP_DIR, 'gunicorn.conf.py'),
+        '--preload',
+        '--bind', f"127.0.0.1:{port}",
+        '--workers', str(args.workers),
+        '--worker-class', 'gthread',
+        '--threads', str(args.threads),
+        '--timeout', '300',
+        'app:app',
+    ]
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    return subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def start_stub(script, *args):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, script), '--port', str(port), *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return proc, port
+
+def stop(proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def run_size(entities, args):
+    """Avvia stub + add-on per una dimensione del registro ed esegue gli scenari"""
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    supervisor, ha_port = start_stub('stub_supervisor.py', '--entities', str(entities),
+                                     '--service-latency', str(args.service_latency))
+    gemini, gemini_port = start_stub('stub_gemini.py', '--latency', str(args.gemini_latency),
+                                     '--slow-rate', str(args.gemini_slow_rate), '--error-rate', str(args.gemini_error_rate))
+    app_port = free_port()
+    app = None
+    results = []
+    try:
+        ha_url = f"http://127.0.0.1:{ha_port}/core/api"
+        wait_http(ha_url + '/')
+        app = start_app(app_port, ha_url, f"http://127.0.0.1:{gemini_port}", workdir, args)
+        base_url = f"http://127.0.0.1:{app_port}"
+        wait_http(base_url + '/api/ready')
+        # Riscaldamento: registri in cache e worker avviati
+        for _ in range(args.workers * 2):
+            requests.get(base_url + '/api/entities?limit=1', timeout=args.timeout)
+
+        for name in args.scenarios:
+            total = args.requests if name != 'generate' else min(args.requests, args.generate_requests)
+            with RssSampler(app.pid) as rss:
+                result = run_scenario(base_url, name, total, args.concurrency, args.timeout)
+            result.update({'entities': entities, 'scenario': name, 'peak_rss_mb': round(rss.peak / 2 ** 20, 1)})
+            results.append(result)
+            print_result(result)
+    finally:
+        if app is not None:
+            stop(app)
+        stop(supervisor)
+        stop(gemini)
+        if args.keep_logs:
+            print(f"  log gunicorn: {os.path.join(workdir, 'gunicorn.log')}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def print_header():
+    print(f"{'entità':>8} {'scenario':<10} {'ok':>6} {'errori':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'RSS MB':>8}")
+
+def print_result(r):
+    errors = sum(r['errors'].values())
+    print(f"{r['entities']:>8} {r['scenario']:<10} {r['ok']:>6} {errors:>7} {r['throughput_rps'] or 0:>9} "
+          f"{r['p50_ms'] or '-':>9} {r['p99_ms'] or '-':>9} {r['peak_rss_mb']:>8}")
+    if errors:
+        print(f"{'':>8} {'':<10} errori: {r['errors']}")
+
+def compare(results, baseline_path, tolerance):
+    """Confronta con un baseline JSON: ritorna l'elenco delle regressioni"""
+    with open(baseline_path) as f:
+        baseline = {(r['entities'], r['scenario']): r for r in json.load(f)['results']}
+    regressions = []
+    for r in results:
+        base = baseline.get((r['entities'], r['scenario']))
+        if base is None:
+            continue
+        label = f"{r['scenario']} ({r['entities']} entità)"
+        if r['errors']:
+            regressions.append(f"{label}: errori {r['errors']}")
+        if base.get('p99_ms') and r['p99_ms'] and r['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{label}: p99 {r['p99_ms']}ms contro {base['p99_ms']}ms")
+        if base.get('throughput_rps') and (r['throughput_rps'] or 0) < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {r['throughput_rps']} req/s contro {base['throughput_rps']}")
+        if base.get('peak_rss_mb') and r['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{label}: RSS {r['peak_rss_mb']}MB contro {base['peak_rss_mb']}MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entities', default='100,1000,10000', help='dimensioni del registro, separate da virgola (max 50000)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"fra: {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='richieste per scenario')
+    parser.add_argument('--generate-requests', type=int, default=40, help='richieste per lo scenario generate')
+    parser.add_argument('--gemini-latency', type=float, default=0.5, help='latenza dello stub Gemini (s)')
+    parser.add_argument('--gemini-slow-rate', type=float, default=0.0, help='frazione di risposte Gemini lente (10s)')
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0, help='frazione di risposte Gemini 503')
+    parser.add_argument('--service-latency', type=float, default=0.05, help='latenza delle chiamate servizio (s)')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--json', help='scrive i risultati in questo file')
+    parser.add_argument('--baseline', help='risultati di riferimento (JSON di --json)')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='peggioramento ammesso rispetto al baseline')
+    parser.add_argument('--keep-logs', action='store_true')
+    args = parser.parse_args()
+
+    args.scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"scenari sconosciuti: {', '.join(unknown)}")
+    sizes = [int(n) for n in args.entities.split(',')]
+    if any(n < 1 or n > 50000 for n in sizes):
+        parser.error('--entities: valori fra 1 e 50000')
+
+    print(f"Concorrenza {args.concurrency}, {args.workers} worker x {args.threads} thread, "
+          f"latenza Gemini {args.gemini_latency}s")
+    print_header()
+    results = []
+    for entities in sizes:
+        results += run_size(entities, args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'config': {k: v for k, v in vars(args).items() if k not in ('json', 'baseline')},
+                       'results': results}, f, indent=2)
+        print(f"Risultati scritti in {args.json}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print('REGRESSIONI:')
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print('Nessuna regressione rispetto al baseline')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Tempo di avvio dell'add-on (gira offline, con supervisor finto).
+
+Misura, per più avvii di gunicorn con la configurazione di run.sh:
+- import: tempo di `import app` in un processo Python nuovo
+- ingress: dal lancio di gunicorn alla prima risposta 200 su /
+- ready:   dal lancio alla prima risposta 200 su /api/ready (registri in cache)
+
+Esce con codice 1 se la mediana supera i target (--target-ingress, --target-ready).
+
+Esempi:
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --runs 5 --entities 10000 --target-ready 8
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from run_benchmark import APP_DIR, free_port, start_app, start_stub, stop
+
+def measure_import():
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, '-c', 'import app'],
+        cwd=APP_DIR, check=True, stdout=subprocess.DEVNULL,
+        env=dict(os.environ, CACHE_DIR=tempfile.mkdtemp(prefix='bench-import-'), HA_WEBSOCKET_MIRROR='0')
+    )
+    return time.perf_counter() - started
+
+def wait_status(url, launched, timeout):
+    """Secondi dal lancio alla prima risposta 200 di url"""
+    deadline = launched + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if requests.get(url, timeout=2).status_code == 200:
+                return time.perf_counter() - launched
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.02)
+    raise RuntimeError(f"{url} non pronto dopo {timeout}s")
+
+def measure_start(ha_url, args):
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    launched = time.perf_counter()
+    app = start_app(port, ha_url, 'http://127.0.0.1:9', workdir, args)
+    try:
+        ingress = wait_status(base_url + '/', launched, args.timeout)
+        ready = wait_status(base_url + '/api/ready', launched, args.timeout)
+        return ingress, ready
+    finally:
+        stop(app)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--entities', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--target-ingress', type=float, default=3.0, help='mediana massima (s) per la prima risposta su /')
+    parser.add_argument('--target-ready', type=float, default=5.0, help='mediana massima (s) per /api/ready')
+    parser.add_argument('--json', help='scrive i risultati in questo file')
+    args = parser.parse_args()
+
+    supervisor, ha_port = start_stub('stub_supervisor.py', '--entities', str(args.entities))
+    ha_url = f"http://127.0.0.1:{ha_port}/core/api"
+    try:
+        imports, ingress, ready = [], [], []
+        for run in range(args.runs):
+            imports.append(measure_import())
+            i, r = measure_start(ha_url, args)
+            ingress.append(i)
+            ready.append(r)
+            print(f"avvio {run + 1}: import {imports[-1]:.2f}s, ingress {i:.2f}s, ready {r:.2f}s")
+    finally:
+        stop(supervisor)
+
+    result = {
+        'entities': args.entities,
+        'workers': args.workers,
+        'import_s': round(statistics.median(imports), 3),
+        'ingress_s': round(statistics.median(ingress), 3),
+        'ready_s': round(statistics.median(ready), 3),
+    }
+    print(f"mediana: import {result['import_s']}s, ingress {result['ingress_s']}s "
+          f"(target {args.target_ingress}s), ready {result['ready_s']}s (target {args.target_ready}s)")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if result['ingress_s'] > args.target_ingress or result['ready_s'] > args.target_ready:
+        print('TARGET DI AVVIO SUPERATO')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
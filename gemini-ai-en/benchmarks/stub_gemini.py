@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""API Gemini finta per i benchmark (trasporto REST di google-generativeai).
+
+Risponde a :generateContent e :streamGenerateContent dopo una latenza
+configurabile: YAML per le richieste di generazione, JSON per le analisi.
+Gestisce anche cachedContents (context caching): i token del contenuto in
+cache sono riportati in usageMetadata.cachedContentTokenCount.
+--slow-rate/--slow-latency simulano la coda lenta dei modelli preview,
+--error-rate risposte 503 (errori transitori).
+
+Uso: python stub_gemini.py --latency 1.5 --port 8124
+     python stub_gemini.py --latency 1 --slow-rate 0.05 --slow-latency 20 --error-rate 0.02
+L'add-on va avviato con GEMINI_API_ENDPOINT=http://127.0.0.1:8124
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+AUTOMATION_TEXT = """```yaml
+alias: Benchmark - luce al movimento
+description: Accende la luce quando rileva movimento
+trigger:
+  - platform: state
+    entity_id: binary_sensor.bench_3
+    to: "on"
+condition: []
+action:
+  - service: light.turn_on
+    target:
+      entity_id: light.bench_0
+mode: single
+```"""
+
+ANALYSIS_TEXT = json.dumps({
+    'summary': 'Accende la luce quando viene rilevato movimento.',
+    'triggers': ['Movimento rilevato'],
+    'conditions': [],
+    'actions': ['Accende la luce'],
+    'suggestions': ['Aggiungi una condizione sull\'orario']
+})
+
+class GeminiStub:
+    """Server HTTP in un thread con latenza (più jitter) per chiamata"""
+
+    def __init__(self, latency=0.5, jitter=0.1, port=0, slow_rate=0.0, slow_latency=10.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self.cached_contents = {}  # {nome: CachedContent JSON}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _read(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+            
+            def _cached_name(self):
+                path = self.path.split('?', 1)[0]
+                return path[path.index('cachedContents/'):] if 'cachedContents/' in path else None
+            
+            def do_GET(self):
+                cached = stub.cached_contents.get(self._cached_name())
+                if cached is None:
+                    return self._send({'error': {'code': 404, 'message': 'CachedContent not found', 'status': 'NOT_FOUND'}}, 404)
+                self._send(cached)
+            
+            def do_PATCH(self):
+                cached = stub.cached_contents.get(self._cached_name())
+                if cached is None:
+                    return self._send({'error': {'code': 404, 'message': 'CachedContent not found', 'status': 'NOT_FOUND'}}, 404)
+                cached.update({k: v for k, v in self._read().items() if k in ('ttl', 'expireTime')})
+                self._send(cached)
+            
+            def do_DELETE(self):
+                stub.cached_contents.pop(self._cached_name(), None)
+                self._send({})
+            
+            def _create_cached_content(self, request):
+                name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+                text = ''.join(p.get('text', '') for p in (request.get('systemInstruction') or {}).get('parts', []))
+                cached = {
+                    'name': name,
+                    'model': request.get('model', ''),
+                    'displayName': request.get('displayName', ''),
+                    'createTime': '2026-01-01T00:00:00Z',
+                    'updateTime': '2026-01-01T00:00:00Z',
+                    'expireTime': '2026-01-01T01:00:00Z',
+                    'usageMetadata': {'totalTokenCount': len(text) // 4},
+                    '_text': text
+                }
+                stub.cached_contents[name] = cached
+                self._send({k: v for k, v in cached.items() if not k.startswith('_')})
+            
+            def do_POST(self):
+                request = self._read()
+                if self.path.split('?', 1)[0].endswith('/cachedContents'):
+                    return self._create_cached_content(request)
+                with stub._lock:
+                    stub.calls += 1
+                prompt = ''.join(
+                    part.get('text', '')
+                    for content in request.get('contents', [])
+                    for part in content.get('parts', [])
+                )
+                prefix = ''.join(p.get('text', '') for p in (request.get('systemInstruction') or {}).get('parts', []))
+                cached_tokens = 0
+                if request.get('cachedContent'):
+                    cached = stub.cached_contents.get(request['cachedContent'])
+                    if cached is None:
+                        return self._send({'error': {'code': 404, 'message': 'CachedContent not found', 'status': 'NOT_FOUND'}}, 404)
+                    prefix = cached['_text']
+                    cached_tokens = len(prefix) // 4
+                text = ANALYSIS_TEXT if 'valid JSON object' in prompt else AUTOMATION_TEXT
+                latency = stub.slow_latency if random.random() < stub.slow_rate else stub.latency
+                time.sleep(max(0.0, latency + random.uniform(-stub.jitter, stub.jitter)))
+                if random.random() < stub.error_rate:
+                    return self._send({'error': {'code': 503, 'message': 'The model is overloaded', 'status': 'UNAVAILABLE'}}, 503)
+
+                usage = {
+                    'promptTokenCount': (len(prefix) + len(prompt)) // 4,
+                    'cachedContentTokenCount': cached_tokens,
+                    'candidatesTokenCount': len(text) // 4,
+                    'totalTokenCount': (len(prefix) + len(prompt) + len(text)) // 4
+                }
+                if ':streamGenerateContent' in self.path:
+                    # Il trasporto REST legge un array JSON di risposte parziali
+                    step = max(1, len(text) // 4)
+                    body = [
+                        {'candidates': [{'content': {'parts': [{'text': text[i:i + step]}], 'role': 'model'}, 'index': 0}]}
+                        for i in range(0, len(text), step)
+                    ]
+                    body[-1]['candidates'][0]['finishReason'] = 'STOP'
+                    body[-1]['usageMetadata'] = usage
+                elif ':generateContent' in self.path:
+                    body = {
+                        'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}],
+                        'usageMetadata': usage
+                    }
+                else:
+                    return self._send({'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}}, 404)
+                self._send(body)
+
+            def _send(self, body, status=200):
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.5, help='secondi per risposta')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='frazione di risposte lente')
+    parser.add_argument('--slow-latency', type=float, default=10.0, help='latenza delle risposte lente (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='frazione di risposte 503')
+    parser.add_argument('--port', type=int, default=8124)
+    args = parser.parse_args()
+
+    stub = GeminiStub(args.latency, args.jitter, args.port, args.slow_rate, args.slow_latency, args.error_rate)
+    print(f"Gemini finto su {stub.url} (latenza {args.latency}s)")
+    stub.server.serve_forever()
+
+if __name__ == '__main__':
+    main()
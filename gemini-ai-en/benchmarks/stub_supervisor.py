@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Supervisor HA finto per i benchmark (nessuna rete esterna).
+
+Serve sotto /core/api:
+- GET  states                          N entità sintetiche (100 - 50k)
+- GET  services                        servizi dei domini generati
+- GET  config/automation/config/<id>   automazione di esempio
+- POST config/automation/config/<id>   salvataggio (sempre ok)
+- POST services/<dominio>/<servizio>   chiamata servizio con latenza configurabile
+
+Uso: python stub_supervisor.py --entities 10000 --port 8123
+L'add-on va avviato con HA_URL=http://127.0.0.1:8123/core/api
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+API_PREFIX = '/core/api/'
+
+# (dominio, stati possibili, attributi extra, servizi)
+DOMAINS = [
+    ('light', ['on', 'off'], {'brightness': 180, 'color_mode': 'brightness'}, ['turn_on', 'turn_off', 'toggle']),
+    ('switch', ['on', 'off'], {}, ['turn_on', 'turn_off', 'toggle']),
+    ('sensor', ['21.5', '48', '1013'], {'unit_of_measurement': '°C', 'device_class': 'temperature', 'state_class': 'measurement'}, []),
+    ('binary_sensor', ['on', 'off'], {'device_class': 'motion'}, []),
+    ('climate', ['heat', 'off'], {'current_temperature': 20.5, 'temperature': 21, 'hvac_modes': ['off', 'heat']}, ['set_temperature', 'set_hvac_mode']),
+    ('cover', ['open', 'closed'], {'current_position': 100}, ['open_cover', 'close_cover']),
+    ('media_player', ['playing', 'idle'], {'volume_level': 0.4, 'source_list': ['TV', 'Radio']}, ['media_play', 'media_pause', 'volume_set']),
+    ('person', ['home', 'not_home'], {}, []),
+]
+
+EXTRA_SERVICES = {
+    'homeassistant': ['turn_on', 'turn_off', 'toggle'],
+    'automation': ['reload', 'trigger', 'turn_on', 'turn_off'],
+    'notify': ['notify', 'mobile_app_phone'],
+    'script': ['turn_on'],
+    'scene': ['turn_on'],
+    'input_boolean': ['turn_on', 'turn_off'],
+}
+
+def make_states(count):
+    """Entità sintetiche distribuite sui domini; entity_id stabili (dominio.bench_i)"""
+    states = []
+    for i in range(count):
+        domain, values, attributes, _ = DOMAINS[i % len(DOMAINS)]
+        states.append({
+            'entity_id': f"{domain}.bench_{i}",
+            'state': values[i % len(values)],
+            'attributes': dict(attributes, friendly_name=f"{domain.replace('_', ' ').title()} Bench {i}"),
+            'last_changed': '2026-01-01T00:00:00+00:00',
+            'last_updated': '2026-01-01T00:00:00+00:00',
+            'context': {'id': f"ctx{i}", 'parent_id': None, 'user_id': None}
+        })
+    return states
+
+def make_services():
+    services = {domain: names for domain, _, _, names in DOMAINS if names}
+    services.update(EXTRA_SERVICES)
+    return [
+        {'domain': domain, 'services': {name: {'name': name, 'fields': {}} for name in names}}
+        for domain, names in services.items()
+    ]
+
+SAMPLE_AUTOMATION = {
+    'id': 'bench',
+    'alias': 'Benchmark',
+    'trigger': [{'platform': 'state', 'entity_id': 'binary_sensor.bench_3', 'to': 'on'}],
+    'condition': [],
+    'action': [{'service': 'light.turn_on', 'target': {'entity_id': 'light.bench_0'}}],
+    'mode': 'single'
+}
+
+class SupervisorStub:
+    """Server HTTP in un thread; i payload JSON sono pre-serializzati"""
+
+    def __init__(self, entities=1000, service_latency=0.05, port=0):
+        self.states_body = json.dumps(make_states(entities)).encode('utf-8')
+        self.services_body = json.dumps(make_services()).encode('utf-8')
+        self.service_latency = service_latency
+        self.hits = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/core/api"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, key):
+        with self._lock:
+            self.hits[key] = self.hits.get(key, 0) + 1
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive come il supervisor vero
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, status=200):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _path(self):
+                path = self.path.split('?', 1)[0]
+                return path[len(API_PREFIX):] if path.startswith(API_PREFIX) else None
+
+            def do_GET(self):
+                path = self._path()
+                stub._count(f"GET {path}")
+                if path == 'states':
+                    return self._send(stub.states_body)
+                if path == 'services':
+                    return self._send(stub.services_body)
+                if path is not None and path.startswith('config/automation/config/'):
+                    return self._send(dict(SAMPLE_AUTOMATION, id=path.rsplit('/', 1)[-1]))
+                if path == '':
+                    return self._send({'message': 'API running.'})
+                self._send({'message': 'Not found'}, 404)
+
+            def do_POST(self):
+                path = self._path()
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                stub._count(f"POST {path}")
+                if path is not None and path.startswith('config/automation/config/'):
+                    return self._send({'result': 'ok'})
+                if path is not None and path.startswith('services/'):
+                    time.sleep(stub.service_latency)
+                    return self._send([])
+                self._send({'message': 'Not found'}, 404)
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entities', type=int, default=1000)
+    parser.add_argument('--service-latency', type=float, default=0.05, help='secondi per chiamata servizio')
+    parser.add_argument('--port', type=int, default=8123)
+    args = parser.parse_args()
+
+    stub = SupervisorStub(args.entities, args.service_latency, args.port)
+    print(f"Supervisor finto su {stub.url} ({args.entities} entità)")
+    stub.server.serve_forever()
+
+if __name__ == '__main__':
+    main()
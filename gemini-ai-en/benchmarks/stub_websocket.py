@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""API WebSocket di HA finta per il mirror delle entità (nessuna dipendenza esterna).
+
+Implementa la parte del protocollo usata da HAEntityMirror:
+- auth_required / auth / auth_ok (o auth_invalid se il token non corrisponde)
+- subscribe_events (state_changed, service_registered, service_removed)
+- get_states, get_services, ping/pong
+Genera eventi state_changed a ritmo configurabile e può chiudere tutte le
+connessioni (--drop-every, drop_connections()) o smettere di rispondere ai
+ping (ignore_pings) per riprodurre riconnessione e risincronizzazione.
+
+Uso: python stub_websocket.py --entities 10000 --event-rate 50 --drop-every 30 --port 8125
+L'add-on va avviato con HA_WS_URL=ws://127.0.0.1:8125/core/websocket
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import socketserver
+import struct
+import threading
+import time
+
+from stub_supervisor import DOMAINS, EXTRA_SERVICES, make_states
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def make_services():
+    """Servizi nel formato di get_services: {dominio: {servizio: dati}}"""
+    services = {domain: names for domain, _, _, names in DOMAINS if names}
+    services.update(EXTRA_SERVICES)
+    return {domain: {name: {'name': name, 'fields': {}} for name in names} for domain, names in services.items()}
+
+class WebSocketStub:
+    """Server WebSocket in un thread; stati e servizi modificabili dai test"""
+
+    def __init__(self, entities=1000, port=0, token=None, event_rate=0.0, drop_every=0.0):
+        self.states = {s['entity_id']: s for s in make_states(entities)}
+        self.services = make_services()
+        self.token = token
+        self.event_rate = event_rate
+        self.drop_every = drop_every
+        self.ignore_pings = False
+        self.connections = 0  # connessioni autenticate dall'avvio
+        self.events_sent = 0
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.server.allow_reuse_address = True
+
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self.server.server_address[1]}/core/websocket"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.event_rate > 0 or self.drop_every > 0:
+            threading.Thread(target=self._background, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.drop_connections()
+        self.server.shutdown()
+        self.server.server_close()
+
+    # ---- modifiche dai test ----
+
+    def set_state(self, entity_id, state, attributes=None):
+        """Crea o aggiorna un'entità e notifica state_changed"""
+        with self._lock:
+            old = self.states.get(entity_id)
+            new = {
+                'entity_id': entity_id,
+                'state': state,
+                'attributes': attributes if attributes is not None else (old or {}).get('attributes', {}),
+                'last_changed': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()),
+                'last_updated': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()),
+                'context': {'id': f"ctx{random.getrandbits(32)}", 'parent_id': None, 'user_id': None}
+            }
+            self.states[entity_id] = new
+        self._broadcast('state_changed', {'entity_id': entity_id, 'old_state': old, 'new_state': new})
+
+    def remove_entity(self, entity_id):
+        with self._lock:
+            old = self.states.pop(entity_id, None)
+        if old is not None:
+            self._broadcast('state_changed', {'entity_id': entity_id, 'old_state': old, 'new_state': None})
+
+    def register_service(self, domain, service):
+        with self._lock:
+            self.services.setdefault(domain, {})[service] = {'name': service, 'fields': {}}
+        self._broadcast('service_registered', {'domain': domain, 'service': service})
+
+    def remove_service(self, domain, service):
+        with self._lock:
+            self.services.get(domain, {}).pop(service, None)
+            if not self.services.get(domain):
+                self.services.pop(domain, None)
+        self._broadcast('service_removed', {'domain': domain, 'service': service})
+
+    def drop_connections(self):
+        """Chiude tutte le connessioni (come un riavvio di HA)"""
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+
+    # ---- interno ----
+
+    def _broadcast(self, event_type, data):
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            subscription = client.subscriptions.get(event_type)
+            if subscription is not None:
+                client.send({
+                    'id': subscription,
+                    'type': 'event',
+                    'event': {'event_type': event_type, 'data': data, 'origin': 'LOCAL',
+                              'time_fired': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())}
+                })
+                self.events_sent += 1
+
+    def _background(self):
+        """Eventi state_changed casuali e chiusure periodiche delle connessioni"""
+        last_drop = time.monotonic()
+        interval = 1.0 / self.event_rate if self.event_rate > 0 else 0.5
+        while not self._stop.wait(interval):
+            if self.event_rate > 0:
+                with self._lock:
+                    entity_id = random.choice(list(self.states)) if self.states else None
+                if entity_id:
+                    domain = entity_id.split('.', 1)[0]
+                    values = next((v for d, v, _, _ in DOMAINS if d == domain), ['on', 'off'])
+                    self.set_state(entity_id, random.choice(values))
+            if self.drop_every > 0 and time.monotonic() - last_drop >= self.drop_every:
+                last_drop = time.monotonic()
+                self.drop_connections()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                super().setup()
+                self.subscriptions = {}  # {event_type: id della sottoscrizione}
+                self._send_lock = threading.Lock()
+                self._closed = False
+
+            # -- framing RFC 6455 (solo quanto serve: testo, ping, close) --
+
+            def _handshake(self):
+                request_line = self.rfile.readline()
+                headers = {}
+                while True:
+                    line = self.rfile.readline().decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                key = headers.get('sec-websocket-key')
+                if not request_line or not key:
+                    return False
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+                self.wfile.write((
+                    'HTTP/1.1 101 Switching Protocols\r\n'
+                    'Upgrade: websocket\r\n'
+                    'Connection: Upgrade\r\n'
+                    f'Sec-WebSocket-Accept: {accept}\r\n\r\n'
+                ).encode())
+                return True
+
+            def _frame(self, opcode, payload):
+                header = bytes([0x80 | opcode])
+                length = len(payload)
+                if length < 126:
+                    header += bytes([length])
+                elif length < 1 << 16:
+                    header += bytes([126]) + struct.pack('!H', length)
+                else:
+                    header += bytes([127]) + struct.pack('!Q', length)
+                with self._send_lock:
+                    if self._closed:
+                        return
+                    try:
+                        self.wfile.write(header + payload)
+                        self.wfile.flush()
+                    except OSError:
+                        self._closed = True
+
+            def _read_frame(self):
+                head = self.rfile.read(2)
+                if len(head) < 2:
+                    return None, None
+                opcode = head[0] & 0x0F
+                length = head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('!H', self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', self.rfile.read(8))[0]
+                mask = self.rfile.read(4) if head[1] & 0x80 else b'\0\0\0\0'
+                data = self.rfile.read(length)
+                return opcode, bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+            def send(self, message):
+                self._frame(0x1, json.dumps(message).encode('utf-8'))
+
+            def close(self):
+                self._frame(0x8, b'')
+                with self._send_lock:
+                    self._closed = True
+                try:
+                    self.request.shutdown(2)
+                except OSError:
+                    pass
+
+            def recv(self):
+                while True:
+                    opcode, payload = self._read_frame()
+                    if opcode is None or opcode == 0x8:
+                        return None
+                    if opcode == 0x9:
+                        self._frame(0xA, payload)
+                    elif opcode == 0x1:
+                        return json.loads(payload)
+
+            # -- protocollo HA --
+
+            def handle(self):
+                if not self._handshake():
+                    return
+                self.send({'type': 'auth_required', 'ha_version': '2026.1.0'})
+                msg = self.recv()
+                if not msg or msg.get('type') != 'auth' or (stub.token and msg.get('access_token') != stub.token):
+                    self.send({'type': 'auth_invalid', 'message': 'Invalid access token or password'})
+                    return
+                self.send({'type': 'auth_ok', 'ha_version': '2026.1.0'})
+                with stub._lock:
+                    stub._clients.add(self)
+                    stub.connections += 1
+                try:
+                    while not self._closed:
+                        msg = self.recv()
+                        if msg is None:
+                            break
+                        self._command(msg)
+                finally:
+                    with stub._lock:
+                        stub._clients.discard(self)
+
+            def _command(self, msg):
+                msg_id = msg.get('id')
+                msg_type = msg.get('type')
+                if msg_type == 'subscribe_events':
+                    self.subscriptions[msg.get('event_type')] = msg_id
+                    self.send({'id': msg_id, 'type': 'result', 'success': True, 'result': None})
+                elif msg_type == 'get_states':
+                    with stub._lock:
+                        states = list(stub.states.values())
+                    self.send({'id': msg_id, 'type': 'result', 'success': True, 'result': states})
+                elif msg_type == 'get_services':
+                    with stub._lock:
+                        services = {domain: dict(names) for domain, names in stub.services.items()}
+                    self.send({'id': msg_id, 'type': 'result', 'success': True, 'result': services})
+                elif msg_type == 'ping':
+                    if not stub.ignore_pings:
+                        self.send({'id': msg_id, 'type': 'pong'})
+                else:
+                    self.send({'id': msg_id, 'type': 'result', 'success': False,
+                               'error': {'code': 'unknown_command', 'message': 'Unknown command.'}})
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entities', type=int, default=1000)
+    parser.add_argument('--event-rate', type=float, default=0.0, help='eventi state_changed al secondo')
+    parser.add_argument('--drop-every', type=float, default=0.0, help='chiude tutte le connessioni ogni N secondi')
+    parser.add_argument('--token', help='token atteso (qualsiasi se omesso)')
+    parser.add_argument('--port', type=int, default=8125)
+    args = parser.parse_args()
+
+    stub = WebSocketStub(args.entities, args.port, args.token, args.event_rate, args.drop_every)
+    print(f"WebSocket HA finto su {stub.url} ({args.entities} entità)")
+    stub.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stub.stop()
+
+if __name__ == '__main__':
+    main()
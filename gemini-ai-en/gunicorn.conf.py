@@ -0,0 +1,11 @@
+# Configurazione gunicorn (le opzioni di avvio sono in run.sh)
+from prometheus_client import multiprocess
+
+def child_exit(server, worker):
+    # Metriche Prometheus: rimuove i valori "live" del worker terminato
+    multiprocess.mark_process_dead(worker.pid)
+
+def post_worker_init(worker):
+    # Con --preload il modulo è già importato dal master: scalda registri e SDK in background
+    import app
+    app.warm_up()
@@ -3,6 +3,27 @@
 export GOOGLE_API_KEY=$(bashio::config 'google_api_key')
 export SUPERVISOR_TOKEN="${SUPERVISOR_TOKEN}"
 
+# Modello e generation config per compito (generate, explain, repair)
+for task in generate explain repair; do
+    prefix="GEMINI_${task^^}"
+    export "${prefix}_MODEL=$(bashio::config "${task}_model")"
+    if bashio::config.has_value "${task}_temperature"; then
+        export "${prefix}_TEMPERATURE=$(bashio::config "${task}_temperature")"
+    fi
+    if bashio::config.has_value "${task}_max_tokens"; then
+        export "${prefix}_MAX_TOKENS=$(bashio::config "${task}_max_tokens")"
+    fi
+    if bashio::config.has_value "${task}_fallback_model"; then
+        export "${prefix}_FALLBACK_MODEL=$(bashio::config "${task}_fallback_model")"
+    fi
+done
+if bashio::config.has_value 'hedge_percentile'; then
+    export GEMINI_HEDGE_PERCENTILE=$(bashio::config 'hedge_percentile')
+fi
+if bashio::config.has_value 'generate_candidates'; then
+    export GENERATE_CANDIDATES=$(bashio::config 'generate_candidates')
+fi
+
 if [ -z "$GOOGLE_API_KEY" ]; then
     bashio::log.error "Google API Key non configurata!"
     bashio::log.error "Aggiungi la tua API key nella configurazione dell'addon"
@@ -15,5 +36,12 @@ bashio::log.info "Lingua: Italiano 🇮🇹"
 bashio::log.info "Autenticazione: Disabilitata (protetto da Ingress HA)"
 bashio::log.info "Nuova feature: Editor YAML ✏️"
 
+# Metriche Prometheus condivise fra i worker (/metrics)
+export PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 cd /
-exec gunicorn --bind 0.0.0.0:8099 --workers 4 --timeout 300 app:app
+# Thread per worker: le chiamate AI (pool limitato) non bloccano gli endpoint veloci.
+# --preload: i worker nascono dal master con i moduli già importati (avvio rapido)
+exec gunicorn --config /gunicorn.conf.py --preload --bind 0.0.0.0:8099 --workers 2 --worker-class gthread --threads 16 --timeout 300 app:app